@@ -5,6 +5,7 @@ Runs the application.
 """
 
 
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from itertools import cycle
@@ -36,7 +37,7 @@ if __name__ == '__main__':
     geo_data.dataset_name = 'WI_Municipal_Wards_Fall_2016'
     geo_data.load_data()
 
-    geo_data.generate_polygons()
+    geo_data.generate_polygons(threads=os.cpu_count())
     geo_data.scale_to_screen()
     geo_data.smooth_vertices()
 
@@ -2,14 +2,47 @@ import os
 import json
 import numpy as np
 import csv
+import multiprocessing
+from collections import deque
 
 import distopia
 from distopia.app.geo_data import GeoData
-from distopia.precinct import Precinct
+from distopia.precinct import PrecinctTable
 from distopia.mapping.voronoi import VoronoiMapping
-from distopia.precinct.metrics import PrecinctHistogram, PrecinctScalar
-from distopia.district.metrics import DistrictHistogramAggregateMetric, \
-    DistrictScalarAggregateMetric
+from distopia.district.metrics import create_district_metrics
+from distopia.district.aggregate import MetricAggregator
+from distopia.district.compactness import DistrictCompactness
+from distopia.metrics import StateMetricSuite
+
+
+_pool_agent = None
+"""The :class:`VoronoiAgent` used by the pool worker processes.
+"""
+
+_fork_agent = None
+"""The initialized :class:`VoronoiAgent` inherited by forked pool workers.
+"""
+
+
+def _init_pool_worker(settings):
+    # with fork the workers inherit the parent's initialized agent, otherwise
+    # they load their own with the parent's settings
+    global _pool_agent
+    if settings is None:
+        agent = _pool_agent = _fork_agent
+    else:
+        agent = _pool_agent = VoronoiAgent()
+        for key, value in settings.items():
+            setattr(agent, key, value)
+        agent.create_voronoi()
+        agent.load_precinct_metrics()
+        agent.load_precinct_adjacency()
+    # the pool already uses all the cores
+    agent.voronoi_mapping.num_threads = 1
+
+
+def _evaluate_chunk(configs):
+    return [_pool_agent.evaluate_design(fiducials) for fiducials in configs]
 
 
 class VoronoiAgent(object):
@@ -22,25 +55,72 @@ class VoronoiAgent(object):
 
     precincts = []
 
+    precinct_table = None
+    """The :class:`~distopia.precinct.PrecinctTable` holding the data of the
+    :attr:`precincts`.
+    """
+
     screen_size = (1900, 800)
 
     metrics = ['demographics', ]
 
     data_loader = None
 
-    def create_district_metrics(self, districts):
-        for district in districts:
-            for name in self.metrics:
-                if name == 'income':
-                    continue
-                district.metrics[name] = \
-                    DistrictHistogramAggregateMetric(
-                        district=district, name=name)
-
-            name = 'income'
-            if name in self.metrics:
-                district.metrics[name] = \
-                    DistrictScalarAggregateMetric(district=district, name=name)
+    adjacency_mode = 'rook'
+    """How the precinct adjacency is computed for datasets other than the
+    county dataset, see
+    :meth:`~distopia.app.geo_data.GeoData.load_adjacency`.
+    """
+
+    metric_aggregations = {'income': 'median', 'projected_votes': 'mean'}
+    """A mapping from metric name to how the precinct metric is aggregated
+    into the district metric, see
+    :class:`~distopia.district.aggregate.MetricAggregator`.
+    """
+
+    metric_aggregator = None
+    """The :class:`~distopia.district.aggregate.MetricAggregator` that
+    computes the district metrics.
+    """
+
+    state_metric_suite = None
+    """The :class:`~distopia.metrics.StateMetricSuite` that computes the state
+    metrics.
+    """
+
+    compactness_metrics = ['polsby_popper', 'reock', 'convex_hull']
+    """The names of the district compactness metrics, see
+    :class:`~distopia.district.compactness.DistrictCompactness`. If empty,
+    the compactness is not computed.
+    """
+
+    district_compactness = None
+    """The :class:`~distopia.district.compactness.DistrictCompactness` that
+    computes the :attr:`compactness_metrics`.
+    """
+
+    pool_settings = (
+        'use_county_dataset', 'screen_size', 'metrics', 'adjacency_mode',
+        'metric_aggregations', 'compactness_metrics')
+    """The settings copied to the pool workers that are not forked and have
+    to load their own data.
+    """
+
+    _pool = None
+
+    _pool_size = 0
+
+    def create_district_metrics(
+            self, districts, pixel_district_map=None,
+            pixel_district_scale=None):
+        """Creates and computes the metrics of the districts, with the
+        :attr:`metric_aggregator` and the :attr:`district_compactness`, see
+        :func:`~distopia.district.metrics.create_district_metrics`.
+        """
+        create_district_metrics(
+            districts, self.metrics, self.metric_aggregator,
+            self.district_compactness, self.voronoi_mapping,
+            pixel_district_map, pixel_district_scale)
 
     def load_precinct_metrics(self):
         assert self.use_county_dataset
@@ -50,12 +130,14 @@ class VoronoiAgent(object):
         names = {v: v for v in names}
         names['Saint Croix'] = 'St. Croix'
 
+        # the population is also needed to weight the aggregated metrics
+        metric_names = list(self.metrics)
+        if 'population' not in metric_names:
+            metric_names.append('population')
+
         root = os.path.join(
             os.path.dirname(distopia.__file__), 'data', 'aggregate')
-        for name in self.metrics:
-            if name == 'income':
-                continue
-
+        for name in metric_names:
             fname = os.path.join(root, '{}.csv'.format(name))
             with open(fname) as fh:
                 reader = csv.reader(fh, delimiter='\t')
@@ -65,41 +147,51 @@ class VoronoiAgent(object):
                 for row in reader:
                     data[row[0]] = list(map(float, row[1:]))
 
-            for precinct, record in zip(self.precincts, geo_data.records):
-                precinct_name = names[record[3]]
-                precinct.metrics[name] = PrecinctHistogram(
-                    name=name, labels=header, data=data[precinct_name])
-
-        name = 'income'
-        if name in self.metrics:
-            fname = os.path.join(root, '{}.csv'.format(name))
-            with open(fname) as fh:
-                reader = csv.reader(fh, delimiter='\t')
-                _ = next(reader)[1:]  # header
-
-                data = {}
-                for row in reader:
-                    data[row[0]] = float(row[1])
+            data = [data[names[record[3]]] for record in geo_data.records]
+            if name == 'income':
+                # skip the county median income, the district median is
+                # estimated from the income brackets
+                header = header[1:]
+                data = [item[1:] for item in data]
+            self.precinct_table.set_metric(name, data, labels=header)
 
-            for precinct, record in zip(self.precincts, geo_data.records):
-                precinct_name = names[record[3]]
-                precinct.metrics[name] = PrecinctScalar(
-                    name=name, value=data[precinct_name])
+        self.metric_aggregator = MetricAggregator(
+            self.precinct_table, self.metrics,
+            aggregations=self.metric_aggregations, weights='population')
+        self.state_metric_suite = StateMetricSuite()
 
     def load_precinct_adjacency(self):
-        assert self.use_county_dataset
-        fname = os.path.join(
-            os.path.dirname(distopia.__file__), 'data', 'county_adjacency.json')
+        """Loads the precincts' neighbours. The hand-made county adjacency is
+        used for the county dataset, otherwise it's computed from the
+        precinct geometry as set by :attr:`adjacency_mode`, and cached.
+        """
+        table = self.precinct_table
+        if self.use_county_dataset:
+            fname = os.path.join(
+                os.path.dirname(distopia.__file__), 'data',
+                'county_adjacency.json')
+
+            with open(fname, 'r') as fh:
+                counties = json.load(fh)
 
-        with open(fname, 'r') as fh:
-            counties = json.load(fh)
+            table.set_neighbours(
+                [counties.get(str(i), []) for i in range(len(table))])
+            adjacency = table.get_adjacency()
+        else:
+            adjacency = self.geo_data.load_adjacency(
+                mode=self.adjacency_mode,
+                pixel_precinct_map=self.voronoi_mapping.pixel_precinct_map)
+            table.set_adjacency(adjacency)
 
-        precincts = self.precincts
-        for i, neighbours in counties.items():
-            precincts[int(i)].neighbours = [precincts[p] for p in neighbours]
+        self.voronoi_mapping.precinct_adjacency = adjacency
 
     def create_state_metrics(self, districts):
-        return []
+        """Creates the state metrics of the districts, computed together by
+        the :attr:`state_metric_suite` from the district metrics.
+        """
+        if self.state_metric_suite is None:
+            return []
+        return self.state_metric_suite.create_state_metrics(districts)
 
     def create_voronoi(self):
         """Loads and initializes all the data and voronoi mapping.
@@ -112,26 +204,33 @@ class VoronoiAgent(object):
             geo_data.source_coordinates = ''
 
         geo_data.screen_size = self.screen_size
-        try:
-            geo_data.load_npz_data()
-        except FileNotFoundError:
-            geo_data.load_data()
-            geo_data.generate_polygons()
-            geo_data.scale_to_screen()
-            geo_data.smooth_vertices()
+        if not geo_data.load_flat_data():
+            try:
+                geo_data.load_npz_data()
+            except FileNotFoundError:
+                geo_data.load_data()
+                geo_data.generate_polygons()
+                geo_data.scale_to_screen()
+                geo_data.smooth_vertices()
+            if not geo_data.polygon_lods:
+                geo_data.simplify_polygons()
+            # the flat data is memory mapped, so it loads much faster. It's
+            # reloaded so the data is the same as on the next startups
+            if geo_data.dump_flat_data():
+                geo_data.load_flat_data()
 
         self.voronoi_mapping = vor = VoronoiMapping()
         vor.screen_size = self.screen_size
-        self.precincts = precincts = []
+        vor.raster_cache_path = geo_data.get_raster_cache_path()
+        self.precinct_table = table = PrecinctTable.from_polygons(
+            geo_data.polygons, names=[str(r[0]) for r in geo_data.records])
+        self.precincts = precincts = table.precincts
 
-        for i, (record, polygons) in enumerate(
-                zip(geo_data.records, geo_data.polygons)):
-            precinct = Precinct(
-                name=str(record[0]), boundary=polygons[0].reshape(-1).tolist(),
-                identity=i, location=polygons[0].mean(axis=0).tolist())
-            precincts.append(precinct)
+        vor.set_precincts(precincts, geo_data.get_lod_boundaries())
 
-        vor.set_precincts(precincts)
+        if self.compactness_metrics:
+            self.district_compactness = DistrictCompactness(
+                self.compactness_metrics)
 
     def load_config(self):
         fname = os.path.join(
@@ -163,20 +262,215 @@ class VoronoiAgent(object):
             return [], []
 
         self.create_district_metrics(districts)
-        state_mets = self.create_state_metrics(districts)
-
-        state_metrics = []
-        for metric in state_mets:
-            metric.compute()
-            state_metrics.append(metric)
+        state_metrics = self.create_state_metrics(districts)
 
         district_metrics = {}
         for district in districts:
-            district.compute_metrics()
             district_metrics[district.identity] = list(district.metrics.values())
 
         return state_metrics, district_metrics
 
+    @staticmethod
+    def get_metric_data(metric):
+        """Returns a json-able dict with the name and data of the district or
+        state ``metric``.
+        """
+        if hasattr(metric, 'data'):
+            return {
+                'name': metric.name, 'labels': list(metric.labels),
+                'data': list(metric.data)}
+        return {'name': metric.name, 'value': metric.value}
+
+    def evaluate_design(self, fiducials):
+        """Computes the districts and metrics of a design, like
+        :meth:`compute_voronoi_metrics`, but without adding the fiducials to
+        the :attr:`voronoi_mapping`.
+
+        :param fiducials: A dict mapping the district (logical) id to a list
+            of the ``(x, y)`` positions of its fiducials.
+        :return: A json-able dict with the ``'districts'``, each a dict with
+            its ``'district_id'``, ``'precincts'`` identities and
+            ``'metrics'``, the state ``'metrics'``, and the ``'error'``
+            precinct identities if the districts are not contiguous.
+        """
+        vor = self.voronoi_mapping
+        w, h = vor.screen_size
+        fiducial_pos = []
+        fiducial_identity = []
+        for fid_id, locations in fiducials.items():
+            for x, y in locations:
+                fiducial_pos.append(
+                    (min(max(x, 0), w - 1), min(max(y, 0), h - 1)))
+                fiducial_identity.append(fid_id)
+
+        result = {'districts': [], 'metrics': [], 'error': []}
+        if len(fiducial_pos) <= 3:
+            return result
+
+        unique_ids = list(sorted(set(fiducial_identity)))
+        pixel_district_map, precinct_assignment, _ = vor.compute_assignment(
+            np.asarray(fiducial_pos), fiducial_identity, unique_ids)
+        districts, error = vor.create_districts_from_assignment(
+            precinct_assignment, unique_ids)
+        if error:
+            result['error'] = [p.identity for p in error]
+            return result
+
+        for district, precincts in zip(districts, precinct_assignment):
+            district.assign_precincts(precincts)
+        self.create_district_metrics(
+            districts, pixel_district_map, vor.compute_scale)
+
+        for metric in self.create_state_metrics(districts):
+            result['metrics'].append(self.get_metric_data(metric))
+
+        for district in districts:
+            result['districts'].append({
+                'district_id': district.identity,
+                'precincts': [p.identity for p in district.precincts],
+                'metrics': [self.get_metric_data(m)
+                            for m in district.metrics.values()]})
+        return result
+
+    def get_precinct_metric_data(self, name):
+        """Returns the metric data of all the :attr:`precincts` for the
+        metric ``name``, as loaded by :meth:`load_precinct_metrics`.
+
+        :return: A tuple of the labels and a precincts by labels array for
+            histogram metrics, or None and a precincts array for scalar
+            metrics.
+        """
+        table = self.precinct_table
+        return table.metric_labels.get(name), table.metric_data[name]
+
+    def evaluate_batch(self, configs, sample_step=4):
+        """Evaluates a small batch of designs at once, vectorized with numpy
+        using :meth:`~distopia.mapping.voronoi.VoronoiMapping.compute_batch_assignment`.
+
+        Unlike :meth:`evaluate_design`, the contiguity of the districts is
+        not checked.
+
+        :param configs: A list of designs, each a dict mapping the district
+            (logical) id to a list of the ``(x, y)`` positions of its
+            fiducials.
+        :param sample_step: Passed on to
+            :meth:`~distopia.mapping.voronoi.VoronoiMapping.compute_batch_assignment`.
+            With ``1``, all the precinct pixels are sampled and the precinct
+            assignment matches :meth:`evaluate_design`. Larger steps are
+            much faster and only flip the odd precinct split almost evenly
+            between districts.
+        :return: A dict with the sorted ``'district_ids'`` of all the
+            designs, the configurations by precincts ``'assignment'`` array
+            of the index in ``'district_ids'`` of each precinct's district,
+            the ``'metrics'`` dict mapping each metric name to a
+            configurations by districts (by labels, for histograms) array of
+            the district metrics as aggregated by the
+            :attr:`metric_aggregator` and the ``'labels'`` of each metric.
+        """
+        vor = self.voronoi_mapping
+        w, h = vor.screen_size
+        district_ids = sorted(
+            set(fid_id for config in configs for fid_id in config))
+        n_sites = max(
+            [sum(len(locations) for locations in config.values())
+             for config in configs] or [0])
+
+        fiducials = np.full((len(configs), n_sites, 2), np.nan)
+        fiducials_district = np.zeros((len(configs), n_sites), dtype=np.int64)
+        for i, config in enumerate(configs):
+            j = 0
+            for fid_id, locations in config.items():
+                for x, y in locations:
+                    fiducials[i, j] = min(max(x, 0), w - 1), \
+                        min(max(y, 0), h - 1)
+                    fiducials_district[i, j] = district_ids.index(fid_id)
+                    j += 1
+
+        assignment = vor.compute_batch_assignment(
+            fiducials, fiducials_district, len(district_ids),
+            sample_step=sample_step)
+        aggregator = self.metric_aggregator
+        metrics = aggregator.aggregate_batch(assignment, len(district_ids))
+        labels = {name: aggregator.labels[name] for name in self.metrics}
+
+        return {'district_ids': district_ids, 'assignment': assignment,
+                'metrics': metrics, 'labels': labels}
+
+    def start_pool(self, processes=None):
+        """Starts the pool of worker processes used by :meth:`evaluate_many`.
+
+        Where processes are forked, the workers inherit this agent with its
+        loaded data, so :meth:`load_data` must have been called. Otherwise
+        each worker loads the data with this agent's :attr:`pool_settings`.
+
+        :param processes: The number of processes. Defaults to the number of
+            cores.
+        """
+        global _fork_agent
+        self.stop_pool()
+        self._pool_size = processes = processes or multiprocessing.cpu_count()
+
+        context = multiprocessing.get_context()
+        if context.get_start_method() == 'fork':
+            _fork_agent = self
+            settings = None
+        else:
+            settings = {key: getattr(self, key) for key in self.pool_settings}
+
+        self._pool = context.Pool(
+            processes, initializer=_init_pool_worker, initargs=(settings, ))
+
+    def stop_pool(self):
+        """Stops the pool started by :meth:`start_pool`, if any.
+        """
+        global _fork_agent
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if _fork_agent is self:
+            _fork_agent = None
+
+    def evaluate_many(self, configs, chunk_size=16, max_pending=None):
+        """Evaluates many designs with :meth:`evaluate_design` on the
+        worker pool, starting it if needed.
+
+        :param configs: An iterable of designs, each a dict like the
+            ``fiducials`` of :meth:`evaluate_design`. It's consumed lazily,
+            so it may be a generator.
+        :param chunk_size: The number of designs sent to a worker at once.
+        :param max_pending: The largest number of chunks that may be
+            submitted but not yet collected. Once reached, the iteration of
+            ``configs`` waits for the oldest chunk. Defaults to twice the
+            number of processes.
+        :return: A list of the results of :meth:`evaluate_design`, in the
+            order of ``configs``.
+        """
+        if self._pool is None:
+            self.start_pool()
+        pool = self._pool
+        if max_pending is None:
+            max_pending = 2 * self._pool_size
+
+        results = []
+        pending = deque()
+        chunk = []
+        for config in configs:
+            chunk.append(config)
+            if len(chunk) < chunk_size:
+                continue
+
+            if len(pending) >= max_pending:
+                results.extend(pending.popleft().get())
+            pending.append(pool.apply_async(_evaluate_chunk, (chunk, )))
+            chunk = []
+
+        if chunk:
+            pending.append(pool.apply_async(_evaluate_chunk, (chunk, )))
+        while pending:
+            results.extend(pending.popleft().get())
+        return results
+
 
 if __name__ == '__main__':
     import time
@@ -18,13 +18,19 @@ We assume that in wisconsin, wards are precincts.
 """
 
 import os.path
+import shutil
 import distopia
 import shapefile
 import numpy as np
-from pyproj import Proj, transform
+from pyproj import Transformer
 import math
 import json
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from distopia.precinct.adjacency import PrecinctAdjacency, \
+    adjacency_from_polygons, adjacency_from_raster
+from distopia.precinct.topology import PrecinctTopology
 
 __all__ = ('GeoData', )
 
@@ -55,6 +61,27 @@ class GeoData(object):
     ``(min_x, min_y, max_x, max_y)``
     """
 
+    lod_tolerances = (.5, 1., 2., 4.)
+    """The tolerances, in the units of the :attr:`polygons` (screen pixels
+    once scaled to the screen), of the levels of detail created by
+    :meth:`simplify_polygons`.
+    """
+
+    flat_vertex_dtype = np.float32
+    """The type of the vertices saved by :meth:`dump_flat_data`.
+    """
+
+    polygon_lods = []
+    """A list of ``(tolerance, polygons)`` levels of detail of the
+    :attr:`polygons`, from the most to the least detailed, each simplified
+    within ``tolerance`` by :meth:`simplify_polygons`. They are saved with
+    and loaded from ``data.npz``.
+    """
+
+    def __init__(self, **kwargs):
+        super(GeoData, self).__init__(**kwargs)
+        self.polygon_lods = []
+
     @property
     def data_path(self):
         return os.path.join(
@@ -80,6 +107,141 @@ class GeoData(object):
         self.polygons = data['polygons'].tolist()
         self.records = data['records'].tolist()
 
+        self.polygon_lods = []
+        if 'lod_tolerances' in data.files:
+            for i, tolerance in enumerate(data['lod_tolerances'].tolist()):
+                self.polygon_lods.append((tolerance, self.unflatten_polygons(
+                    data['lod_{}_vertices'.format(i)],
+                    data['lod_{}_polygon_offsets'.format(i)],
+                    data['lod_{}_precinct_offsets'.format(i)])))
+
+    @staticmethod
+    def flatten_polygons(polygons):
+        """Flattens the list of the polygons of each precinct, as in
+        :attr:`polygons`, into arrays.
+
+        :return: A tuple of the nx2 array of the vertices of all the polygons,
+            the number of polygons + 1 array of the offsets of each polygon's
+            vertices in it, and the number of precincts + 1 array of the
+            offsets of each precinct's polygons in the polygon offsets.
+        """
+        flat = [polygon for precinct_polygons in polygons
+                for polygon in precinct_polygons]
+        polygon_offsets = np.zeros(len(flat) + 1, dtype=np.int64)
+        np.cumsum([len(polygon) for polygon in flat], out=polygon_offsets[1:])
+        precinct_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        np.cumsum([len(precinct_polygons) for precinct_polygons in polygons],
+                  out=precinct_offsets[1:])
+        vertices = np.concatenate(
+            [np.asarray(polygon, dtype=np.float64).reshape((-1, 2))
+             for polygon in flat]) if flat else np.zeros((0, 2))
+        return vertices, polygon_offsets, precinct_offsets
+
+    @staticmethod
+    def unflatten_polygons(vertices, polygon_offsets, precinct_offsets):
+        """The inverse of :meth:`flatten_polygons`. The polygons are views
+        into ``vertices``.
+        """
+        polygon_offsets = np.asarray(polygon_offsets).tolist()
+        polygons = [
+            vertices[s:e]
+            for s, e in zip(polygon_offsets[:-1], polygon_offsets[1:])]
+        precinct_offsets = np.asarray(precinct_offsets).tolist()
+        return [polygons[s:e]
+                for s, e in zip(precinct_offsets[:-1], precinct_offsets[1:])]
+
+    def simplify_polygons(self, tolerances=None, topology_tolerance=1.):
+        """Creates the :attr:`polygon_lods` from the :attr:`polygons`.
+
+        The boundaries are simplified on the
+        :class:`~distopia.precinct.topology.PrecinctTopology` of the
+        polygons, so the boundary shared by two precincts is simplified the
+        same for both and the simplified precincts don't have gaps or
+        overlaps between them.
+
+        :param tolerances: The tolerance of each level. Defaults to
+            :attr:`lod_tolerances`.
+        :param topology_tolerance: The largest distance between boundaries
+            that are considered shared, see
+            :meth:`~distopia.precinct.topology.PrecinctTopology.from_polygons`.
+        """
+        if tolerances is None:
+            tolerances = self.lod_tolerances
+        topology = PrecinctTopology.from_polygons(
+            self.polygons, tolerance=topology_tolerance)
+        self.polygon_lods = [
+            (tolerance, topology.simplify(tolerance).get_precinct_polygons(
+                self.polygons))
+            for tolerance in sorted(tolerances)]
+
+    def get_lod_polygons(self, tolerance):
+        """Returns the polygons of the least detailed level in
+        :attr:`polygon_lods` whose tolerance is not larger than
+        ``tolerance``, or the :attr:`polygons` if there's none.
+        """
+        polygons = self.polygons
+        for lod_tolerance, lod_polygons in self.polygon_lods:
+            if lod_tolerance <= tolerance:
+                polygons = lod_polygons
+        return polygons
+
+    def get_lod_boundaries(self):
+        """Returns the :attr:`polygon_lods` as a list of
+        ``(tolerance, boundaries)``, where ``boundaries`` is the flat array of
+        the coordinates of the first polygon of each precinct. This is the
+        format of
+        :attr:`~distopia.mapping.voronoi.VoronoiMapping.precinct_lods`.
+        """
+        return [
+            (tolerance, [
+                np.asarray(precinct_polygons[0], dtype=np.float64).ravel()
+                for precinct_polygons in polygons])
+            for tolerance, polygons in self.polygon_lods]
+
+    def get_adjacency_filename(self, mode='rook'):
+        """Returns the filename, next to ``data.npz``, where the precinct
+        adjacency computed with ``mode`` is saved.
+        """
+        return os.path.join(
+            self.data_path, 'adjacency_{}.npz'.format(mode.replace('-', '_')))
+
+    def load_adjacency(self, mode='rook', tolerance=1., pixel_precinct_map=None):
+        """Loads the precinct adjacency saved by a previous call, or builds it
+        and saves it next to ``data.npz``.
+
+        :param mode: ``'rook'`` or ``'queen'`` to build it from the
+            :attr:`polygons` with
+            :func:`~distopia.precinct.adjacency.adjacency_from_polygons`, or
+            ``'raster-rook'`` or ``'raster-queen'`` to build it from
+            ``pixel_precinct_map`` with
+            :func:`~distopia.precinct.adjacency.adjacency_from_raster`.
+        :param tolerance: The tolerance, in the units of the :attr:`polygons`,
+            used when building it from the polygons.
+        :param pixel_precinct_map: The precincts rasterized, e.g.
+            :attr:`distopia.mapping.raster.PrecinctRaster.pixel_precinct_map`.
+        :return: The :class:`~distopia.precinct.adjacency.PrecinctAdjacency`.
+        """
+        fname = self.get_adjacency_filename(mode)
+        if os.path.exists(fname):
+            adjacency = PrecinctAdjacency.load(fname)
+            if len(adjacency) == len(self.polygons):
+                return adjacency
+
+        if mode in ('rook', 'queen'):
+            adjacency = adjacency_from_polygons(
+                self.polygons, mode=mode, tolerance=tolerance)
+        elif mode in ('raster-rook', 'raster-queen'):
+            if pixel_precinct_map is None:
+                raise ValueError('pixel_precinct_map is required for raster '
+                                 'adjacency')
+            adjacency = adjacency_from_raster(
+                pixel_precinct_map, len(self.polygons), mode=mode[7:])
+        else:
+            raise ValueError('Unknown adjacency mode "{}"'.format(mode))
+
+        adjacency.save(fname)
+        return adjacency
+
     def dump_data_to_disk(self):
         with zipfile.ZipFile(
                 os.path.join(self.data_path, 'json_data.zip'), 'w',
@@ -98,6 +260,19 @@ class GeoData(object):
                 'polygons.json',
                 json.dumps(polygons, indent=2, sort_keys=True))
 
+        np.savez_compressed(
+            os.path.join(self.data_path, 'data.npz'),
+            records=self.get_record_array(), polygons=self.polygons,
+            fields=self.fields, **self.get_lod_arrays())
+        self.dump_flat_data()
+
+    def get_record_array(self):
+        """Returns the :attr:`records` as a structured array with a typed
+        column for each field.
+        """
+        if isinstance(self.records, np.ndarray):
+            return self.records
+
         str_max = 0
         int_max = 0
         field_types = [
@@ -113,7 +288,7 @@ class GeoData(object):
                     int_max = max(int_max, val)
 
         for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
-            if int_max <= dtype(-1):
+            if int_max <= np.iinfo(dtype).max:
                 break
         else:
             raise Exception('{} is really big!'.format(int_max))
@@ -121,66 +296,220 @@ class GeoData(object):
         types = []
         for type_, name in zip(field_types, self.fields):
             if type_ == 'str':
-                types.append((name, np.unicode_, str_max + 6))
+                types.append((name, np.str_, str_max + 6))
             elif type_ == 'int':
                 types.append((name, dtype))
             else:
                 types.append((name, np.double))
-        records = np.array(
+        return np.array(
             [tuple(r) for r in self.records], dtype=np.dtype(types))
 
-        np.savez_compressed(
-            os.path.join(self.data_path, 'data.npz'),
-            records=records, polygons=self.polygons, fields=self.fields)
+    def get_lod_arrays(self, dtype=np.float64):
+        """Returns a dict with the :attr:`polygon_lods` flattened into arrays
+        by :meth:`flatten_polygons`, as saved on disk, with the vertices of
+        type ``dtype``.
+        """
+        lods = {}
+        if not self.polygon_lods:
+            return lods
+
+        lods['lod_tolerances'] = np.array(
+            [tolerance for tolerance, _ in self.polygon_lods])
+        for i, (_, polygons) in enumerate(self.polygon_lods):
+            vertices, polygon_offsets, precinct_offsets = \
+                self.flatten_polygons(polygons)
+            lods['lod_{}_vertices'.format(i)] = vertices.astype(dtype)
+            lods['lod_{}_polygon_offsets'.format(i)] = polygon_offsets
+            lods['lod_{}_precinct_offsets'.format(i)] = precinct_offsets
+        return lods
+
+    def get_flat_data_path(self):
+        """Returns the directory, next to ``data.npz``, where
+        :meth:`dump_flat_data` saves the data.
+        """
+        return os.path.join(self.data_path, 'flat_data')
 
-    def generate_polygons(self):
-        """Converts the shapes in the data into a list of closed polygons,
-        described by their vertices.
+    def get_raster_cache_path(self):
+        """Returns the directory, next to ``data.npz``, in which the rasters
+        of the precincts are cached, see
+        :attr:`~distopia.mapping.voronoi.VoronoiMapping.raster_cache_path`.
+        """
+        return os.path.join(self.data_path, 'raster_cache')
+
+    def dump_flat_data(self):
+        """Saves the data in the flat format loaded by
+        :meth:`load_flat_data`: a ``.npy`` file for each of the float32
+        vertex buffer and offset arrays of the :attr:`polygons` (see
+        :meth:`flatten_polygons`) and their :attr:`polygon_lods`, the
+        :attr:`records` as a structured array and the :attr:`fields`.
+
+        The files are first written to a temporary directory that is then
+        renamed into place, so a partially written set is never loaded.
+
+        :return: Whether the data was saved. It's not saved if the directory
+            cannot be written, e.g. if the package data is read-only.
+        """
+        path = self.get_flat_data_path()
+        vertices, polygon_offsets, precinct_offsets = self.flatten_polygons(
+            self.polygons)
+        arrays = {
+            'fields': np.array(self.fields, dtype=np.str_),
+            'records': self.get_record_array(),
+            'vertices': vertices.astype(self.flat_vertex_dtype),
+            'polygon_offsets': polygon_offsets,
+            'precinct_offsets': precinct_offsets,
+        }
+        arrays.update(self.get_lod_arrays(self.flat_vertex_dtype))
+        if 'lod_tolerances' not in arrays:
+            arrays['lod_tolerances'] = np.zeros(0)
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(temp_path)
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, '{}.npy'.format(name)), array,
+                        allow_pickle=False)
+            # replace any previous data, which may be unreadable
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(temp_path, path)
+        except OSError:
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path, ignore_errors=True)
+        return True
+
+    def load_flat_data(self):
+        """Loads the data saved by :meth:`dump_flat_data`.
+
+        The arrays are memory mapped, and the polygons are views into the
+        vertex buffer, so the loading time doesn't depend on the number of
+        vertices.
+
+        :return: Whether the data was loaded. If it was not saved or cannot
+            be read, the data is left unchanged and False is returned.
+        """
+        path = self.get_flat_data_path()
+
+        def load(name):
+            # a plain array view of the memory map is much faster to slice
+            return np.load(os.path.join(path, '{}.npy'.format(name)),
+                           mmap_mode='r', allow_pickle=False).view(np.ndarray)
+
+        def unflatten(prefix):
+            vertices = load(prefix + 'vertices')
+            polygon_offsets = load(prefix + 'polygon_offsets')
+            precinct_offsets = load(prefix + 'precinct_offsets')
+            # catch a buffer that doesn't match its offsets
+            if polygon_offsets[-1] != len(vertices) or \
+                    precinct_offsets[-1] != len(polygon_offsets) - 1:
+                raise ValueError('Inconsistent flat data in {}'.format(path))
+            return self.unflatten_polygons(
+                vertices, polygon_offsets, precinct_offsets)
+
+        try:
+            fields = load('fields').tolist()
+            records = load('records')
+            polygons = unflatten('')
+            polygon_lods = [
+                (tolerance, unflatten('lod_{}_'.format(i)))
+                for i, tolerance in enumerate(
+                    load('lod_tolerances').tolist())]
+        except (OSError, ValueError, IndexError, EOFError):
+            return False
+
+        if len(records) != len(polygons) or any(
+                len(lod) != len(polygons) for _, lod in polygon_lods):
+            return False
+
+        self.fields = fields
+        self.records = records
+        self.polygons = polygons
+        self.polygon_lods = polygon_lods
+        return True
+
+    def get_transformer(self):
+        """Returns the :class:`pyproj.Transformer` from
+        :attr:`source_coordinates` to :attr:`target_coordinates`, or None if
+        either is empty, in which case the points are not reprojected.
+
+        A transformer must not be shared between threads.
         """
         src, target = self.source_coordinates, self.target_coordinates
         if not src or not target:
-            trans = lambda _0, _1, lon, lat: (lon, lat)
-            crs_src = crs_target = None
+            return None
+        return Transformer.from_crs(src, target, always_xy=True)
+
+    def reproject_points(self, points, threads=0, chunk_size=1 << 16):
+        """Reprojects the points from :attr:`source_coordinates` to
+        :attr:`target_coordinates`, with one vectorized call.
+
+        :param points: A nx2 array of the points.
+        :param threads: If more than one, the points are reprojected in
+            chunks of ``chunk_size`` points on that many threads, each with
+            its own transformer.
+        :return: The nx2 array of the reprojected points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+        if not self.source_coordinates or not self.target_coordinates:
+            return points.copy()
+
+        x = np.ascontiguousarray(points[:, 0])
+        y = np.ascontiguousarray(points[:, 1])
+        local = threading.local()
+
+        def reproject(start, end):
+            transformer = getattr(local, 'transformer', None)
+            if transformer is None:
+                transformer = local.transformer = self.get_transformer()
+            x[start:end], y[start:end] = transformer.transform(
+                x[start:end], y[start:end])
+
+        if threads > 1 and len(x) > chunk_size:
+            starts = list(range(0, len(x), chunk_size))
+            ends = starts[1:] + [len(x)]
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(reproject, starts, ends))
         else:
-            trans = transform
-            crs_src = Proj(init='epsg:3071')
-            crs_target = Proj(init='epsg:3857')
+            reproject(0, len(x))
+        return np.stack([x, y], axis=1)
+
+    def generate_polygons(self, threads=0):
+        """Converts the shapes in the data into a list of closed polygons,
+        described by their vertices.
+
+        The points of all the shapes are reprojected together, see
+        :meth:`reproject_points`.
+
+        :param threads: The number of threads used to reproject the points.
+        """
+        shapes = self.shapes
+        counts = [len(shape.points) for shape in shapes]
+        points = np.empty((sum(counts), 2), dtype=np.float64)
+        offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        for shape, start, end in zip(shapes, offsets[:-1], offsets[1:]):
+            if end > start:
+                points[start:end] = shape.points
+
+        points = self.reproject_points(points, threads=threads)
+        if len(points):
+            min_x, min_y = points.min(axis=0).tolist()
+            max_x, max_y = points.max(axis=0).tolist()
+        else:
+            min_x = min_y = float('inf')
+            max_x = max_y = float('-inf')
+        self.containing_rect = min_x, min_y, max_x, max_y
 
         self.polygons = polygons = []
-        min_x = min_y = float('inf')
-        max_x = max_y = float('-inf')
-        for record, shape in zip(self.records, self.shapes):
-            if len(shape.parts) == 1:
-                arr = np.array(
-                    [trans(crs_src, crs_target, lon, lat) for
-                     lon, lat in shape.points])
-
-                max_x = max(max_x, np.max(arr[:, 0]))
-                max_y = max(max_y, np.max(arr[:, 1]))
-                min_x = min(min_x, np.min(arr[:, 0]))
-                min_y = min(min_y, np.min(arr[:, 1]))
-
-                poly_list = [arr, ]
+        for shape, start, end in zip(shapes, offsets[:-1], offsets[1:]):
+            if len(shape.parts) <= 1:
+                polygons.append([points[start:end]])
             else:
-                poly_list = []
-                for i, s in enumerate(shape.parts):
-                    if i < len(shape.parts) - 1:
-                        e = shape.parts[i + 1] - 1
-                    else:
-                        e = len(shape.points)
-
-                    arr = np.array([
-                        trans(crs_src, crs_target, lon, lat) for
-                        lon, lat in shape.points[s:e + 1]])
-
-                    max_x = max(max_x, np.max(arr[:, 0]))
-                    max_y = max(max_y, np.max(arr[:, 1]))
-                    min_x = min(min_x, np.min(arr[:, 0]))
-                    min_y = min(min_y, np.min(arr[:, 1]))
-
-                    poly_list.append(arr)
-            polygons.append(poly_list)
-        self.containing_rect = min_x, min_y, max_x, max_y
+                # each part starts at its offset in the shape's points
+                polygons.append(
+                    np.split(points[start:end], list(shape.parts[1:])))
 
     def smooth_vertices(self, tolerance=2):
         for shape_polygons in self.polygons:
@@ -14,7 +14,8 @@ import json
 import roslibpy
 import logging
 
-from distopia.district.metrics import DistrictHistogramAggregateMetric
+from distopia.district.metrics import DistrictHistogramAggregateMetric, \
+    DistrictScalarAggregateMetric, DistrictScalarMetric
 
 __all__ = ('RosBridge', )
 
@@ -88,6 +89,10 @@ class RosBridge(object):
                 item = {
                     "name": metric.name, "labels": metric.labels,
                     "data": metric.data}
+            elif isinstance(
+                    metric,
+                    (DistrictScalarAggregateMetric, DistrictScalarMetric)):
+                item = {"name": metric.name, "value": metric.value}
             else:
                 assert False, metric
             metrics.append(item)
@@ -95,11 +100,9 @@ class RosBridge(object):
 
     @staticmethod
     def get_state_metrics(state_metrics):
-        metrics = []
-        for metric in state_metrics:
-            metric.compute()
-            metrics.append({"name": "something", "labels": [], "data": []})
-        return metrics
+        # the state metrics were already computed when created
+        return [{"name": metric.name, "value": metric.value}
+                for metric in state_metrics]
 
     def make_computation_packet(
             self, fiducials_locations, fiducial_ids, fiducial_logical_ids,
@@ -107,9 +110,8 @@ class RosBridge(object):
         state_data = self.get_state_metrics(state_metrics)
 
         districts_data = []
+        # the district metrics were already computed when created
         for district in districts:
-            district.compute_metrics()
-
             district_data = {
                 'district_id': district.identity,
                 'precincts': [p.identity for p in district.precincts],
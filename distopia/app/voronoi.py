@@ -36,12 +36,14 @@ from kivy.uix.spinner import Spinner
 
 import distopia
 from distopia.app.geo_data import GeoData
-from distopia.precinct import Precinct
-from distopia.mapping.voronoi import VoronoiMapping
+from distopia.precinct import PrecinctTable
+from distopia.mapping.voronoi import VoronoiMapping, GridScaleController, \
+    ReassignmentCache
 from distopia.app.ros import RosBridge
-from distopia.precinct.metrics import PrecinctHistogram, PrecinctScalar
-from distopia.district.metrics import DistrictHistogramAggregateMetric, \
-    DistrictScalarAggregateMetric
+from distopia.district.metrics import create_district_metrics
+from distopia.district.aggregate import MetricAggregator
+from distopia.district.compactness import DistrictCompactness
+from distopia.metrics import StateMetricSuite
 
 __all__ = ('VoronoiWidget', 'VoronoiApp')
 
@@ -132,12 +134,22 @@ class VoronoiWidget(Widget):
 
     screen_size = (1920, 1080)
 
+    precinct_lod_tolerance = .5
+    """The largest simplification error, in screen pixels, of the
+    :attr:`~distopia.mapping.voronoi.VoronoiMapping.precinct_lods` level
+    from which the precincts are drawn.
+    """
+
     focus_region_width = 0
 
     n_focus_rows = 0
 
     n_focus_cols = 0
 
+    _voronoi_epoch = 0
+    """The epoch of the voronoi results currently displayed.
+    """
+
     gui_touch_spinner = None
 
     def __init__(
@@ -217,13 +229,16 @@ class VoronoiWidget(Widget):
 
     def show_precincts(self):
         precinct_graphics = self.precinct_graphics = {}
+        vor = self.voronoi_mapping
+        boundaries = vor.get_precinct_boundaries(self.precinct_lod_tolerance)
         with self.canvas:
             PushMatrix()
             Translate(self.focus_region_width, 0)
-            for precinct in self.voronoi_mapping.precincts:
-                assert len(precinct.boundary) >= 6
+            for precinct, boundary in zip(vor.precincts, boundaries):
+                boundary = np.asarray(boundary).tolist()
+                assert len(boundary) >= 6
                 tess = Tesselator()
-                tess.add_contour(precinct.boundary)
+                tess.add_contour(boundary)
                 tess.tesselate(WINDING_ODD, TYPE_POLYGONS)
 
                 graphics = [
@@ -237,7 +252,7 @@ class VoronoiWidget(Widget):
                 graphics.append(
                     Color(rgba=(0, 1, 0, 1)))
                 graphics.append(
-                    Line(points=precinct.boundary, width=1))
+                    Line(points=boundary, width=1))
                 precinct_graphics[precinct] = graphics
             PopMatrix()
 
@@ -562,9 +577,14 @@ class VoronoiWidget(Widget):
     def process_voronoi_output(
             self, districts, fiducial_identity, fiducial_pos, error=[],
             post_callback=None, largs=(),
-            data_is_old=False):
-        if data_is_old:
-            return
+            data_is_old=False, epoch=None):
+        # results that were superseded by newer requests are still displayed
+        # so the districts follow the blocks, but never older than what's
+        # already displayed
+        if epoch is not None:
+            if epoch < self._voronoi_epoch:
+                return
+            self._voronoi_epoch = epoch
 
         if post_callback is not None:
             post_callback(*largs)
@@ -602,9 +622,9 @@ class VoronoiWidget(Widget):
             with self.canvas:
                 self.district_graphics.append(Color(1, 1, 0, 1))
                 for district in districts:
-                    self.district_graphics.append(
-                        Line(points=district.boundary + district.boundary[:2],
-                             width=2))
+                    for boundary in district.boundaries:
+                        self.district_graphics.append(
+                            Line(points=boundary + boundary[:2], width=2))
             PopMatrix()
 
 
@@ -622,6 +642,11 @@ class VoronoiApp(App):
 
     precincts = []
 
+    precinct_table = None
+    """The :class:`~distopia.precinct.PrecinctTable` holding the data of the
+    :attr:`precincts`.
+    """
+
     screen_size = (1900, 800)
 
     table_mode = False
@@ -656,12 +681,58 @@ class VoronoiApp(App):
 
     focus_metric_height = 100
 
-    def create_district_metrics(self, districts):
-        for district in districts:
-            for name in self.metrics:
-                district.metrics[name] = \
-                    DistrictHistogramAggregateMetric(
-                        district=district, name=name)
+    compute_scale = 1.
+
+    progressive = False
+
+    target_latency = 0
+
+    cache_entries = 0
+
+    cache_memory = 256
+
+    cache_grid = 4.
+
+    adjacency_mode = 'rook'
+
+    metric_aggregations = {'income': 'median', 'projected_votes': 'mean'}
+    """A mapping from metric name to how the precinct metric is aggregated
+    into the district metric, see
+    :class:`~distopia.district.aggregate.MetricAggregator`.
+    """
+
+    metric_aggregator = None
+    """The :class:`~distopia.district.aggregate.MetricAggregator` that
+    computes the district metrics.
+    """
+
+    state_metric_suite = None
+    """The :class:`~distopia.metrics.StateMetricSuite` that computes the state
+    metrics.
+    """
+
+    compactness_metrics = ['polsby_popper', 'reock', 'convex_hull']
+    """The names of the district compactness metrics, see
+    :class:`~distopia.district.compactness.DistrictCompactness`. If empty,
+    the compactness is not computed.
+    """
+
+    district_compactness = None
+    """The :class:`~distopia.district.compactness.DistrictCompactness` that
+    computes the :attr:`compactness_metrics`.
+    """
+
+    def create_district_metrics(
+            self, districts, pixel_district_map=None,
+            pixel_district_scale=None):
+        """Creates and computes the metrics of the districts, with the
+        :attr:`metric_aggregator` and the :attr:`district_compactness`, see
+        :func:`~distopia.district.metrics.create_district_metrics`.
+        """
+        create_district_metrics(
+            districts, self.metrics, self.metric_aggregator,
+            self.district_compactness, self.voronoi_mapping,
+            pixel_district_map, pixel_district_scale)
 
     def load_precinct_metrics(self):
         assert self.use_county_dataset
@@ -671,10 +742,14 @@ class VoronoiApp(App):
         names = {v: v for v in names}
         names['Saint Croix'] = 'St. Croix'
 
+        # the population is also needed to weight the aggregated metrics
+        metric_names = list(self.metrics)
+        if 'population' not in metric_names:
+            metric_names.append('population')
+
         root = os.path.join(
             os.path.dirname(distopia.__file__), 'data', 'aggregate')
-        for name in self.metrics:
-
+        for name in metric_names:
             fname = os.path.join(root, '{}.csv'.format(name))
             with open(fname) as fh:
                 reader = csv.reader(fh, delimiter='\t')
@@ -684,25 +759,51 @@ class VoronoiApp(App):
                 for row in reader:
                     data[row[0]] = list(map(float, row[1:]))
 
-            for precinct, record in zip(self.precincts, geo_data.records):
-                precinct_name = names[record[3]]
-                precinct.metrics[name] = PrecinctHistogram(
-                    name=name, labels=header, data=data[precinct_name])
+            data = [data[names[record[3]]] for record in geo_data.records]
+            if name == 'income':
+                # skip the county median income, the district median is
+                # estimated from the income brackets
+                header = header[1:]
+                data = [item[1:] for item in data]
+            self.precinct_table.set_metric(name, data, labels=header)
+
+        self.metric_aggregator = MetricAggregator(
+            self.precinct_table, self.metrics,
+            aggregations=self.metric_aggregations, weights='population')
+        self.state_metric_suite = StateMetricSuite()
 
     def load_precinct_adjacency(self):
-        assert self.use_county_dataset
-        fname = os.path.join(
-            os.path.dirname(distopia.__file__), 'data', 'county_adjacency.json')
+        """Loads the precincts' neighbours. The hand-made county adjacency is
+        used for the county dataset, otherwise it's computed from the
+        precinct geometry as set by :attr:`adjacency_mode`, and cached.
+        """
+        table = self.precinct_table
+        if self.use_county_dataset:
+            fname = os.path.join(
+                os.path.dirname(distopia.__file__), 'data',
+                'county_adjacency.json')
 
-        with open(fname, 'r') as fh:
-            counties = json.load(fh)
+            with open(fname, 'r') as fh:
+                counties = json.load(fh)
 
-        precincts = self.precincts
-        for i, neighbours in counties.items():
-            precincts[int(i)].neighbours = [precincts[p] for p in neighbours]
+            table.set_neighbours(
+                [counties.get(str(i), []) for i in range(len(table))])
+            adjacency = table.get_adjacency()
+        else:
+            adjacency = self.geo_data.load_adjacency(
+                mode=self.adjacency_mode,
+                pixel_precinct_map=self.voronoi_mapping.pixel_precinct_map)
+            table.set_adjacency(adjacency)
+
+        self.voronoi_mapping.precinct_adjacency = adjacency
 
     def create_state_metrics(self, districts):
-        return []
+        """Creates the state metrics of the districts, computed together by
+        the :attr:`state_metric_suite` from the district metrics.
+        """
+        if self.state_metric_suite is None:
+            return []
+        return self.state_metric_suite.create_state_metrics(districts)
 
     def create_voronoi(self):
         """Loads and initializes all the data and voronoi mapping.
@@ -715,27 +816,46 @@ class VoronoiApp(App):
             geo_data.source_coordinates = ''
 
         geo_data.screen_size = self.screen_size
-        try:
-            geo_data.load_npz_data()
-        except FileNotFoundError:
-            geo_data.load_data()
-            geo_data.generate_polygons()
-            geo_data.scale_to_screen()
-            geo_data.smooth_vertices()
+        if not geo_data.load_flat_data():
+            try:
+                geo_data.load_npz_data()
+            except FileNotFoundError:
+                geo_data.load_data()
+                geo_data.generate_polygons()
+                geo_data.scale_to_screen()
+                geo_data.smooth_vertices()
+            if not geo_data.polygon_lods:
+                geo_data.simplify_polygons()
+            # the flat data is memory mapped, so it loads much faster. It's
+            # reloaded so the data is the same as on the next startups
+            if geo_data.dump_flat_data():
+                geo_data.load_flat_data()
 
         self.voronoi_mapping = vor = VoronoiMapping()
         vor.start_processing_thread()
         vor.screen_size = self.screen_size
-        self.precincts = precincts = []
-
-        for i, (record, polygons) in enumerate(
-                zip(geo_data.records, geo_data.polygons)):
-            precinct = Precinct(
-                name=str(record[0]), boundary=polygons[0].reshape(-1).tolist(),
-                identity=i, location=polygons[0].mean(axis=0).tolist())
-            precincts.append(precinct)
-
-        vor.set_precincts(precincts)
+        vor.raster_cache_path = geo_data.get_raster_cache_path()
+        vor.compute_scale = self.compute_scale
+        vor.progressive = self.progressive
+        if self.target_latency:
+            vor.grid_controller = GridScaleController(
+                target_latency=self.target_latency,
+                scales=[self.compute_scale * scale for scale in
+                        GridScaleController.scales])
+        if self.cache_entries:
+            vor.reassignment_cache = ReassignmentCache(
+                max_entries=self.cache_entries,
+                max_memory=self.cache_memory * 1024 * 1024,
+                grid=self.cache_grid)
+        self.precinct_table = table = PrecinctTable.from_polygons(
+            geo_data.polygons, names=[str(r[0]) for r in geo_data.records])
+        self.precincts = precincts = table.precincts
+
+        vor.set_precincts(precincts, geo_data.get_lod_boundaries())
+
+        if self.compactness_metrics:
+            self.district_compactness = DistrictCompactness(
+                self.compactness_metrics)
 
     def show_precinct_labels(self, widget):
         offset = widget.focus_region_width
@@ -753,7 +873,11 @@ class VoronoiApp(App):
                 'show_precinct_id', 'focus_block_fid',
                 'focus_block_logical_id', 'district_blocks_fid', 'use_ros',
                 'metrics', 'ros_host', 'ros_port', 'show_voronoi_boundaries',
-                'focus_metrics', 'focus_metric_width', 'focus_metric_height']
+                'focus_metrics', 'focus_metric_width', 'focus_metric_height',
+                'compute_scale', 'progressive', 'target_latency',
+                'cache_entries', 'cache_memory', 'cache_grid',
+                'adjacency_mode', 'metric_aggregations',
+                'compactness_metrics']
 
         fname = os.path.join(
             os.path.dirname(distopia.__file__), 'data', 'config.json')
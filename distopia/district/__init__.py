@@ -25,6 +25,12 @@ class District(object):
     describes the district's boundary.
     """
 
+    boundaries = []
+    """A list of the boundaries of all the district's rings, each like
+    :attr:`boundary`, including its holes and detached pieces.
+    :attr:`boundary` is the largest of them.
+    """
+
     neighbours = []
     """List of other :class:`District`'s that are on the boundary of this
     district.
@@ -0,0 +1,376 @@
+"""
+District Metric Aggregation
+============================
+
+Computes the metrics of all the districts at once from the precinct metrics
+stored in a :class:`~distopia.precinct.PrecinctTable`.
+
+All the configured metrics are packed into one precincts by features matrix,
+which is multiplied by the sparse one-hot districts by precincts assignment
+matrix, so a single product gives the sums needed by every metric of every
+district.
+"""
+import re
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from distopia.district.metrics import DistrictHistogramAggregateMetric, \
+    DistrictScalarAggregateMetric
+
+__all__ = ('MetricAggregator', 'get_histogram_bin_edges',
+           'get_histogram_median')
+
+_number_pat = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+
+def get_histogram_bin_edges(labels):
+    """Parses the lower and upper edge of each histogram bin from its label,
+    e.g. ``'<10,000'``, ``'10,000-14,999'``, ``'population_90+'`` or
+    ``'>200,000'``.
+
+    Bins are assumed to be contiguous, so each bin ends where the next one
+    starts. The last bin ends at the second number of its label (plus one,
+    for integer ranges), or at its start if it's open ended.
+
+    :return: A tuple of the lower and upper edges arrays.
+    """
+    lower = []
+    last_upper = None
+    for label in labels:
+        numbers = [float(n.replace(',', ''))
+                   for n in _number_pat.findall(label)]
+        if not numbers:
+            raise ValueError(
+                'Cannot parse histogram bin "{}", the bin edges must be '
+                'given'.format(label))
+
+        stripped = label.strip().strip('"')
+        if stripped.startswith('<'):
+            lower.append(0.)
+            last_upper = numbers[0]
+        elif len(numbers) >= 2:
+            lower.append(numbers[0])
+            last_upper = numbers[1] + 1
+        else:
+            lower.append(numbers[0])
+            last_upper = numbers[0]
+
+    lower = np.array(lower, dtype=np.float64)
+    upper = np.append(lower[1:], last_upper)
+    return lower, upper
+
+
+def get_histogram_median(histograms, lower, upper):
+    """Estimates the median of each histogram by linearly interpolating
+    within the bin that contains the middle count.
+
+    :param histograms: A ...xL array of histograms.
+    :param lower: The L array of the lower edge of each bin.
+    :param upper: The L array of the upper edge of each bin.
+    :return: The ... array of the medians, zero for empty histograms.
+    """
+    histograms = np.asarray(histograms, dtype=np.float64)
+    cumulative = np.cumsum(histograms, axis=-1)
+    total = cumulative[..., -1]
+    half = total / 2.
+
+    k = np.argmax(cumulative >= half[..., np.newaxis], axis=-1)[
+        ..., np.newaxis]
+    count = np.take_along_axis(histograms, k, axis=-1)[..., 0]
+    before = np.take_along_axis(cumulative, k, axis=-1)[..., 0] - count
+    k = k[..., 0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(count > 0, (half - before) / count, 0)
+    median = lower[k] + fraction * (upper[k] - lower[k])
+    median[total <= 0] = 0
+    return median
+
+
+class MetricAggregator(object):
+    """Aggregates the precinct metrics of a
+    :class:`~distopia.precinct.PrecinctTable` into district metrics.
+
+    Each metric is aggregated with one of:
+
+    ``'sum'``
+        The sum of the precincts' values (or histograms).
+    ``'mean'``
+        The mean of the precincts' values (or histograms), weighted by the
+        precincts' :attr:`weights`.
+    ``'median'``
+        The median of a histogram metric, estimated from the district's
+        histogram. Each precinct's histogram is normalized and scaled by its
+        weight before summing, so histograms of counts and of percentages
+        both work. The result is a scalar.
+    """
+
+    table = None
+    """The :class:`~distopia.precinct.PrecinctTable` with the precinct
+    metrics.
+    """
+
+    metrics = []
+    """The names of the metrics that are aggregated.
+    """
+
+    aggregations = {}
+    """A mapping from metric name to how it's aggregated. Metrics not listed
+    are summed.
+    """
+
+    weights = None
+    """The array of the weight of each precinct used by the ``'mean'`` and
+    ``'median'`` aggregations.
+    """
+
+    bin_edges = {}
+    """A mapping from the name of the ``'median'`` metrics to the tuple of
+    the lower and upper edges of their bins.
+    """
+
+    labels = {}
+    """A mapping from metric name to the labels of the aggregated histogram,
+    or None if the aggregated metric is a scalar.
+    """
+
+    features = None
+    """The precincts by features matrix of all the metrics, with a last column
+    holding the :attr:`weights`.
+    """
+
+    max_delta_fraction = .25
+    """The largest fraction of the precincts that may change district for
+    :meth:`aggregate` to update the previous sums rather than recompute them.
+    """
+
+    max_updates = 256
+    """The number of consecutive incremental updates after which the sums are
+    recomputed, so floating point errors don't accumulate.
+    """
+
+    _columns = {}
+
+    _previous = None
+
+    _n_updates = 0
+
+    def __init__(self, table, metrics, aggregations=None, weights=None,
+                 bin_edges=None, **kwargs):
+        """
+        :param weights: The weight of each precinct, or the name of a table
+            metric whose (first) column is used, e.g. ``'population'``.
+            Defaults to weighting all precincts equally.
+        :param bin_edges: A mapping from metric name to the lower and upper
+            edges of its histogram bins, for ``'median'`` metrics whose edges
+            can't be parsed from their labels.
+        """
+        super(MetricAggregator, self).__init__(**kwargs)
+        self.table = table
+        self.metrics = list(metrics)
+        self.aggregations = dict(aggregations or {})
+        self.bin_edges = bin_edges = dict(bin_edges or {})
+        self.labels = {}
+        self._columns = {}
+
+        n = len(table)
+        if weights is None:
+            weights = np.ones(n)
+        elif isinstance(weights, str):
+            weights = table.metric_data[weights].reshape((n, -1))[:, 0]
+        self.weights = weights = np.asarray(weights, dtype=np.float64)
+
+        columns = []
+        start = 0
+        for name in self.metrics:
+            data = table.metric_data[name]
+            is_histogram = data.ndim == 2
+            data = data.reshape((n, -1))
+            aggregation = self.aggregations.get(name, 'sum')
+
+            if aggregation == 'sum':
+                features = data
+            elif aggregation == 'mean':
+                features = data * weights[:, np.newaxis]
+            elif aggregation == 'median':
+                if not is_histogram:
+                    raise ValueError(
+                        'Only histogram metrics, not "{}", can be aggregated '
+                        'with the median'.format(name))
+                if name not in bin_edges:
+                    bin_edges[name] = get_histogram_bin_edges(
+                        table.metric_labels[name])
+                totals = data.sum(axis=1)
+                scale = np.zeros(n)
+                np.divide(weights, totals, out=scale, where=totals > 0)
+                features = data * scale[:, np.newaxis]
+            else:
+                raise ValueError(
+                    'Unknown aggregation "{}" of "{}"'.format(
+                        aggregation, name))
+
+            columns.append(features)
+            self._columns[name] = start, start + features.shape[1]
+            start += features.shape[1]
+            if is_histogram and aggregation != 'median':
+                self.labels[name] = list(table.metric_labels[name])
+            else:
+                self.labels[name] = None
+
+        columns.append(weights[:, np.newaxis])
+        self.features = np.concatenate(columns, axis=1)
+        self.reset()
+
+    def aggregate(self, precinct_districts, n_districts, district_ids=None):
+        """Aggregates the metrics of the districts.
+
+        When ``district_ids`` is given and matches the ids of the previous
+        call, only the precincts that changed district since then are
+        applied to the previous sums, by subtracting their rows from their
+        old district and adding them to the new one. Otherwise, or when too
+        many precincts changed (see :attr:`max_delta_fraction`), the sums
+        are fully recomputed.
+
+        :param precinct_districts: The array of the district index of each
+            precinct, or -1 if it's under no district.
+        :param n_districts: The number of districts.
+        :param district_ids: The (unique) identity of each district, used to
+            tell if the districts are the same as in the previous call.
+        :return: A mapping from metric name to the districts by labels array
+            of its histograms, or the districts array of its values.
+        """
+        precinct_districts = np.array(precinct_districts, dtype=np.int64)
+        previous = self._previous
+        if district_ids is not None:
+            district_ids = tuple(district_ids)
+            assert len(district_ids) == n_districts
+
+        sums = None
+        if district_ids is not None and previous is not None and \
+                previous[0] == district_ids and \
+                self._n_updates < self.max_updates:
+            changed = np.flatnonzero(precinct_districts != previous[1])
+            if len(changed) <= self.max_delta_fraction * len(
+                    precinct_districts):
+                # the returned values may be views of the previous sums
+                sums = previous[2].copy()
+                self._apply_delta(
+                    sums, changed, previous[1][changed],
+                    precinct_districts[changed])
+                self._n_updates += 1
+
+        if sums is None:
+            sums = self.compute_sums(
+                precinct_districts[np.newaxis, :], n_districts)[0]
+            self._n_updates = 0
+
+        if district_ids is None:
+            self._previous = None
+        else:
+            self._previous = district_ids, precinct_districts, sums
+
+        values = self.get_values(sums[np.newaxis, :, :])
+        return {name: value[0] for name, value in values.items()}
+
+    def _apply_delta(self, sums, changed, old, new):
+        features = self.features
+        leaving = old >= 0
+        np.subtract.at(sums, old[leaving], features[changed[leaving]])
+        arriving = new >= 0
+        np.add.at(sums, new[arriving], features[changed[arriving]])
+
+    def reset(self):
+        """Forgets the previous sums, so the next :meth:`aggregate`
+        recomputes them from scratch.
+        """
+        self._previous = None
+        self._n_updates = 0
+
+    def compute_sums(self, precinct_districts, n_districts):
+        """Computes the sums of the :attr:`features` of the districts of many
+        assignments, with a single sparse product.
+
+        :param precinct_districts: A configurations by precincts array of the
+            district index of each precinct, or -1.
+        :return: The configurations by districts by features array of sums.
+        """
+        precinct_districts = np.asarray(precinct_districts, dtype=np.int64)
+        n_configs, n_precincts = precinct_districts.shape
+        assigned = precinct_districts >= 0
+        rows = (np.arange(n_configs, dtype=np.int64)[:, np.newaxis] *
+                n_districts + precinct_districts)[assigned]
+        cols = np.broadcast_to(
+            np.arange(n_precincts, dtype=np.int64), assigned.shape)[assigned]
+        one_hot = csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(n_configs * n_districts, n_precincts))
+
+        return np.asarray(one_hot.dot(self.features)).reshape(
+            (n_configs, n_districts, -1))
+
+    def get_values(self, sums):
+        """Computes the aggregated metrics from the sums of the features, as
+        returned by :meth:`compute_sums`.
+
+        :return: A mapping from metric name to the configurations by
+            districts (by labels, for histograms) array of the aggregated
+            metric.
+        """
+        weight = sums[:, :, -1:]
+
+        values = {}
+        for name in self.metrics:
+            s, e = self._columns[name]
+            value = sums[:, :, s:e]
+            aggregation = self.aggregations.get(name, 'sum')
+            if aggregation == 'mean':
+                value = np.divide(
+                    value, weight, out=np.zeros_like(value), where=weight > 0)
+            elif aggregation == 'median':
+                value = get_histogram_median(value, *self.bin_edges[name])
+
+            if aggregation != 'median' and self.labels[name] is None:
+                value = value[:, :, 0]
+            values[name] = value
+        return values
+
+    def aggregate_batch(self, precinct_districts, n_districts):
+        """Like :meth:`aggregate`, but for many assignments at once, with a
+        single sparse product. It's never incremental.
+
+        :param precinct_districts: A configurations by precincts array of the
+            district index of each precinct, or -1.
+        :return: A mapping from metric name to the configurations by
+            districts (by labels, for histograms) array of the aggregated
+            metric.
+        """
+        return self.get_values(
+            self.compute_sums(precinct_districts, n_districts))
+
+    def create_district_metrics(self, districts):
+        """Creates the :attr:`~distopia.district.District.metrics` of the
+        districts, already computed, from the districts the table's precincts
+        are currently assigned to.
+
+        Consecutive calls with districts of the same identities, e.g. while a
+        block is dragged, only update the sums with the precincts that
+        changed district.
+        """
+        precinct_districts = self.table.get_district_assignment(districts)
+        values = self.aggregate(
+            precinct_districts, len(districts),
+            district_ids=[district.identity for district in districts])
+
+        for i, district in enumerate(districts):
+            for name in self.metrics:
+                labels = self.labels[name]
+                if labels is None:
+                    metric = DistrictScalarAggregateMetric(
+                        district=district, name=name)
+                    metric.value = float(values[name][i])
+                else:
+                    metric = DistrictHistogramAggregateMetric(
+                        district=district, name=name)
+                    metric.labels = labels
+                    metric.data = values[name][i].tolist()
+                district.metrics[name] = metric
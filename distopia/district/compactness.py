@@ -0,0 +1,236 @@
+"""
+District Compactness
+====================
+
+Computes the compactness of all the districts at once from the rasterized
+districts, i.e. the ``pixel_district_map`` of
+:class:`~distopia.mapping.voronoi.VoronoiMapping`.
+
+A couple of passes over the pixels accumulate the area, perimeter, moments
+and the extreme points of each district (see
+:func:`~distopia.mapping._voronoi.accumulate_district_shapes`), so the cost
+depends on the number of pixels, not on the number of precincts or on the
+complexity of their boundaries.
+"""
+import math
+import numpy as np
+from scipy.spatial import ConvexHull
+
+from distopia.mapping._voronoi import accumulate_district_shapes
+from distopia.district.metrics import DistrictScalarMetric
+
+__all__ = ('DistrictCompactness', 'get_min_enclosing_circle')
+
+
+def _circle_from_two(a, b):
+    x, y = (a[0] + b[0]) / 2., (a[1] + b[1]) / 2.
+    return x, y, math.hypot(a[0] - x, a[1] - y)
+
+
+def _circle_from_three(a, b, c):
+    bx, by = b[0] - a[0], b[1] - a[1]
+    cx, cy = c[0] - a[0], c[1] - a[1]
+    d = 2. * (bx * cy - by * cx)
+    if not d:
+        # collinear, the circle is through the two farthest points
+        circles = [_circle_from_two(a, b), _circle_from_two(a, c),
+                   _circle_from_two(b, c)]
+        return max(circles, key=lambda circle: circle[2])
+
+    b2, c2 = bx * bx + by * by, cx * cx + cy * cy
+    x = (cy * b2 - by * c2) / d
+    y = (bx * c2 - cx * b2) / d
+    return x + a[0], y + a[1], math.hypot(x, y)
+
+
+def get_min_enclosing_circle(points):
+    """Returns the smallest circle that contains all the points, using
+    Welzl's randomized incremental algorithm.
+
+    The points are shuffled with a fixed seed so the result is
+    deterministic. Passing only the convex hull's vertices gives the same
+    circle, much faster.
+
+    :param points: A nx2 array of points.
+    :return: A tuple of the ``(x, y, radius)`` of the circle.
+    """
+    points = np.array(points, dtype=np.float64)
+    if not len(points):
+        return 0., 0., 0.
+    np.random.RandomState(0).shuffle(points)
+    points = points.tolist()
+    eps = 1e-7
+
+    def contains(circle, p):
+        return math.hypot(p[0] - circle[0], p[1] - circle[1]) <= \
+            circle[2] * (1 + eps) + eps
+
+    circle = points[0][0], points[0][1], 0.
+    for i, p in enumerate(points):
+        if contains(circle, p):
+            continue
+        circle = p[0], p[1], 0.
+        for j in range(i):
+            q = points[j]
+            if contains(circle, q):
+                continue
+            circle = _circle_from_two(p, q)
+            for k in range(j):
+                r = points[k]
+                if not contains(circle, r):
+                    circle = _circle_from_three(p, q, r)
+    return circle
+
+
+class DistrictCompactness(object):
+    """Computes the compactness metrics of the districts from the
+    ``pixel_district_map``, masked by the ``pixel_precinct_map`` so that only
+    the pixels within the state count.
+
+    The supported metrics are, all between zero and one, with one the most
+    compact:
+
+    ``'polsby_popper'``
+        The ratio of the district's area to the area of the circle with the
+        same perimeter, ``4 pi A / P ** 2``. The perimeter is estimated from
+        the boundary crossings in 8 directions (see
+        :func:`~distopia.mapping._voronoi.accumulate_district_shapes`), so
+        it doesn't depend on the district's orientation. E.g. a square is
+        about ``pi / 4`` in any orientation. Being an estimate, it's within a
+        few percent and a disk may be slightly above one.
+    ``'reock'``
+        The ratio of the district's area to the area of its minimum enclosing
+        circle.
+    ``'convex_hull'``
+        The ratio of the district's area to the area of its convex hull.
+    ``'moment_of_inertia'``
+        The ratio of the polar moment of inertia of the disk with the
+        district's area to the district's moment of inertia about its
+        centroid.
+
+    The ratios don't depend on the scale of the grid the districts were
+    rasterized on, other than through the resolution.
+    """
+
+    metrics = ['polsby_popper', 'reock', 'convex_hull']
+    """The names of the computed metrics.
+    """
+
+    _supported_metrics = (
+        'polsby_popper', 'reock', 'convex_hull', 'moment_of_inertia')
+
+    def __init__(self, metrics=None, **kwargs):
+        super(DistrictCompactness, self).__init__(**kwargs)
+        if metrics is not None:
+            self.metrics = list(metrics)
+        for name in self.metrics:
+            if name not in self._supported_metrics:
+                raise ValueError(
+                    'Unknown compactness metric "{}"'.format(name))
+
+    @staticmethod
+    def accumulate_shapes(
+            pixel_district_map, pixel_precinct_map, n_districts, n_precincts):
+        """Accumulates the shape statistics of the districts, see
+        :func:`~distopia.mapping._voronoi.accumulate_district_shapes`.
+
+        :return: A tuple of the districts by 7 stats matrix and the districts
+            by map width by 2 matrix of each column's extreme y.
+        """
+        stats = np.zeros((n_districts, 7), dtype=np.float64)
+        extremes = np.empty(
+            (n_districts, pixel_district_map.shape[0], 2), dtype=np.int32)
+        extremes[:, :, 0] = pixel_district_map.shape[1]
+        extremes[:, :, 1] = -1
+        accumulate_district_shapes(
+            pixel_precinct_map, pixel_district_map, n_precincts, stats,
+            extremes)
+        return stats, extremes
+
+    @staticmethod
+    def get_hull_points(extremes):
+        """Returns the corners of the extreme pixels of each column of a
+        district, from its width by 2 ``extremes`` matrix. Their convex hull
+        is the convex hull of all the district's pixels.
+        """
+        x = np.flatnonzero(extremes[:, 1] >= 0)
+        y1 = extremes[x, 0]
+        y2 = extremes[x, 1] + 1
+        xs = np.concatenate([x, x + 1, x, x + 1])
+        ys = np.concatenate([y1, y1, y2, y2])
+        return np.stack([xs, ys], axis=1)
+
+    def compute(
+            self, pixel_district_map, pixel_precinct_map, n_districts,
+            n_precincts):
+        """Computes the compactness of the districts.
+
+        :param pixel_district_map: The map of the district index of each
+            pixel.
+        :param pixel_precinct_map: The same sized map of the precinct index
+            of each pixel.
+        :param n_districts: The number of districts.
+        :param n_precincts: The number of precincts. Pixels whose precinct
+            index is not less are outside the state.
+        :return: A mapping from metric name to the array of the value of each
+            district, zero for districts without pixels.
+        """
+        stats, extremes = self.accumulate_shapes(
+            pixel_district_map, pixel_precinct_map, n_districts, n_precincts)
+        area = stats[:, 0]
+        has_area = area > 0
+        values = {}
+
+        if 'polsby_popper' in self.metrics:
+            value = np.zeros(n_districts)
+            np.divide(4 * math.pi * area, stats[:, 1] ** 2, out=value,
+                      where=has_area)
+            values['polsby_popper'] = value
+
+        if 'moment_of_inertia' in self.metrics:
+            safe_area = np.where(has_area, area, 1.)
+            # each pixel adds the moment of the unit square about its center
+            inertia = stats[:, 4] - stats[:, 2] ** 2 / safe_area + \
+                stats[:, 5] - stats[:, 3] ** 2 / safe_area + area / 6.
+            value = np.zeros(n_districts)
+            np.divide(area ** 2 / (2 * math.pi), inertia, out=value,
+                      where=has_area)
+            values['moment_of_inertia'] = np.minimum(value, 1.)
+
+        hull_metrics = [name for name in ('reock', 'convex_hull')
+                        if name in self.metrics]
+        if hull_metrics:
+            for name in hull_metrics:
+                values[name] = np.zeros(n_districts)
+            for i in np.flatnonzero(has_area):
+                # the points are pixel corners, so they are never collinear
+                points = self.get_hull_points(extremes[i])
+                hull = ConvexHull(points)
+                if 'reock' in self.metrics:
+                    radius = get_min_enclosing_circle(
+                        points[hull.vertices])[2]
+                    values['reock'][i] = min(
+                        area[i] / (math.pi * radius ** 2), 1.)
+                if 'convex_hull' in self.metrics:
+                    # in 2d the volume is the area
+                    values['convex_hull'][i] = min(area[i] / hull.volume, 1.)
+        return values
+
+    def create_district_metrics(
+            self, districts, pixel_district_map, pixel_precinct_map,
+            n_precincts):
+        """Computes the compactness of the districts and adds them to the
+        :attr:`~distopia.district.District.metrics` of the districts, as
+        :class:`~distopia.district.metrics.DistrictScalarMetric`.
+
+        The district index in ``pixel_district_map`` is the index of the
+        district in ``districts``.
+        """
+        values = self.compute(
+            pixel_district_map, pixel_precinct_map, len(districts),
+            n_precincts)
+        for i, district in enumerate(districts):
+            for name in self.metrics:
+                metric = DistrictScalarMetric(district=district, name=name)
+                metric.value = float(values[name][i])
+                district.metrics[name] = metric
@@ -8,7 +8,9 @@ and other metadata.
 import numpy as np
 
 __all__ = ('DistrictMetric', 'DistrictAggregateMetric',
-           'DistrictHistogramAggregateMetric')
+           'DistrictHistogramAggregateMetric',
+           'DistrictScalarAggregateMetric', 'DistrictScalarMetric',
+           'create_district_metrics', 'create_compactness_metrics')
 
 
 class DistrictMetric(object):
@@ -69,3 +71,76 @@ class DistrictScalarAggregateMetric(DistrictAggregateMetric):
         precinct_metrics = [
             p.metrics[name].value for p in self.district.precincts]
         self.value = np.sum(precinct_metrics)
+
+
+class DistrictScalarMetric(DistrictAggregateMetric):
+    """A district metric with a single value that is not aggregated from the
+    precincts, but computed for all the districts at once, e.g. by
+    :class:`~distopia.district.compactness.DistrictCompactness`.
+    """
+
+    value = 0
+
+    def compute(self):
+        # the value is computed when the metric is created
+        pass
+
+
+def create_district_metrics(
+        districts, metrics, metric_aggregator=None, district_compactness=None,
+        voronoi_mapping=None, pixel_district_map=None,
+        pixel_district_scale=None):
+    """Creates and computes the metrics of the districts, for all the
+    districts at once with the ``metric_aggregator`` once the precinct
+    metrics are loaded, and their compactness, see
+    :func:`create_compactness_metrics`.
+
+    :param metrics: The names of the histogram metrics created for each
+        district when there's no ``metric_aggregator``.
+    :param metric_aggregator: The optional
+        :class:`~distopia.district.aggregate.MetricAggregator`.
+    """
+    if metric_aggregator is not None:
+        metric_aggregator.create_district_metrics(districts)
+    else:
+        for district in districts:
+            for name in metrics:
+                district.metrics[name] = DistrictHistogramAggregateMetric(
+                    district=district, name=name)
+            district.compute_metrics()
+
+    create_compactness_metrics(
+        districts, district_compactness, voronoi_mapping, pixel_district_map,
+        pixel_district_scale)
+
+
+def create_compactness_metrics(
+        districts, district_compactness, voronoi_mapping,
+        pixel_district_map=None, pixel_district_scale=None):
+    """Adds the compactness metrics of the districts, computed by the
+    :class:`~distopia.district.compactness.DistrictCompactness`
+    ``district_compactness`` from the district pixels. Nothing is added if
+    it's None.
+
+    :param voronoi_mapping: The
+        :class:`~distopia.mapping.voronoi.VoronoiMapping` of the districts.
+    :param pixel_district_map: The district pixels of the districts.
+        Defaults to the voronoi mapping's last
+        :attr:`~distopia.mapping.voronoi.VoronoiMapping.pixel_district_map`.
+    :param pixel_district_scale: The scale of the grid of
+        ``pixel_district_map``.
+    """
+    if district_compactness is None or not districts:
+        return
+
+    vor = voronoi_mapping
+    if pixel_district_map is None:
+        pixel_district_map = vor.pixel_district_map
+        pixel_district_scale = vor.pixel_district_scale
+    if pixel_district_map is None:
+        return
+
+    raster = vor.get_precinct_raster(pixel_district_scale)
+    district_compactness.create_district_metrics(
+        districts, pixel_district_map, raster.pixel_precinct_map,
+        len(vor.precincts))
@@ -14,18 +14,37 @@ containing collider.pyx and::
     python setup.py build_ext --inplace
 '''
 
-__all__ = ('PolygonCollider', 'fill_voronoi_diagram')
+__all__ = ('PolygonCollider', 'fill_voronoi_diagram', 'fill_voronoi_scanline',
+           'count_precinct_districts', 'accumulate_district_shapes')
 
 
 cimport cython
 cimport numpy as np
-from libc.stdlib cimport malloc, free
-cdef extern from "math.h":
+import numpy as np
+from cython.parallel cimport prange
+from libc.stdlib cimport malloc, free, qsort
+from libc.string cimport memset
+from libc.math cimport atan2, M_PI
+cdef extern from "math.h" nogil:
     double round(double val)
     double floor(double val)
     double ceil(double val)
     double pow(double x, double y)
     double sqrt(double x)
+cdef extern from *:
+    """
+    static int distopia_is_cancelled(volatile unsigned char *flag) {
+        return flag != NULL && *flag;
+    }
+    """
+    # reads the flag through a volatile pointer so it's re-read on each call,
+    # even though it's set from another thread
+    int _is_cancelled "distopia_is_cancelled"(np.uint8_t *flag) nogil
+
+
+ctypedef fused precinct_t:
+    np.uint8_t
+    np.uint16_t
 
 
 @cython.boundscheck(False)
@@ -52,6 +71,287 @@ def fill_voronoi_diagram(
             pixels[x, y] = site_ids[i_min]
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void _fill_voronoi_line(
+        np.uint8_t[:, :] pixels, int line, double x, int h, int y_offset,
+        double[:, ::1] sites, np.uint8_t[::1] site_ids, int n) noexcept nogil:
+    # fills pixels[line, :], whose points are at x, y + y_offset. Walks the
+    # line run by run: finds the site owning the first unfilled pixel and then
+    # uses the bisectors with the other sites to find where its run ends
+    cdef int y = 0, y_end, i, owner
+    cdef double y_, d, d_min, a, bound, xo, yo
+
+    while y < h:
+        y_ = y + y_offset
+        owner = 0
+        d_min = (x - sites[0, 0]) * (x - sites[0, 0]) + \
+            (y_ - sites[0, 1]) * (y_ - sites[0, 1])
+        for i in range(1, n):
+            d = (x - sites[i, 0]) * (x - sites[i, 0]) + \
+                (y_ - sites[i, 1]) * (y_ - sites[i, 1])
+            if d < d_min:
+                d_min = d
+                owner = i
+
+        # owner stays closest to the pixel than site i as long as
+        # 2 y (yi - yo) <= xi^2 + yi^2 - xo^2 - yo^2 - 2 x (xi - xo). Only
+        # sites with yi > yo can end the run. Ties go to the lower index
+        xo = sites[owner, 0]
+        yo = sites[owner, 1]
+        y_end = h - 1
+        for i in range(n):
+            a = 2 * (sites[i, 1] - yo)
+            if i == owner or a <= 0:
+                continue
+
+            bound = (sites[i, 0] * sites[i, 0] + sites[i, 1] * sites[i, 1] -
+                     xo * xo - yo * yo - 2 * x * (sites[i, 0] - xo)) / a
+            bound -= y_offset
+            if bound >= h:
+                continue
+            if bound < y:
+                y_end = y
+                break
+            if i < owner:
+                bound = ceil(bound) - 1
+            else:
+                bound = floor(bound)
+            if bound < y_end:
+                y_end = <int>bound
+
+        if y_end < y:
+            y_end = y
+        memset(&pixels[line, y], site_ids[owner], y_end - y + 1)
+        y = y_end + 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fill_voronoi_scanline(
+        np.uint8_t[:, :] pixels, double[:, ::1] sites,
+        np.uint8_t[::1] site_ids, int x_offset=0, int y_offset=0,
+        int num_threads=0, np.uint8_t[::1] cancel=None):
+    '''Fills ``pixels`` with the id of the site closest to each pixel, like
+    :func:`fill_voronoi_diagram`, but using the analytic voronoi scanline.
+
+    ``pixels`` is indexed as ``pixels[x, y]`` and its first pixel is at
+    ``(x_offset, y_offset)``, so a slice of a larger map may be passed in as
+    long as its y axis is contiguous.
+    ``sites`` is a nx2 array of the ``x``, ``y`` site coordinates and
+    ``site_ids`` the value to fill for each site.
+
+    Each line of ``pixels`` is filled run by run: a run ends at the
+    perpendicular bisector of its site and the next site, so the cost per
+    line is proportional to the number of runs rather than the number of
+    pixels. On ties the site with the lower index wins. The GIL is released
+    and the lines are split among ``num_threads`` OpenMP threads (all
+    available when ``0``).
+
+    ``cancel`` is an optional one item array checked before each line. Once
+    another thread sets it to non-zero, the remaining lines are skipped and
+    ``pixels`` is left partially filled.
+    '''
+    cdef int w = pixels.shape[0], h = pixels.shape[1], n = sites.shape[0]
+    cdef int x
+    cdef np.uint8_t *cancel_flag = NULL
+    if not n:
+        raise ValueError('No sites specified')
+    if site_ids.shape[0] != n or sites.shape[1] != 2:
+        raise ValueError('sites must be nx2 and match site_ids')
+    if pixels.strides[1] != 1:
+        raise ValueError('The y axis of pixels must be contiguous')
+    if not h:
+        return
+    if cancel is not None:
+        cancel_flag = &cancel[0]
+
+    with nogil:
+        if num_threads > 0:
+            for x in prange(w, schedule='static', num_threads=num_threads):
+                if _is_cancelled(cancel_flag):
+                    continue
+                _fill_voronoi_line(
+                    pixels, x, x + x_offset, h, y_offset, sites, site_ids, n)
+        else:
+            for x in prange(w, schedule='static'):
+                if _is_cancelled(cancel_flag):
+                    continue
+                _fill_voronoi_line(
+                    pixels, x, x + x_offset, h, y_offset, sites, site_ids, n)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def count_precinct_districts(
+        precinct_t[:, :] pixel_precinct_map, np.uint8_t[:, :] pixel_district_map,
+        np.uint32_t[:, ::1] counts, np.uint8_t[::1] cancel=None):
+    '''Counts, in a single pass over the pixels, the number of pixels of
+    each precinct that falls within each district.
+
+    ``pixel_precinct_map`` and ``pixel_district_map`` are same sized maps of
+    the precinct and district index of each pixel. ``counts`` is a number of
+    precincts by number of districts matrix to which the counts are added.
+    Pixels whose precinct or district index is out of range of ``counts``
+    (e.g. the none value) are skipped.
+
+    ``cancel`` is an optional one item array checked before each line, like
+    in :func:`fill_voronoi_scanline`. Once it's set, counting stops.
+    '''
+    cdef int w = pixel_precinct_map.shape[0], h = pixel_precinct_map.shape[1]
+    cdef int n_precincts = counts.shape[0], n_districts = counts.shape[1]
+    cdef int x, y, precinct, district
+    cdef np.uint8_t *cancel_flag = NULL
+    if pixel_district_map.shape[0] != w or pixel_district_map.shape[1] != h:
+        raise ValueError('The precinct and district maps are not the same size')
+    if cancel is not None:
+        cancel_flag = &cancel[0]
+
+    with nogil:
+        for x in range(w):
+            if _is_cancelled(cancel_flag):
+                break
+            for y in range(h):
+                precinct = pixel_precinct_map[x, y]
+                district = pixel_district_map[x, y]
+                if precinct < n_precincts and district < n_districts:
+                    counts[precinct, district] += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate_district_shapes(
+        precinct_t[:, :] pixel_precinct_map, np.uint8_t[:, :] pixel_district_map,
+        int n_precincts, double[:, ::1] stats, np.int32_t[:, :, ::1] extremes):
+    '''Accumulates, in two passes over the pixels, the shape statistics of
+    each district, from which its compactness is computed.
+
+    Only the pixels within a precinct, i.e. whose ``pixel_precinct_map``
+    index is less than ``n_precincts``, and whose district is in range of
+    ``stats`` are counted.
+
+    ``stats`` is a number of districts by 7 matrix to which each district's
+    area, perimeter, sum of x, sum of y, sum of x squared, sum of y squared
+    and sum of x times y are added.
+
+    The perimeter is estimated with the Cauchy-Crofton formula, from the
+    number of times the lines through the pixel centers in 8 directions,
+    along the offsets ``(1, 0)``, ``(2, 1)``, ``(1, 1)``, ``(1, 2)`` and
+    their rotations, cross the district's boundary, i.e. go from a pixel of
+    the district to one that's not a counted pixel of the same district.
+    Unlike the length of the pixels' staircase boundary, which overestimates
+    a diagonal boundary by up to ``sqrt(2)``, it's within about 1.5% of the
+    length of a straight boundary in any orientation.
+
+    ``extremes`` is a number of districts by map width by 2 matrix, which
+    should be initialized to the map height and -1. For each district and
+    column x, it's set to the smallest and largest y of the district's
+    pixels in the column.
+    '''
+    cdef int w = pixel_precinct_map.shape[0], h = pixel_precinct_map.shape[1]
+    cdef int n_districts = stats.shape[0]
+    cdef int x, y, district, other, k, nx, ny
+    cdef double fx, fy, prev_angle, next_angle
+    cdef int dx[8]
+    cdef int dy[8]
+    cdef double weights[8]
+    cdef np.int32_t[:, ::1] labels
+    if pixel_district_map.shape[0] != w or pixel_district_map.shape[1] != h:
+        raise ValueError('The precinct and district maps are not the same size')
+    if stats.shape[1] != 7:
+        raise ValueError('The stats matrix must have 7 columns')
+    if extremes.shape[0] != n_districts or extremes.shape[1] != w or \
+            extremes.shape[2] != 2:
+        raise ValueError('The extremes matrix does not match the map size')
+
+    # the directions in increasing angle in [0, pi)
+    dx[:] = [1, 2, 1, 1, 0, -1, -1, -2]
+    dy[:] = [0, 1, 1, 2, 1, 2, 1, 1]
+    for k in range(8):
+        # each direction integrates the angles half way to its neighbours
+        if k:
+            prev_angle = atan2(dy[k - 1], dx[k - 1])
+        else:
+            prev_angle = atan2(dy[7], dx[7]) - M_PI
+        if k < 7:
+            next_angle = atan2(dy[k + 1], dx[k + 1])
+        else:
+            next_angle = atan2(dy[0], dx[0]) + M_PI
+        # the perimeter is half the integral over the angles of the boundary
+        # crossings per unit of distance between the parallel lines, which
+        # is 1 / sqrt(dx ** 2 + dy ** 2)
+        weights[k] = (next_angle - prev_angle) / 4. / sqrt(
+            dx[k] * dx[k] + dy[k] * dy[k])
+
+    # the district of the counted pixels, or -1, with a 2 pixel border of -1
+    # so the offsets never leave the map
+    labels = np.full((w + 4, h + 4), -1, dtype=np.int32)
+
+    with nogil:
+        for x in range(w):
+            fx = x
+            for y in range(h):
+                district = pixel_district_map[x, y]
+                if district >= n_districts or \
+                        pixel_precinct_map[x, y] >= n_precincts:
+                    continue
+
+                labels[x + 2, y + 2] = district
+                fy = y
+                stats[district, 0] += 1
+                stats[district, 2] += fx
+                stats[district, 3] += fy
+                stats[district, 4] += fx * fx
+                stats[district, 5] += fy * fy
+                stats[district, 6] += fx * fy
+
+                if y < extremes[district, x, 0]:
+                    extremes[district, x, 0] = y
+                if y > extremes[district, x, 1]:
+                    extremes[district, x, 1] = y
+
+        # each pair of pixels in each direction is visited once, and a
+        # crossing adds to the districts on both sides of it
+        for x in range(w + 4):
+            for y in range(h + 2):
+                district = labels[x, y]
+                for k in range(8):
+                    nx = x + dx[k]
+                    ny = y + dy[k]
+                    if nx < 0 or nx >= w + 4:
+                        continue
+                    other = labels[nx, ny]
+                    if other == district:
+                        continue
+                    if district >= 0:
+                        stats[district, 1] += weights[k]
+                    if other >= 0:
+                        stats[other, 1] += weights[k]
+
+
+cdef struct _Edge:
+    int first_row
+    int last_row
+    int index
+
+
+cdef int _compare_edge_rows(const void *a, const void *b) noexcept nogil:
+    return (<_Edge *>a).first_row - (<_Edge *>b).first_row
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _mark_pixels(
+        char *cspace, int width, int height, precinct_t[:, :] table,
+        int x_offset, int y_offset, precinct_t value) noexcept nogil:
+    cdef int x, y
+    for x in range(width):
+        for y in range(height):
+            if cspace[y * width + x]:
+                table[x + x_offset, y + y_offset] = value
+
+
 cdef class PolygonCollider(object):
     ''' PolygonCollider checks whether a point is within a polygon defined by a
     list of corner points.
@@ -70,11 +370,13 @@ cdef class PolygonCollider(object):
         True
 
     The constructor takes a list of x,y points in the form of [x1,y1,x2,y2...]
-    as the points argument. These points define the corners of the
-    polygon. The boundary is linearly interpolated between each set of points.
-    The x, and y values must be floating points.
+    as the points argument, or a flat or kx2 numpy array of them. These points
+    define the corners of the polygon. The boundary is linearly interpolated
+    between each set of points.
     The cache argument, if True, will calculate membership for all the points
-    so when collide_point is called it'll just be a table lookup.
+    so when collide_point is called it'll just be a table lookup. It's
+    computed with a scanline fill, whose cost is proportional to the number of
+    edges crossing each row and the number of pixels in the bounding box.
     '''
 
     cdef double *cpoints
@@ -103,7 +405,10 @@ cdef class PolygonCollider(object):
 
     @cython.cdivision(True)
     def __cinit__(self, points, cache=False, rect=None, **kwargs):
-        cdef int length = len(points)
+        # lists and arrays are all read from a flat array of doubles
+        cdef double[::1] values = np.ascontiguousarray(
+            points, dtype=np.float64).reshape(-1)
+        cdef int length = values.shape[0]
         if length % 2:
             raise IndexError('Odd number of points provided')
         if length < 6:
@@ -123,15 +428,22 @@ cdef class PolygonCollider(object):
         if cpoints is NULL or cconstant is NULL or cmultiple is NULL:
             raise MemoryError()
 
-        self.min_x = floor(min(points[0::2]))
-        self.max_x = ceil(max(points[0::2]))
-        self.min_y = floor(min(points[1::2]))
-        self.max_y = ceil(max(points[1::2]))
-
-        cdef int i_x, i_y, j_x, j_y, i
-        cdef int j = count - 1, odd, x, y
-        for i in range(length):
-            cpoints[i] = points[i]
+        cdef int i_x, i_y, j_x, j_y, i, failed
+        cdef int j = count - 1
+        cdef double min_x = values[0], max_x = values[0]
+        cdef double min_y = values[1], max_y = values[1]
+        for i in range(count):
+            cpoints[2 * i] = values[2 * i]
+            cpoints[2 * i + 1] = values[2 * i + 1]
+            min_x = min(min_x, values[2 * i])
+            max_x = max(max_x, values[2 * i])
+            min_y = min(min_y, values[2 * i + 1])
+            max_y = max(max_y, values[2 * i + 1])
+
+        self.min_x = floor(min_x)
+        self.max_x = ceil(max_x)
+        self.min_y = floor(min_y)
+        self.max_y = ceil(max_y)
 
         if cache:
             for i in range(count):
@@ -155,7 +467,6 @@ cdef class PolygonCollider(object):
                                (cpoints[j_y] - cpoints[i_y]))
             j = i
 
-        cdef int x_, y_
         if cache:
             self.width = int(self.max_x - self.min_x + 1.)
             self.height = int(self.max_y - self.min_y + 1.)
@@ -195,20 +506,102 @@ cdef class PolygonCollider(object):
             if self.cspace is NULL:
                 raise MemoryError()
 
-            for y_ in range(self.y_start, self.y_start + self.height):
-                y = y_ - self.y_start
-                for x_ in range(self.x_start, self.x_start + self.width):
-                    x = x_ - self.x_start
-                    j = count - 1
-                    odd = 0
-                    for i in range(count):
-                        i_y = i * 2 + 1
-                        j_y = j * 2 + 1
-                        if (cpoints[i_y] < y_ <= cpoints[j_y] or
-                            cpoints[j_y] < y_ <= cpoints[i_y]):
-                            odd ^= y_ * cmultiple[i] + cconstant[i] < x_
-                        j = i
-                    self.cspace[y * self.width + x] = odd
+            # the GIL is released so colliders can be built on many threads
+            with nogil:
+                failed = self._fill_cache()
+            if failed:
+                raise MemoryError()
+
+    @cython.cdivision(True)
+    cdef int _fill_cache(self) noexcept nogil:
+        # a scanline fill with an active edge table. Each row is filled
+        # between pairs of the sorted x crossings of the edges active in the
+        # row, i.e. the edges whose y_low < y <= y_high. The crossings are
+        # computed like in collide_point, so the pixels are the same as
+        # testing each one against all the edges
+        cdef double *cpoints = self.cpoints
+        cdef double *cconstant = self.cconstant
+        cdef double *cmultiple = self.cmultiple
+        cdef char *cspace = self.cspace
+        cdef int count = self.count, width = self.width
+        cdef int x_start = self.x_start, x_end = self.x_start + self.width
+        cdef int n_edges = 0, n_active = 0, next_edge = 0
+        cdef int x, y_, i, j, k, e, row, lo, hi
+        cdef double y_low, y_high, crossing
+        cdef _Edge *edges = <_Edge *>malloc(count * sizeof(_Edge))
+        cdef int *active = <int *>malloc(count * sizeof(int))
+        cdef double *crossings = <double *>malloc(count * sizeof(double))
+        if edges is NULL or active is NULL or crossings is NULL:
+            free(edges)
+            free(active)
+            free(crossings)
+            return -1
+
+        memset(cspace, 0, self.width * self.height * sizeof(char))
+        j = count - 1
+        for i in range(count):
+            y_low = cpoints[i * 2 + 1]
+            y_high = cpoints[j * 2 + 1]
+            if y_low > y_high:
+                y_low, y_high = y_high, y_low
+            if y_low != y_high:
+                edges[n_edges].first_row = <int>floor(y_low) + 1
+                edges[n_edges].last_row = <int>floor(y_high)
+                edges[n_edges].index = i
+                n_edges += 1
+            j = i
+        qsort(edges, n_edges, sizeof(_Edge), _compare_edge_rows)
+
+        for y_ in range(self.y_start, self.y_start + self.height):
+            # drop the edges that ended and add the ones that start
+            k = 0
+            for e in range(n_active):
+                if edges[active[e]].last_row >= y_:
+                    active[k] = active[e]
+                    k += 1
+            n_active = k
+            while next_edge < n_edges and edges[next_edge].first_row <= y_:
+                if edges[next_edge].last_row >= y_:
+                    active[n_active] = next_edge
+                    n_active += 1
+                next_edge += 1
+
+            # the active edges are kept sorted by their crossing in the
+            # previous row, and the order of edges only changes where they
+            # intersect, so the insertion sort mostly just places the edges
+            # that were added in this row
+            for e in range(n_active):
+                j = active[e]
+                i = edges[j].index
+                crossing = y_ * cmultiple[i] + cconstant[i]
+                k = e
+                while k > 0 and crossings[k - 1] > crossing:
+                    crossings[k] = crossings[k - 1]
+                    active[k] = active[k - 1]
+                    k -= 1
+                crossings[k] = crossing
+                active[k] = j
+
+            # a pixel is inside if an odd number of crossings are left of it
+            row = (y_ - self.y_start) * width - x_start
+            for k in range(0, n_active, 2):
+                if crossings[k] >= x_end:
+                    break
+                lo = x_start
+                if crossings[k] >= x_start:
+                    lo = <int>floor(crossings[k]) + 1
+                hi = x_end - 1
+                if k + 1 < n_active and crossings[k + 1] < x_end - 1:
+                    if crossings[k + 1] < x_start:
+                        continue
+                    hi = <int>floor(crossings[k + 1])
+                for x in range(lo, hi + 1):
+                    cspace[row + x] = 1
+
+        free(edges)
+        free(active)
+        free(crossings)
+        return 0
 
     def __dealloc__(self):
         free(self.cpoints)
@@ -249,7 +642,7 @@ cdef class PolygonCollider(object):
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def mark_pixels_u8(self, np.ndarray[np.uint8_t, ndim=2] table, int w, int h,
+    def mark_pixels_u8(self, np.uint8_t[:, :] table, int w, int h,
                        np.uint8_t value):
         cdef int x, y, x_offset, y_offset
         if self.cspace is NULL:
@@ -271,15 +664,14 @@ cdef class PolygonCollider(object):
         else:
             y_offset = -self.y_offset
 
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.cspace[y * self.width + x]:
-                    table[x + x_offset, y + y_offset] = value
+        with nogil:
+            _mark_pixels(self.cspace, self.width, self.height, table,
+                         x_offset, y_offset, value)
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
     def mark_pixels_u16(
-            self, np.ndarray[np.uint16_t, ndim=2] table, int w, int h, np.uint16_t value):
+            self, np.uint16_t[:, :] table, int w, int h, np.uint16_t value):
         cdef int x, y, x_offset, y_offset
         if self.cspace is NULL:
             raise TypeError('This method can only be called if cache was True')
@@ -300,42 +692,64 @@ cdef class PolygonCollider(object):
         else:
             y_offset = -self.y_offset
 
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.cspace[y * self.width + x]:
-                    table[x + x_offset, y + y_offset] = value
+        with nogil:
+            _mark_pixels(self.cspace, self.width, self.height, table,
+                         x_offset, y_offset, value)
 
     @staticmethod
     @cython.boundscheck(False)
     @cython.wraparound(False)
     def get_arg_max_count(
-            np.ndarray[np.uint8_t, ndim=2] table,
-            np.ndarray[np.uint8_t, ndim=2] mask,
-            np.ndarray[np.uint64_t, ndim=1] bins, int num_bins, int w, int h,
+            np.uint8_t[:, :] table, np.uint8_t[:, :] mask,
+            np.uint64_t[:] bins, int num_bins, int w, int h,
             unsigned char none_val):
         cdef int x, y, i, best_i
         cdef unsigned char val
         cdef np.uint64_t count_val, max_val
 
-        for x in range(w):
-            for y in range(h):
-                if mask[x, y]:
-                    val = table[x, y]
-                    if val != none_val:
-                        bins[val] += 1
-
-        max_val = 0
-        best_i = -1
-        for i in range(num_bins):
-            count_val = bins[i]
-            if count_val > max_val:
-                best_i = i
-                max_val = count_val
+        with nogil:
+            for x in range(w):
+                for y in range(h):
+                    if mask[x, y]:
+                        val = table[x, y]
+                        if val != none_val:
+                            bins[val] += 1
+
+            max_val = 0
+            best_i = -1
+            for i in range(num_bins):
+                count_val = bins[i]
+                if count_val > max_val:
+                    best_i = i
+                    max_val = count_val
 
         if best_i == -1:
             return none_val
         return best_i
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fill_mask(self, np.uint8_t[:, :] mask):
+        '''Sets to one the items of ``mask``, a matrix the size of the
+        :meth:`bounding_box` (inclusive), of the pixels within the polygon
+        (and the rect). It's the same as setting the :meth:`get_inside_points`
+        relative to the bounding box, but without the GIL.
+        '''
+        cdef int x, y
+        if self.cspace is NULL:
+            raise TypeError('This method can only be called if cache was True')
+        if self.empty:
+            return
+        if (mask.shape[0] < self.x_start + self.width or
+                mask.shape[1] < self.y_start + self.height):
+            raise ValueError('The mask is smaller than the bounding box')
+
+        with nogil:
+            for x in range(self.width):
+                for y in range(self.height):
+                    if self.cspace[y * self.width + x]:
+                        mask[x + self.x_start, y + self.y_start] = 1
+
     def get_inside_points(self):
         '''Returns a list of all the points that are within the polygon.
         '''
@@ -0,0 +1,258 @@
+"""
+Precinct Raster
+===============
+
+Rasterizes the precincts onto a pixel grid, which is used to map the
+district pixels onto the precincts.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from distopia.mapping._voronoi import PolygonCollider
+import numpy as np
+
+__all__ = ('PrecinctRaster', 'get_grid_size')
+
+
+def get_grid_size(screen_size, scale):
+    """Returns the ``(width, height)`` of the compute grid that covers
+    ``screen_size`` at ``scale`` pixels per screen pixel.
+    """
+    w, h = screen_size
+    return max(int(round(w * scale)), 1), max(int(round(h * scale)), 1)
+
+
+class PrecinctRaster(object):
+    """The precincts rasterized onto a grid covering the screen at a given
+    scale.
+
+    Grid pixel ``(x, y)`` is at screen position ``(x / scale, y / scale)``.
+
+    The precincts are rasterized from their
+    :attr:`~distopia.precinct.Precinct.vertices`, unless ``boundaries``, a
+    list with the boundary of each precinct as a flat list or array, e.g.
+    simplified for the scale, is given.
+
+    The colliders and masks of batches of precincts are computed on
+    ``num_threads`` threads (all the cores if zero), as the collider kernels
+    release the GIL. The precincts are then marked into
+    :attr:`pixel_precinct_map` in order, so where precincts overlap the
+    pixel is always marked with the last one, whatever the number of threads.
+    """
+
+    scale = 1.
+    """The number of grid pixels per screen pixel.
+    """
+
+    size = (0, 0)
+    """The ``(width, height)`` of the grid.
+    """
+
+    pixel_precinct_map = None
+    """A width by height matrix, where each item is the index of the precinct
+    that contains the pixel, or the max value of the dtype if none.
+    """
+
+    colliders = []
+    """A list of :class:`~distopia.mapping._voronoi.PolygonCollider`, one for
+    each precinct. It's empty when the raster was loaded with :meth:`load`.
+    """
+
+    precinct_indices = []
+    """A list with a ``(x1, y1, x2, y2, mask)`` tuple for each precinct.
+    ``mask`` is a uint8 matrix of the pixels in the ``x1:x2, y1:y2``
+    bounding box that are within the precinct.
+    """
+
+    bboxes = None
+    """A nx4 array of the ``(x1, y1, x2, y2)`` (exclusive) bounding box of
+    each precinct in :attr:`precinct_indices`.
+    """
+
+    mask_sizes = None
+    """An array with the number of pixels in each precinct's mask in
+    :attr:`precinct_indices`.
+    """
+
+    format_version = 1
+    """The version of the rasterization, which is part of the cache key of
+    saved rasters (see
+    :meth:`~distopia.mapping.voronoi.VoronoiMapping.get_raster_cache_key`),
+    so it must be increased whenever the rasterization changes.
+    """
+
+    _samples = {}
+
+    def __init__(
+            self, precincts, screen_size, scale=1., boundaries=None,
+            num_threads=0, **kwargs):
+        super(PrecinctRaster, self).__init__(**kwargs)
+        self._samples = {}
+        self.scale = scale
+        self.size = w, h = get_grid_size(screen_size, scale)
+
+        if len(precincts) < 2 ** 8 - 1:
+            dtype = np.uint8
+            f = 'mark_pixels_u8'
+        elif len(precincts) < 2 ** 16 - 1:
+            dtype = np.uint16
+            f = 'mark_pixels_u16'
+        else:
+            raise ValueError('Too many precincts')
+
+        self.pixel_precinct_map = pixel_precinct_map = np.ones(
+            (w, h), dtype=dtype) * np.iinfo(dtype).max
+
+        if boundaries is None:
+            boundaries = [precinct.vertices for precinct in precincts]
+
+        def rasterize(batch):
+            items = []
+            for boundary in batch:
+                if scale != 1:
+                    boundary = np.asarray(boundary, dtype=np.float64) * scale
+                collider = PolygonCollider(
+                    points=boundary, cache=True, rect=(0, 0, w, h))
+
+                x1, y1, x2, y2 = collider.bounding_box()
+                precinct_values = np.zeros(
+                    (x2 - x1 + 1, y2 - y1 + 1), dtype=np.uint8)
+                collider.fill_mask(precinct_values)
+                items.append(
+                    (collider, (x1, y1, x2 + 1, y2 + 1, precinct_values)))
+            return items
+
+        if num_threads <= 0:
+            num_threads = os.cpu_count() or 1
+        if num_threads > 1 and len(boundaries) > 1:
+            # a few batches per thread to balance the load
+            n = max(len(boundaries) // (num_threads * 4), 1)
+            batches = [boundaries[i:i + n]
+                       for i in range(0, len(boundaries), n)]
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                items = [item for batch_items in executor.map(
+                         rasterize, batches) for item in batch_items]
+        else:
+            items = rasterize(boundaries)
+
+        self.colliders = colliders = [collider for collider, _ in items]
+        self.precinct_indices = [indices for _, indices in items]
+        for i, collider in enumerate(colliders):
+            getattr(collider, f)(pixel_precinct_map, w, h, i)
+
+        self.bboxes = np.array(
+            [item[:4] for item in self.precinct_indices],
+            dtype=np.int64).reshape((-1, 4))
+        self.mask_sizes = np.array(
+            [np.count_nonzero(item[4]) for item in self.precinct_indices],
+            dtype=np.int64)
+
+    _saved_arrays = (
+        'scale', 'pixel_precinct_map', 'bboxes', 'mask_sizes', 'masks',
+        'mask_offsets')
+
+    def save(self, path):
+        """Saves the raster to the directory ``path``, with a ``.npy`` file
+        for each array, so that :meth:`load` can memory map it instead of
+        rasterizing the precincts again.
+
+        The files are first written to a temporary directory that is then
+        renamed to ``path``, so a partially written raster is never loaded.
+        If ``path`` already exists, it's left unchanged.
+        """
+        if os.path.exists(path):
+            return
+
+        masks = [item[4].ravel() for item in self.precinct_indices]
+        mask_offsets = np.zeros(len(masks) + 1, dtype=np.int64)
+        np.cumsum([len(mask) for mask in masks], out=mask_offsets[1:])
+        arrays = {
+            'scale': np.array(self.scale, dtype=np.float64),
+            'pixel_precinct_map': self.pixel_precinct_map,
+            'bboxes': self.bboxes,
+            'mask_sizes': self.mask_sizes,
+            'masks': np.concatenate(
+                masks or [np.zeros(0, dtype=np.uint8)]),
+            'mask_offsets': mask_offsets,
+        }
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(temp_path)
+        try:
+            for name in self._saved_arrays:
+                np.save(os.path.join(temp_path, '{}.npy'.format(name)),
+                        arrays[name], allow_pickle=False)
+            os.rename(temp_path, path)
+        except OSError:
+            # another process saved it first
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the raster saved with :meth:`save`.
+
+        The arrays are memory mapped copy on write, so they're only read
+        from disk as needed, and the masks in :attr:`precinct_indices` are
+        views into a single buffer.
+        """
+        def load(name):
+            return np.load(os.path.join(path, '{}.npy'.format(name)),
+                           mmap_mode='c', allow_pickle=False).view(np.ndarray)
+
+        raster = cls.__new__(cls)
+        raster._samples = {}
+        raster.colliders = []
+        raster.scale = float(load('scale'))
+        raster.pixel_precinct_map = load('pixel_precinct_map')
+        raster.size = tuple(raster.pixel_precinct_map.shape)
+        raster.bboxes = bboxes = load('bboxes')
+        raster.mask_sizes = load('mask_sizes')
+
+        masks = load('masks')
+        offsets = load('mask_offsets').tolist()
+        precinct_indices = raster.precinct_indices = []
+        for (x1, y1, x2, y2), start, end in zip(
+                bboxes.tolist(), offsets[:-1], offsets[1:]):
+            precinct_indices.append((x1, y1, x2, y2, masks[start:end].reshape(
+                (x2 - x1, y2 - y1))))
+        return raster
+
+    def get_sample_pixels(self, step=1):
+        """Returns the grid pixels within the precinct masks of
+        :attr:`precinct_indices`, sampled every ``step`` pixels in ``x`` and
+        ``y``. Each precinct with a non-empty mask gets at least one sample,
+        even if it's smaller than ``step``.
+
+        :return: A tuple of a nx2 float64 array of the ``x``, ``y`` grid
+            coordinates of the samples, and an array of the index of the
+            precinct of each sample. A pixel within multiple masks is
+            sampled for each of these precincts.
+        """
+        if step in self._samples:
+            return self._samples[step]
+
+        positions = []
+        precincts = []
+        for i, (x1, y1, x2, y2, mask) in enumerate(self.precinct_indices):
+            xs, ys = np.nonzero(mask)
+            xs += x1
+            ys += y1
+            if step > 1 and len(xs):
+                selected = (xs % step == 0) & (ys % step == 0)
+                if not selected.any():
+                    selected[0] = True
+                xs, ys = xs[selected], ys[selected]
+
+            positions.append(np.stack([xs, ys], axis=1))
+            precincts.append(np.full(len(xs), i, dtype=np.int64))
+
+        positions = np.concatenate(
+            positions or [np.empty((0, 2))]).astype(np.float64)
+        precincts = np.concatenate(
+            precincts or [np.empty(0, dtype=np.int64)])
+        self._samples[step] = positions, precincts
+        return positions, precincts
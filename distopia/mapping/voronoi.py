@@ -4,21 +4,486 @@ Voronoi Mapping
 """
 from scipy.spatial import Voronoi
 from distopia.district import District
-from distopia.precinct import Precinct
-from distopia.mapping._voronoi import PolygonCollider, fill_voronoi_diagram
+from distopia.precinct.adjacency import PrecinctAdjacency, \
+    DistrictContiguity
+from distopia.precinct.topology import PrecinctTopology
+from distopia.mapping._voronoi import PolygonCollider, fill_voronoi_diagram, \
+    fill_voronoi_scanline, count_precinct_districts
+from distopia.mapping.raster import PrecinctRaster, get_grid_size
 import numpy as np
-from collections import defaultdict
+import os
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import time
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
 import math
 import cProfile, pstats, io
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
+from collections import OrderedDict
 
-__all__ = ('VoronoiMapping', )
+__all__ = ('VoronoiMapping', 'GridScaleController', 'ReassignmentCache',
+           'ReassignmentMailbox', 'CancellationToken', 'ComputationCancelled',
+           'voronoi_cell_polygon', 'clipped_voronoi_polygons')
+
+
+class ComputationCancelled(Exception):
+    """Raised by :meth:`CancellationToken.check` when the computation was
+    cancelled.
+    """
+    pass
+
+
+class CancellationToken(object):
+    """A flag with which the processing thread is told to abandon its current
+    computation, e.g. because a newer request was posted.
+
+    The computation stages call :meth:`check` between steps and the Cython
+    kernels read :attr:`flag` directly while they run.
+    """
+
+    flag = None
+    """A one item uint8 array that is non-zero once cancelled.
+    """
+
+    cancellable = True
+    """Whether :meth:`cancel` actually cancels the computation.
+    """
+
+    def __init__(self, cancellable=True, **kwargs):
+        super(CancellationToken, self).__init__(**kwargs)
+        self.flag = np.zeros(1, dtype=np.uint8)
+        self.cancellable = cancellable
+
+    @property
+    def cancelled(self):
+        """Whether the token was cancelled.
+        """
+        return bool(self.flag[0])
+
+    def cancel(self):
+        """Cancels the computation, if it's :attr:`cancellable`.
+        """
+        if self.cancellable:
+            self.flag[0] = 1
+
+    def check(self):
+        """Raises :class:`ComputationCancelled` if the token was cancelled.
+        """
+        if self.flag[0]:
+            raise ComputationCancelled()
+
+
+def _cancel_flag(cancel_token):
+    # the flag passed to the Cython kernels
+    if cancel_token is None:
+        return None
+    return cancel_token.flag
+
+
+def _check_cancelled(cancel_token):
+    if cancel_token is not None:
+        cancel_token.check()
+
+
+class ReassignmentMailbox(object):
+    """A single slot, latest request wins, mailbox through which the
+    reassignment requests are passed to the processing thread.
+
+    Each posted request gets a new, increasing, epoch and replaces any request
+    that has not been started yet. Posting also cancels the computation in
+    progress, unless it was posted as not cancellable or
+    :attr:`max_cancellations` computations in a row were already cancelled.
+    The latter ensures that the reported results trail the newest request
+    by at most one computation, even while requests keep coming.
+    """
+
+    epoch = 0
+    """The epoch of the newest posted request.
+    """
+
+    max_cancellations = 2
+    """The number of computations in a row that may be cancelled by newer
+    requests, before one is allowed to finish.
+    """
+
+    cancellations = 0
+    """The number of computations in a row that were cancelled.
+    """
+
+    _condition = None
+
+    _request = None
+
+    _token = None
+
+    _closed = False
+
+    def __init__(self, max_cancellations=2, **kwargs):
+        super(ReassignmentMailbox, self).__init__(**kwargs)
+        self.max_cancellations = max_cancellations
+        self._condition = Condition()
+
+    def post(self, request, cancellable=True):
+        """Posts ``request``, replacing any pending request, and returns its
+        epoch.
+
+        :param cancellable: Whether the computation of this request may be
+            cancelled by newer requests.
+        """
+        with self._condition:
+            self.epoch += 1
+            self._request = self.epoch, request, cancellable
+            token = self._token
+            if token is not None and \
+                    self.cancellations < self.max_cancellations:
+                token.cancel()
+            self._condition.notify()
+            return self.epoch
+
+    def get(self):
+        """Waits for a request and returns its ``(epoch, request, token)``,
+        where ``token`` is the :class:`CancellationToken` of its computation.
+
+        Returns None once :meth:`close` is called.
+        """
+        with self._condition:
+            while self._request is None and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+
+            epoch, request, cancellable = self._request
+            self._request = None
+            self._token = token = CancellationToken(cancellable=cancellable)
+            return epoch, request, token
+
+    def done(self, cancelled=False):
+        """Called by the processing thread when the computation of the last
+        request returned by :meth:`get` finished or was ``cancelled``.
+        """
+        with self._condition:
+            self._token = None
+            if cancelled:
+                self.cancellations += 1
+            else:
+                self.cancellations = 0
+
+    def is_stale(self, epoch):
+        """Whether a newer request than the one of ``epoch`` was posted.
+        """
+        return epoch != self.epoch
+
+    def has_pending(self):
+        """Whether a request is waiting to be started.
+        """
+        return self._request is not None
+
+    def close(self):
+        """Cancels the current computation and makes :meth:`get` return None.
+        """
+        with self._condition:
+            self._closed = True
+            if self._token is not None:
+                self._token.cancellable = True
+                self._token.cancel()
+            self._condition.notify_all()
+
+
+def voronoi_cell_polygon(sites, i, rect):
+    """Computes the voronoi cell of site ``i`` clipped to ``rect``.
+
+    :param sites: nx2 array of the sites' ``x``, ``y`` coordinates.
+    :param i: The index of the site in ``sites``.
+    :param rect: The ``(x1, y1, x2, y2)`` clipping rectangle.
+    :return: A mx2 array of the vertices of the (convex) cell polygon. It's
+        empty if the cell does not intersect ``rect``.
+    """
+    x1, y1, x2, y2 = rect
+    polygon = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+    sx, sy = sites[i]
+
+    # clip the polygon with the half plane closer to site i than to each other
+    # site, a * x + b * y <= c
+    for j, (ox, oy) in enumerate(sites):
+        if j == i or not polygon:
+            continue
+        a = 2 * (ox - sx)
+        b = 2 * (oy - sy)
+        c = ox * ox + oy * oy - sx * sx - sy * sy
+
+        clipped = []
+        px, py = polygon[-1]
+        p_val = a * px + b * py - c
+        for qx, qy in polygon:
+            q_val = a * qx + b * qy - c
+            if (p_val <= 0) != (q_val <= 0):
+                t = p_val / (p_val - q_val)
+                clipped.append((px + t * (qx - px), py + t * (qy - py)))
+            if q_val <= 0:
+                clipped.append((qx, qy))
+            px, py, p_val = qx, qy, q_val
+        polygon = clipped
+
+    return np.array(polygon, dtype=np.float64).reshape((-1, 2))
+
+
+def clipped_voronoi_polygons(sites, rect):
+    """Computes the voronoi cells of all the ``sites``, clipped to ``rect``.
+
+    The sites are mirrored across the 4 edges of ``rect`` and the diagram of
+    the sites and their mirrors is computed with scipy. The cells of the
+    original sites are then exactly their cells clipped to ``rect``, because
+    the edges of ``rect`` are the bisectors with the mirrored sites.
+
+    :param sites: nx2 array of the sites' ``x``, ``y`` coordinates. They must
+        be within ``rect``.
+    :param rect: The ``(x1, y1, x2, y2)`` clipping rectangle.
+    :return: A tuple of a mx2 array of the vertices of all the cells,
+        followed by an array of n + 1 offsets into it, such that the
+        (convex) cell polygon of site ``i`` is
+        ``vertices[offsets[i]:offsets[i + 1]]``. A site with no cell (e.g. a
+        duplicate site) has an empty polygon.
+    """
+    sites = np.asarray(sites, dtype=np.float64).reshape((-1, 2))
+    n = len(sites)
+    x1, y1, x2, y2 = rect
+    if not n:
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64)
+
+    mirrors = np.tile(sites, (4, 1))
+    mirrors[:n, 0] = 2 * x1 - sites[:, 0]
+    mirrors[n:2 * n, 0] = 2 * x2 - sites[:, 0]
+    mirrors[2 * n:3 * n, 1] = 2 * y1 - sites[:, 1]
+    mirrors[3 * n:, 1] = 2 * y2 - sites[:, 1]
+    vor = Voronoi(np.concatenate([sites, mirrors]))
+
+    # in 2D, the region vertices are listed in order around the region
+    regions = [vor.regions[r] for r in vor.point_region[:n]]
+    regions = [r if r and -1 not in r else [] for r in regions]
+    lengths = np.array([len(r) for r in regions], dtype=np.int64)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    indices = np.fromiter(
+        (v for r in regions for v in r), dtype=np.int64, count=offsets[-1])
+    vertices = vor.vertices[indices]
+    # vertices on the edges may be just outside due to rounding
+    np.clip(vertices[:, 0], x1, x2, out=vertices[:, 0])
+    np.clip(vertices[:, 1], y1, y2, out=vertices[:, 1])
+    return vertices, offsets
+
+
+class GridScaleController(object):
+    """Picks the scale of the compute grid used by :class:`VoronoiMapping`,
+    such that a computation takes no longer than :attr:`target_latency`.
+
+    It keeps a running average of the measured duration of the computations
+    at each scale. The duration at a scale that has not been measured yet
+    is extrapolated from the closest measured scale, assuming the duration is
+    proportional to the number of grid pixels.
+    """
+
+    target_latency = 1 / 30.
+    """The longest duration, in seconds, that a computation should take.
+    """
+
+    scales = (1., .75, .5, .35, .25, .125)
+    """The scales from which the controller picks.
+    """
+
+    smoothing = .25
+    """The weight of a new measurement in the running average.
+    """
+
+    durations = {}
+    """A dict mapping each measured scale to its average duration.
+    """
+
+    def __init__(self, target_latency=1 / 30., scales=None, **kwargs):
+        super(GridScaleController, self).__init__(**kwargs)
+        self.target_latency = target_latency
+        if scales is not None:
+            self.scales = tuple(scales)
+        self.durations = {}
+
+    def record(self, scale, duration):
+        """Records that a computation at ``scale`` took ``duration`` seconds.
+        """
+        durations = self.durations
+        if scale in durations:
+            durations[scale] += self.smoothing * (duration - durations[scale])
+        else:
+            durations[scale] = duration
+
+    def predict(self, scale):
+        """Returns the expected duration of a computation at ``scale``, or
+        None if nothing was measured yet.
+        """
+        durations = self.durations
+        if scale in durations:
+            return durations[scale]
+        if not durations:
+            return None
+
+        closest = min(durations, key=lambda s: abs(s - scale))
+        return durations[closest] * (scale / float(closest)) ** 2
+
+    def select_scale(self):
+        """Returns the largest of the :attr:`scales` expected to meet the
+        :attr:`target_latency`, or the smallest scale if none do.
+        """
+        scales = sorted(self.scales, reverse=True)
+        for scale in scales:
+            duration = self.predict(scale)
+            if duration is None or duration <= self.target_latency:
+                return scale
+        return scales[-1]
+
+
+class ReassignmentCache(object):
+    """A least recently used cache of the results of
+    :class:`VoronoiMapping` computations, keyed by the fiducial
+    configuration.
+
+    The key is the set of the fiducials' logical identity and position, with
+    the positions snapped to a grid of :attr:`grid` pixels, so fiducials that
+    are put back close to where they were still hit the cache.
+
+    The entries are evicted in least recently used order once there are more
+    than :attr:`max_entries` entries, or they use more than
+    :attr:`max_memory` bytes.
+    """
+
+    max_entries = 64
+    """The largest number of entries kept.
+    """
+
+    max_memory = 256 * 1024 * 1024
+    """The approximate largest number of bytes used by the entries' arrays.
+    """
+
+    grid = 4.
+    """The size, in screen pixels, of the grid to which the fiducial
+    positions are snapped when computing the key.
+    """
+
+    memory = 0
+    """The approximate number of bytes used by the entries.
+    """
+
+    hits = 0
+    """The number of lookups that found an entry.
+    """
+
+    misses = 0
+    """The number of lookups that did not find an entry.
+    """
+
+    evictions = 0
+    """The number of entries evicted to respect the limits.
+    """
+
+    _entries = None
+
+    def __init__(
+            self, max_entries=64, max_memory=256 * 1024 * 1024, grid=4.,
+            **kwargs):
+        super(ReassignmentCache, self).__init__(**kwargs)
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.grid = grid
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_key(self, fiducials, fiducials_identity, context=()):
+        """Returns the key of the fiducial configuration.
+
+        :param fiducials: nx2 array of the fiducials' ``x``, ``y`` positions.
+        :param fiducials_identity: The logical identity of each fiducial.
+        :param context: A hashable of anything else the result depends on,
+            e.g. the screen size.
+        """
+        snapped = np.round(
+            np.asarray(fiducials, dtype=np.float64).reshape((-1, 2)) /
+            self.grid).astype(np.int64)
+        return tuple(context), tuple(sorted(
+            (identity, int(x), int(y)) for identity, (x, y) in
+            zip(fiducials_identity, snapped)))
+
+    @staticmethod
+    def get_entry_size(entry, _seen=None):
+        """Returns the approximate number of bytes used by the ``entry`` dict.
+        """
+        seen = set() if _seen is None else _seen
+        size = 0
+        for value in entry.values():
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+
+            if isinstance(value, np.ndarray):
+                size += value.nbytes
+            elif isinstance(value, dict):
+                size += ReassignmentCache.get_entry_size(value, seen)
+            elif isinstance(value, (list, tuple)):
+                # the list of precincts of each district
+                size += 8 * sum(
+                    len(item) if isinstance(item, (list, tuple)) else 1
+                    for item in value)
+        return size
+
+    def get(self, key):
+        """Returns the entry stored for ``key`` or None, and updates the
+        statistics.
+        """
+        entries = self._entries
+        if key not in entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entries.move_to_end(key)
+        return entries[key][0]
+
+    def put(self, key, entry):
+        """Stores the ``entry`` dict under ``key``, evicting the least
+        recently used entries as needed. An entry larger than
+        :attr:`max_memory` is not stored.
+        """
+        entries = self._entries
+        if key in entries:
+            self.memory -= entries.pop(key)[1]
+
+        size = self.get_entry_size(entry)
+        if size > self.max_memory or self.max_entries <= 0:
+            return
+
+        while entries and (len(entries) >= self.max_entries or
+                           self.memory + size > self.max_memory):
+            self.memory -= entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+        entries[key] = entry, size
+        self.memory += size
+
+    def clear(self):
+        """Removes all the entries, e.g. when the precincts change.
+        """
+        self._entries.clear()
+        self.memory = 0
+
+    def get_stats(self):
+        """Returns a dict with the hit and miss statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.,
+            'evictions': self.evictions, 'entries': len(self._entries),
+            'memory': self.memory}
 
 
 class VoronoiMapping(object):
@@ -39,6 +504,59 @@ class VoronoiMapping(object):
     to a precinct in :attr:`precincts`.
     """
 
+    precinct_adjacency = None
+    """The :class:`~distopia.precinct.adjacency.PrecinctAdjacency` of the
+    :attr:`precincts`, used to check the districts' contiguity.
+
+    If None, it's created from the precincts'
+    :attr:`~distopia.precinct.Precinct.neighbours` when first needed, so it
+    must be set (or the neighbours be set) after :meth:`set_precincts`.
+    """
+
+    precinct_topology = None
+    """The :class:`~distopia.precinct.topology.PrecinctTopology` of the
+    :attr:`precincts`' boundaries, from which the districts' boundaries are
+    stitched.
+
+    If None, it's built (or loaded from the :attr:`raster_cache_path`) by
+    :meth:`get_precinct_topology` when the districts' boundaries are first
+    needed.
+    """
+
+    topology_tolerance = 1.
+    """The largest distance between the boundaries of two precincts that are
+    considered shared by the :attr:`precinct_topology`.
+    """
+
+    precinct_lods = []
+    """A list of ``(tolerance, boundaries)`` simplified levels of detail of
+    the :attr:`precincts`, from the most to the least detailed, e.g. from
+    :meth:`~distopia.app.geo_data.GeoData.get_lod_boundaries`.
+    ``boundaries`` is the flat array of the boundary of each precinct,
+    simplified within ``tolerance`` screen pixels.
+
+    It's set by :meth:`set_precincts`.
+    """
+
+    raster_lod_error = .5
+    """The largest simplification error, in grid pixels, of the
+    :attr:`precinct_lods` level from which the precincts are rasterized at
+    each scale, see :meth:`get_precinct_boundaries`.
+    """
+
+    raster_cache_path = None
+    """If not None, the directory in which the
+    :class:`~distopia.mapping.raster.PrecinctRaster` of each scale is saved
+    when it's first created, and from which it's loaded (memory mapped) by
+    later instances, e.g. on the next startup.
+
+    Each raster is saved under the :meth:`get_raster_cache_key` of the
+    boundaries it was rasterized from, the :attr:`screen_size` and the
+    scale, so changing any of them creates a new raster. The
+    :attr:`precinct_topology` is similarly saved under its
+    :meth:`get_topology_cache_key`.
+    """
+
     districts = []
     """A list of all current :class:`distopia.district.District` instances.
     """
@@ -60,17 +578,142 @@ class VoronoiMapping(object):
     pixel_district_map = None
     """A width by height matrix, where each item is the district index in
     :attr:`districts` it belongs to. Read_only (used by the thread).
+
+    It's computed on the grid of scale :attr:`pixel_district_scale`.
+    """
+
+    pixel_district_scale = 1.
+    """The scale of the grid on which :attr:`pixel_district_map` was computed.
+    """
+
+    precinct_district_counts = None
+    """A number of precincts by number of districts matrix with the number of
+    pixels of each precinct that are in each district, as computed by
+    :meth:`compute_precinct_counts` for the current :attr:`districts`.
+
+    Dividing each row by its sum gives the fraction of each precinct that
+    overlaps each district.
     """
 
     pixel_precinct_map = None
+    """The :attr:`~distopia.mapping.raster.PrecinctRaster.pixel_precinct_map`
+    of the precincts rasterized at :attr:`compute_scale`.
+    """
 
     precinct_indices = []
+    """The :attr:`~distopia.mapping.raster.PrecinctRaster.precinct_indices`
+    of the precincts rasterized at :attr:`compute_scale`.
+    """
+
+    compute_scale = 1.
+    """The scale, relative to :attr:`screen_size`, of the grid on which the
+    pixels and precincts are computed. E.g. ``0.5`` computes on a grid with
+    half the width and height of the screen.
+
+    Must be set before :meth:`set_precincts` is called.
+    """
+
+    progressive = False
+    """If True, the processing thread first computes and reports the
+    districts on a coarse grid of scale :attr:`coarse_scale` (or as picked by
+    :attr:`grid_controller`). It then refines the precincts whose district
+    vote was close, at :attr:`compute_scale`, and reports again.
+    """
+
+    coarse_scale = .25
+    """The scale of the first computation in :attr:`progressive` mode, when
+    there's no :attr:`grid_controller`.
+    """
+
+    refine_margin = .2
+    """In :attr:`progressive` mode, precincts whose winning district had a
+    lead smaller than this fraction of their pixels on the coarse grid are
+    refined.
+    """
+
+    grid_controller = None
+    """If not None, a :class:`GridScaleController` that picks the scale of
+    the (first) computation done by the processing thread from the measured
+    timings. Its scales should not be larger than :attr:`compute_scale`.
+    """
+
+    reassignment_cache = None
+    """If not None, a :class:`ReassignmentCache` in which the final results of
+    :meth:`apply_voronoi` and the processing thread are stored, and from which
+    they are returned when the same fiducial configuration is seen again.
+    Only assignments at :attr:`compute_scale`, or refined to it, are stored.
+    """
+
+    pixel_engine = 'scanline'
+    """The algorithm used by :meth:`compute_district_pixels` to compute
+    :attr:`pixel_district_map`.
+
+    Can be one of:
+
+    * ``'collider'``: the voronoi polygons are computed with scipy and each is
+      rasterized with a :class:`~distopia.mapping._voronoi.PolygonCollider`.
+    * ``'nearest'``: each pixel is labeled directly with the district of its
+      nearest fiducial using numpy. This gives the same map without
+      computing any polygons.
+    * ``'scanline'``: like ``'nearest'``, but computed by
+      :func:`~distopia.mapping._voronoi.fill_voronoi_scanline`, which fills
+      whole runs of pixels bounded by the voronoi bisectors, in parallel.
+      This is the default and by far the fastest.
+    """
+
+    nearest_block_size = 64
+    """The number of pixel columns processed at once by the ``'nearest'``
+    :attr:`pixel_engine`.
+    """
+
+    num_threads = 0
+    """The number of threads used by the parallel kernels and by the
+    :meth:`get_thread_pool` on which the precincts are rasterized and
+    counted. If zero, all the available cores are used.
+    """
+
+    min_thread_pixels = 1 << 16
+    """The smallest number of pixels that :meth:`compute_precinct_counts`
+    gives to a thread of the :meth:`get_thread_pool`.
+    """
+
+    incremental_update = True
+    """Whether, when only a single fiducial moved since the last computation,
+    :meth:`compute_assignment` only recomputes the pixels and precincts that
+    could have changed district instead of the whole map.
+    """
 
     _fiducial_count = 0
 
+    _precinct_index = {}
+    """A dict mapping each precinct to its index in :attr:`precincts`.
+    """
+
+    _contiguity = None
+    """The :class:`~distopia.precinct.adjacency.DistrictContiguity` of the
+    last districts created by :meth:`create_districts_from_assignment`.
+    """
+
+    _precinct_rasters = {}
+    """A dict mapping scale to the :class:`PrecinctRaster` at that scale.
+    """
+
+    _last_computation = None
+    """A dict with the fiducials, districts and results of the last
+    :meth:`compute_assignment`, used for incremental updates.
+    """
+
     _thread = None
 
-    _thread_queue = None
+    _thread_pool = None
+    """The :class:`~concurrent.futures.ThreadPoolExecutor` returned by
+    :meth:`get_thread_pool`, with the id of the process that created it.
+    """
+
+    _mailbox = None
+    """The :class:`ReassignmentMailbox` through which the reassignment
+    requests are passed to the processing thread.
+    """
 
     _profiler = None
 
@@ -85,8 +728,11 @@ class VoronoiMapping(object):
         self.precinct_colliders = []
         self.fiducial_locations = {}
         self.fiducial_ids = {}
+        self._precinct_rasters = {}
+        self._precinct_index = {}
+        self.precinct_lods = []
         self.thread_lock = Lock()
-        self._thread_queue = Queue()
+        self._mailbox = ReassignmentMailbox()
 
     def start_processing_thread(self):
         self._thread = thread = Thread(
@@ -106,46 +752,55 @@ class VoronoiMapping(object):
         fiducial_identity = [fiducial_ids[key] for key in fiducial_keys]
         unique_ids = list(sorted(set(fiducial_identity)))
 
-        # w, h = self.screen_size
-        # pixel_district_map = np.empty((w, h), dtype=np.uint8)
-        # fill_voronoi_diagram(
-        #     pixel_district_map, w, h, np.array(fiducial_pos, dtype=np.float64),
-        #     np.array(fiducial_identity, dtype=np.uint8))
-        pixel_district_map = self.compute_district_pixels(
-            np.asarray(fiducial_pos), fiducial_identity, unique_ids)
-        precinct_assignment = self.assign_precincts_to_districts(
-            len(unique_ids), pixel_district_map)
-        districts, error = self.create_districts_from_assignment(
-            precinct_assignment, unique_ids)
-        if error:
-            return []
-
-        self.set_districts_boundary(districts)
-
+        key = self.get_cache_key(fiducial_pos, fiducial_identity)
+        entry = self.get_cached_result(key)
+        if entry is None:
+            pixel_district_map, precinct_assignment, counts = \
+                self.compute_assignment(
+                    np.asarray(fiducial_pos), fiducial_identity, unique_ids)
+            districts, error = self.create_districts_from_assignment(
+                precinct_assignment, unique_ids)
+            if error:
+                return []
+
+            self.set_districts_boundary(districts, precinct_assignment)
+            entry = self.cache_result(
+                key, districts, precinct_assignment, pixel_district_map,
+                self.compute_scale, counts)
+
+        districts = entry['districts']
+        precinct_assignment = entry['precinct_assignment']
         self.districts = districts
-        self.pixel_district_map = pixel_district_map
+        self.pixel_district_map = entry['pixel_district_map']
+        self.pixel_district_scale = entry['pixel_district_scale']
+        self.precinct_district_counts = entry['precinct_district_counts']
         for district, precincts in zip(districts, precinct_assignment):
             district.assign_precincts(precincts)
 
         return districts
 
     def post_thread_computation_callback(
-            self, districts, precinct_assignment, pixel_district_map):
+            self, districts, precinct_assignment, pixel_district_map,
+            pixel_district_scale=None, precinct_district_counts=None):
         self.districts = districts
         self.pixel_district_map = pixel_district_map
+        if pixel_district_scale is None:
+            pixel_district_scale = self.compute_scale
+        self.pixel_district_scale = pixel_district_scale
+        self.precinct_district_counts = precinct_district_counts
         for district, precincts in zip(districts, precinct_assignment):
             district.assign_precincts(precincts)
 
     def voronoi_thread_function(self):
         # this thread never modifies any properties of existing precincts or
         # districts to prevent thread safety issues.
-        queue = self._thread_queue
+        mailbox = self._mailbox
         lock = self.thread_lock
         post_callback = self.post_thread_computation_callback
 
         while True:
-            item = queue.get(block=True)
-            if item == 'eof':
+            item = mailbox.get()
+            if item is None:
                 s = io.StringIO()
                 try:
                     ps = pstats.Stats(
@@ -156,14 +811,15 @@ class VoronoiMapping(object):
                     pass
                 return
 
-            callback, callback_if_old, fiducials, fiducial_ids = item
+            epoch, (callback, fiducials, fiducial_ids), token = item
             if fiducials is None:
                 with lock:
                     fiducials = dict(self.fiducial_locations)
                     fiducial_ids = dict(self.fiducial_ids)
 
             if len(fiducials) <= 3:
-                callback([], [], [])
+                mailbox.done()
+                callback([], [], [], epoch=epoch)
                 continue
 
             fiducial_keys = list(fiducials.keys())
@@ -173,102 +829,359 @@ class VoronoiMapping(object):
 
             self._profiler.enable()
             try:
-                pixel_district_map = self.compute_district_pixels(
-                    np.asarray(fiducial_pos), fiducial_identity, unique_ids)
-                if not callback_if_old and queue.qsize():
-                    continue
-
-                precinct_assignment = self.assign_precincts_to_districts(
-                    len(unique_ids), pixel_district_map)
-                if not callback_if_old and queue.qsize():
-                    continue
-
-                districts, error = self.create_districts_from_assignment(
-                    precinct_assignment, unique_ids)
-                if error:
-                    if callback_if_old or not queue.qsize():
-                        callback(districts, [], [], error)
+                key = self.get_cache_key(fiducial_pos, fiducial_identity)
+                entry = self.get_cached_result(key)
+                if entry is not None:
+                    mailbox.done()
+                    districts = entry['districts']
+                    callback(
+                        districts, fiducial_identity, fiducial_pos, [],
+                        post_callback,
+                        (districts, entry['precinct_assignment'],
+                         entry['pixel_district_map'],
+                         entry['pixel_district_scale'],
+                         entry['precinct_district_counts']),
+                        mailbox.is_stale(epoch), epoch=epoch)
                     continue
 
-                self.set_districts_boundary(districts)
-
+                scale = self.get_grid_scale()
+                pixel_district_map, precinct_assignment, counts = \
+                    self.compute_assignment(
+                        np.asarray(fiducial_pos), fiducial_identity,
+                        unique_ids, scale=scale, cancel_token=token)
+                # in progressive mode the coarse result is reported first
+                passes = [(precinct_assignment, counts)]
+                if self.progressive and scale != self.compute_scale:
+                    passes.append(None)
+
+                for i, item in enumerate(passes):
+                    if item is None:
+                        item = self.refine_assignment(cancel_token=token)
+                    precinct_assignment, counts = item
+                    last = i == len(passes) - 1
+
+                    token.check()
+                    districts, error = self.create_districts_from_assignment(
+                        precinct_assignment, unique_ids)
+                    if error:
+                        if last:
+                            mailbox.done()
+                        callback(
+                            districts, [], [], error,
+                            data_is_old=mailbox.is_stale(epoch), epoch=epoch)
+                        continue
+
+                    token.check()
+                    self.set_districts_boundary(districts, precinct_assignment)
+                    if last:
+                        # the cache key is for the assignment at
+                        # compute_scale, so a coarse one that was not
+                        # refined is not cached
+                        if scale == self.compute_scale or len(passes) > 1:
+                            self.cache_result(
+                                key, districts, precinct_assignment,
+                                pixel_district_map, scale, counts)
+                        mailbox.done()
+
+                    callback(
+                        districts, fiducial_identity, fiducial_pos, [],
+                        post_callback,
+                        (districts, precinct_assignment, pixel_district_map,
+                         scale, counts),
+                        mailbox.is_stale(epoch), epoch=epoch)
+
+            except ComputationCancelled:
+                mailbox.done(cancelled=True)
+                continue
             except Exception as e:
                 logging.exception(e)
-                callback([], [], [])
+                mailbox.done()
+                callback([], [], [], epoch=epoch)
                 continue
             finally:
                 self._profiler.disable()
 
-            qsize = queue.qsize()
-            if not callback_if_old and qsize:
-                self._profiler.disable()
-                continue
-
-            callback(
-                districts, fiducial_identity, fiducial_pos, [], post_callback,
-                (districts, precinct_assignment, pixel_district_map),
-                bool(qsize))
-            self._profiler.disable()
-
     def stop_thread(self):
         if self._thread is not None:
-            self._thread_queue.put('eof')
+            self._mailbox.close()
             self._thread.join()
         self._thread = None
 
-    def request_reassignment(
-            self, callback, ignore_if_scheduled=True,
-            callback_if_old=False, current_fiducials=False):
-        if ignore_if_scheduled and self._thread_queue.qsize():
-            return
+        if self._thread_pool is not None:
+            self._thread_pool[0].shutdown()
+            self._thread_pool = None
 
+    def get_num_threads(self):
+        """Returns the number of threads used, from :attr:`num_threads`.
+        """
+        return self.num_threads if self.num_threads > 0 else \
+            os.cpu_count() or 1
+
+    def get_thread_pool(self):
+        """Returns the pool of :meth:`get_num_threads` threads, on which the
+        GIL free kernels are run in parallel. It's created when first needed,
+        and again in processes forked from the process that created it, as
+        they don't have its threads.
+        """
+        pool = self._thread_pool
+        if pool is None or pool[1] != os.getpid():
+            pool = self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.get_num_threads()), os.getpid()
+        return pool[0]
+
+    def request_reassignment(
+            self, callback, callback_if_old=False, current_fiducials=False):
+        """Requests the processing thread to recompute the districts and
+        returns the epoch of the request.
+
+        The request replaces any request that has not been started yet and
+        cancels the computation in progress (see :class:`ReassignmentMailbox`),
+        so only the newest fiducials are computed.
+
+        ``callback`` is called from the thread with the results, as
+        ``callback(districts, fiducial_identity, fiducial_pos, error,
+        post_callback, largs, data_is_old, epoch=epoch)``, where ``epoch`` is
+        the epoch of the request the results were computed for and
+        ``data_is_old`` whether a newer request was posted since.
+
+        :param callback_if_old: If True, this computation is not cancelled by
+            newer requests, so its results are always reported.
+        :param current_fiducials: If True, the fiducials are read now rather
+            than when the thread starts the computation.
+        """
         fiducials = fiducial_ids = None
         if current_fiducials:
-            fiducials = dict(self.fiducial_locations)
-            fiducial_ids = dict(self.fiducial_ids)
+            with self.thread_lock:
+                fiducials = dict(self.fiducial_locations)
+                fiducial_ids = dict(self.fiducial_ids)
 
-        self._thread_queue.put(
-            (callback, callback_if_old, fiducials, fiducial_ids))
+        return self._mailbox.post(
+            (callback, fiducials, fiducial_ids),
+            cancellable=not callback_if_old)
 
-    def set_precincts(self, precincts):
+    def set_precincts(self, precincts, precinct_lods=None):
         """Adds the precincts to be used by the mapping.
 
-        Must be called only (or every time) after :attr:`screen_size` is set.
+        Must be called only (or every time) after :attr:`screen_size` and
+        :attr:`compute_scale` is set.
 
         :param precincts: List of :class:`distopia.precinct.Precinct`
             instances.
+        :param precinct_lods: The optional :attr:`precinct_lods` of the
+            precincts.
         """
-        w, h = self.screen_size
-        precincts = self.precincts = list(precincts)
-        if len(precincts) < 2 ** 8 - 1:
-            dtype = np.uint8
-            f = 'mark_pixels_u8'
-        elif len(precincts) < 2 ** 16 - 1:
-            dtype = np.uint16
-            f = 'mark_pixels_u16'
-        else:
-            raise ValueError('Too many precincts')
+        self.precincts = list(precincts)
+        self.precinct_lods = list(precinct_lods or [])
+        self._precinct_index = {
+            precinct: i for i, precinct in enumerate(self.precincts)}
+        self.precinct_adjacency = None
+        self.precinct_topology = None
+        self._contiguity = None
+        self._precinct_rasters = {}
+        self._last_computation = None
+        if self.reassignment_cache is not None:
+            self.reassignment_cache.clear()
+
+        raster = self.get_precinct_raster()
+        self.pixel_precinct_map = raster.pixel_precinct_map
+        self.precinct_colliders = raster.colliders
+        self.precinct_indices = raster.precinct_indices
+
+    def get_precinct_raster(self, scale=None):
+        """Returns the :class:`~distopia.mapping.raster.PrecinctRaster` of
+        the precincts at ``scale``, creating it if it doesn't exist yet.
+
+        :param scale: The grid scale. Defaults to :attr:`compute_scale`.
+        """
+        if scale is None:
+            scale = self.compute_scale
+        rasters = self._precinct_rasters
+        if scale not in rasters:
+            boundaries = self.get_precinct_boundaries(
+                self.raster_lod_error / scale)
+            if self.raster_cache_path is None:
+                rasters[scale] = PrecinctRaster(
+                    self.precincts, self.screen_size, scale=scale,
+                    boundaries=boundaries, num_threads=self.num_threads)
+            else:
+                path = os.path.join(
+                    self.raster_cache_path, 'raster_{}'.format(
+                        self.get_raster_cache_key(scale, boundaries)))
+                raster = None
+                if os.path.exists(path):
+                    try:
+                        raster = PrecinctRaster.load(path)
+                    except (OSError, ValueError):
+                        # an unreadable raster is rasterized again
+                        shutil.rmtree(path, ignore_errors=True)
+
+                if raster is None:
+                    raster = PrecinctRaster(
+                        self.precincts, self.screen_size, scale=scale,
+                        boundaries=boundaries, num_threads=self.num_threads)
+                    try:
+                        if not os.path.exists(self.raster_cache_path):
+                            os.makedirs(self.raster_cache_path)
+                        raster.save(path)
+                    except OSError:
+                        # e.g. the cache directory is read-only
+                        pass
+                rasters[scale] = raster
+        return rasters[scale]
+
+    def get_raster_cache_key(self, scale, boundaries):
+        """Returns the hex digest identifying the raster of the precincts'
+        ``boundaries`` at ``scale`` in the :attr:`raster_cache_path`.
+
+        It hashes the vertices of all the boundaries, so it changes with the
+        dataset and its simplification, as well as with the
+        :attr:`screen_size`, ``scale`` and
+        :attr:`~distopia.mapping.raster.PrecinctRaster.format_version`.
+        """
+        return self._hash_boundaries(boundaries, (
+            PrecinctRaster.format_version, tuple(self.screen_size),
+            float(scale)))
+
+    def get_topology_cache_key(self):
+        """Returns the hex digest identifying the :attr:`precinct_topology`
+        in the :attr:`raster_cache_path`.
 
-        self.pixel_precinct_map = pixel_precinct_map = np.ones(
-            (w, h), dtype=dtype) * np.iinfo(dtype).max
+        Like :meth:`get_raster_cache_key`, it hashes the vertices of all the
+        precincts' boundaries, along with the :attr:`topology_tolerance` and
+        :attr:`~distopia.precinct.topology.PrecinctTopology.format_version`.
+        """
+        return self._hash_boundaries(
+            [precinct.vertices for precinct in self.precincts],
+            ('topology', PrecinctTopology.format_version,
+             float(self.topology_tolerance)))
 
-        colliders = self.precinct_colliders = [
-            PolygonCollider(
-                points=precinct.boundary, cache=True, rect=(0, 0, w, h)) for
-            precinct in precincts]
+    @staticmethod
+    def _hash_boundaries(boundaries, params):
+        digest = hashlib.sha1()
+        digest.update(repr(params + (len(boundaries), )).encode('utf8'))
+        for boundary in boundaries:
+            boundary = np.asarray(boundary, dtype=np.float64).ravel()
+            digest.update(np.array(len(boundary), dtype=np.int64).tobytes())
+            digest.update(boundary.tobytes())
+        return digest.hexdigest()
+
+    def get_precinct_boundaries(self, tolerance=0):
+        """Returns the flat array of the boundary of each precinct from the
+        least detailed level in :attr:`precinct_lods` whose tolerance is not
+        larger than ``tolerance``, in screen pixels, or of their full
+        :attr:`~distopia.precinct.Precinct.vertices` if there's none.
+
+        E.g. a grid of scale ``s`` is rasterized from the level within
+        ``raster_lod_error / s`` screen pixels, so coarser grids use fewer
+        vertices.
+        """
+        boundaries = None
+        for lod_tolerance, lod_boundaries in self.precinct_lods:
+            if lod_tolerance <= tolerance:
+                boundaries = lod_boundaries
+        if boundaries is None:
+            boundaries = [
+                precinct.vertices.ravel() for precinct in self.precincts]
+        return boundaries
+
+    def get_precinct_adjacency(self):
+        """Returns the :attr:`precinct_adjacency`, creating it from the
+        precincts' neighbours if it's None.
+        """
+        if self.precinct_adjacency is None:
+            self.precinct_adjacency = PrecinctAdjacency.from_precincts(
+                self.precincts)
+        return self.precinct_adjacency
 
-        precinct_indices = self.precinct_indices = []
-        for i, (precinct, collider) in enumerate(zip(precincts, colliders)):
-            getattr(collider, f)(pixel_precinct_map, w, h, i)
+    def get_precinct_topology(self):
+        """Returns the :attr:`precinct_topology`, building it from the
+        precincts' boundaries if it's None.
 
-            x1, y1, x2, y2 = collider.bounding_box()
-            precinct_values = np.zeros(
-                (x2 - x1 + 1, y2 - y1 + 1), dtype=np.uint8)
-            precinct_indices.append((x1, y1, x2 + 1, y2 + 1, precinct_values))
+        If there's a :attr:`raster_cache_path`, it's loaded from there if it
+        was saved before, otherwise it's saved there once built.
+        """
+        if self.precinct_topology is not None:
+            return self.precinct_topology
+
+        topology = path = None
+        if self.raster_cache_path is not None:
+            path = os.path.join(
+                self.raster_cache_path,
+                'topology_{}'.format(self.get_topology_cache_key()))
+            if os.path.exists(path):
+                try:
+                    topology = PrecinctTopology.load(path)
+                except (OSError, ValueError):
+                    shutil.rmtree(path, ignore_errors=True)
+
+        if topology is None:
+            topology = PrecinctTopology.from_precincts(
+                self.precincts, tolerance=self.topology_tolerance)
+            if path is not None:
+                try:
+                    if not os.path.exists(self.raster_cache_path):
+                        os.makedirs(self.raster_cache_path)
+                    topology.save(path)
+                except OSError:
+                    pass
 
-            for x, y in collider.get_inside_points():
-                if 0 <= x < w and 0 <= y < h:
-                    precinct_values[x - x1, y - y1] = 1
+        self.precinct_topology = topology
+        return topology
+
+    def get_cache_key(self, fiducial_pos, fiducials_identity):
+        """Returns the :attr:`reassignment_cache` key of the fiducial
+        configuration, or None if there's no cache.
+        """
+        cache = self.reassignment_cache
+        if cache is None:
+            return None
+        return cache.get_key(
+            fiducial_pos, fiducials_identity,
+            (tuple(self.screen_size), self.compute_scale, self.pixel_engine))
+
+    def get_cached_result(self, key):
+        """Returns the :attr:`reassignment_cache` entry stored for ``key``, or
+        None if there's none.
+
+        On a hit, the last computation is set to the cached one, so that
+        further incremental updates start from the cached results.
+        """
+        if key is None:
+            return None
+        entry = self.reassignment_cache.get(key)
+        if entry is not None:
+            self._last_computation = entry['last_computation']
+        return entry
+
+    def cache_result(
+            self, key, districts, precinct_assignment, pixel_district_map,
+            pixel_district_scale, precinct_district_counts):
+        """Stores the results of the last :meth:`compute_assignment` in the
+        :attr:`reassignment_cache` under ``key`` and returns the entry.
+        """
+        entry = {
+            'districts': districts, 'precinct_assignment': precinct_assignment,
+            'pixel_district_map': pixel_district_map,
+            'pixel_district_scale': pixel_district_scale,
+            'precinct_district_counts': precinct_district_counts,
+            'last_computation': self._last_computation}
+        if key is not None:
+            self.reassignment_cache.put(key, entry)
+        return entry
+
+    def get_grid_scale(self):
+        """Returns the scale of the grid on which the processing thread
+        should compute first.
+
+        It's picked by the :attr:`grid_controller` if there is one, otherwise
+        it's :attr:`coarse_scale` in :attr:`progressive` mode and
+        :attr:`compute_scale` otherwise.
+        """
+        if self.grid_controller is not None:
+            return self.grid_controller.select_scale()
+        if self.progressive:
+            return self.coarse_scale
+        return self.compute_scale
 
     def add_fiducial(self, location, identity):
         """Adds a new fiducial at ``location``.
@@ -325,17 +1238,33 @@ class VoronoiMapping(object):
         :param pos: position.
         :return: The district under the position, or None if none.
         """
-        x, y = map(int, pos)
+        scale = self.pixel_district_scale
+        pixel_precinct_map = self.get_precinct_raster(scale).pixel_precinct_map
+        w, h = pixel_precinct_map.shape
+        x, y = (min(int(val * scale), size - 1) for val, size in
+                zip(pos, (w, h)))
         d_i = self.pixel_district_map[x, y]
-        p_i = self.pixel_precinct_map[x, y]
+        p_i = pixel_precinct_map[x, y]
 
-        if p_i == np.iinfo(self.pixel_precinct_map.dtype).max:
+        if p_i == np.iinfo(pixel_precinct_map.dtype).max:
             return None
 
         return self.districts[d_i]
 
-    @staticmethod
-    def create_districts_from_assignment(precinct_assignment, unique_ids):
+    def create_districts_from_assignment(self, precinct_assignment, unique_ids):
+        """Creates the districts from the precinct assignment, as returned by
+        :meth:`assign_precincts_to_districts`, and checks that they are
+        contiguous.
+
+        The pieces of all the districts are kept in a
+        :class:`~distopia.precinct.adjacency.DistrictContiguity` over the
+        :attr:`precinct_adjacency`, which is updated with only the precincts
+        that changed district since the last call.
+
+        :return: A tuple of the list of new districts and the list of the
+            precincts of all the disconnected district pieces, which is empty
+            if all the districts are contiguous.
+        """
         districts = []
         for i in range(len(precinct_assignment)):
             district = District()
@@ -343,25 +1272,257 @@ class VoronoiMapping(object):
             district.identity = unique_ids[i]
             districts.append(district)
 
-        district_map = {}
+        index = self._precinct_index
+        precinct_districts = np.full(len(self.precincts), -1, dtype=np.int64)
         for i, precincts in enumerate(precinct_assignment):
-            for precinct in precincts:
-                district_map[precinct] = i
+            precinct_districts[[index[p] for p in precincts]] = i
+
+        adjacency = self.get_precinct_adjacency()
+        contiguity = self._contiguity
+        if contiguity is None or contiguity.adjacency is not adjacency:
+            contiguity = self._contiguity = DistrictContiguity(
+                adjacency, precinct_districts)
+        else:
+            contiguity.update(precinct_districts)
 
-        disconnected = []
-        for precincts in precinct_assignment:
-            if len(precincts) <= 1:
+        pieces = contiguity.find_disconnected_pieces()
+        all_precincts = self.precincts
+        disconnected = [
+            all_precincts[i] for piece in pieces for i in piece.tolist()]
+        return districts, disconnected
+
+    def set_districts_boundary(self, districts, precinct_assignment):
+        """Sets the :attr:`~distopia.district.District.boundary` and
+        :attr:`~distopia.district.District.boundaries` of the districts,
+        stitched from the arcs of the :attr:`precinct_topology` between
+        precincts of different districts.
+
+        :param precinct_assignment: The precinct assignment, as returned by
+            :meth:`assign_precincts_to_districts`. It's used rather than the
+            districts' precincts, which are only assigned later, outside the
+            processing thread.
+        """
+        index = self._precinct_index
+        precinct_districts = np.full(len(self.precincts), -1, dtype=np.int64)
+        for i, precincts in enumerate(precinct_assignment):
+            precinct_districts[[index[p] for p in precincts]] = i
+
+        district_rings = self.get_precinct_topology().get_district_rings(
+            precinct_districts, len(districts))
+        for district, rings in zip(districts, district_rings):
+            district.boundaries = [ring.ravel().tolist() for ring in rings]
+            if rings:
+                # the outer ring with the largest area
+                areas = [PrecinctTopology.get_ring_area(ring)
+                         for ring in rings]
+                district.boundary = district.boundaries[int(np.argmax(areas))]
+            else:
+                district.boundary = []
+
+    def compute_assignment(
+            self, fiducials, fiducials_identity, unique_ids, scale=None,
+            cancel_token=None):
+        """Computes the district pixels and assigns the precincts to the
+        districts.
+
+        If :attr:`incremental_update` and only one fiducial moved since the
+        last call, :meth:`update_district_pixels` is used, otherwise the
+        whole map is recomputed with :meth:`compute_district_pixels` and
+        :meth:`compute_precinct_counts`.
+
+        :param scale: The scale of the grid on which to compute. Defaults to
+            :attr:`compute_scale`.
+        :param cancel_token: An optional :class:`CancellationToken`. If it's
+            cancelled, :class:`ComputationCancelled` is raised and the last
+            computation is left unchanged.
+        :return: The ``pixel_district_map``, the precinct assignment as
+            returned by :meth:`assign_precincts_to_districts` and the
+            precinct by district pixel counts.
+        """
+        if scale is None:
+            scale = self.compute_scale
+        raster = self.get_precinct_raster(scale)
+        ts = time.time()
+        fiducials = np.array(fiducials, dtype=np.float64)
+        n_districts = len(unique_ids)
+
+        moved = self.get_moved_fiducial(
+            fiducials, fiducials_identity, unique_ids, scale)
+        if moved is None:
+            pixel_district_map = self.compute_district_pixels(
+                fiducials, fiducials_identity, unique_ids, scale=scale,
+                cancel_token=cancel_token)
+            counts = self.compute_precinct_counts(
+                n_districts, pixel_district_map, raster=raster,
+                cancel_token=cancel_token)
+        else:
+            pixel_district_map, counts = self.update_district_pixels(
+                moved, fiducials, fiducials_identity, unique_ids,
+                cancel_token=cancel_token)
+
+        margins = np.empty(len(self.precincts), dtype=np.float64)
+        precinct_districts = self.compute_precinct_districts(
+            counts, pixel_district_map, margins=margins, raster=raster,
+            cancel_token=cancel_token)
+
+        self._last_computation = {
+            'screen_size': self.screen_size, 'scale': scale,
+            'fiducials': fiducials, 'identity': list(fiducials_identity),
+            'unique_ids': list(unique_ids),
+            'pixel_district_map': pixel_district_map, 'counts': counts,
+            'precinct_districts': precinct_districts, 'margins': margins}
+
+        # only full recomputes are timed, the incremental updates are much
+        # cheaper and would make a scale look faster than it is
+        if self.grid_controller is not None and moved is None:
+            self.grid_controller.record(scale, time.time() - ts)
+        return pixel_district_map, self.get_precinct_assignment(
+            n_districts, precinct_districts), counts
+
+    def refine_assignment(self, cancel_token=None):
+        """Recomputes at :attr:`compute_scale` the district of the precincts
+        whose vote was close, i.e. with a lead smaller than
+        :attr:`refine_margin`, in the last :meth:`compute_assignment`.
+
+        The counts of the refined precincts are rescaled to the grid of the
+        last computation. They are kept apart from the counts of the last
+        computation, which must stay the exact counts of its
+        ``pixel_district_map`` for :meth:`update_district_pixels`. If the
+        optional :class:`CancellationToken` ``cancel_token`` is cancelled,
+        :class:`ComputationCancelled` is raised, keeping the precincts
+        refined so far.
+
+        :return: The refined precinct assignment as returned by
+            :meth:`assign_precincts_to_districts` and the pixel counts.
+        """
+        last = self._last_computation
+        n_districts = len(last['unique_ids'])
+        precinct_districts = last['precinct_districts'] = np.array(
+            last['precinct_districts'])
+        margins = last['margins'] = np.array(last['margins'])
+        counts = last['refined_counts'] = np.array(
+            last.get('refined_counts', last['counts']))
+        if last['scale'] == self.compute_scale:
+            return self.get_precinct_assignment(
+                n_districts, precinct_districts), counts
+
+        raster = self.get_precinct_raster()
+        scale = raster.scale
+        area_ratio = (last['scale'] / float(scale)) ** 2
+        sites = last['fiducials'] * scale
+        site_district = np.array(
+            [last['unique_ids'].index(identity)
+             for identity in last['identity']], dtype=np.uint8)
+        bins = np.empty((n_districts, ), dtype=np.uint64)
+
+        for i in np.flatnonzero(margins < self.refine_margin):
+            _check_cancelled(cancel_token)
+            x0, y0, x1, y1, mask = raster.precinct_indices[i]
+            labels = np.empty((x1 - x0, y1 - y0), dtype=np.uint8)
+            fill_voronoi_scanline(
+                labels, sites, site_district, x_offset=x0, y_offset=y0,
+                num_threads=1, cancel=_cancel_flag(cancel_token))
+            _check_cancelled(cancel_token)
+
+            bins[:] = 0
+            district_i = PolygonCollider.get_arg_max_count(
+                labels, mask, bins, n_districts, x1 - x0, y1 - y0,
+                2 ** 8 - 1)
+            if district_i != 2 ** 8 - 1:
+                precinct_districts[i] = district_i
+                counts[i, :] = np.round(bins * area_ratio)
+            # it's now computed at the final resolution
+            margins[i] = 1
+
+        return self.get_precinct_assignment(
+            n_districts, precinct_districts), counts
+
+    def get_moved_fiducial(
+            self, fiducials, fiducials_identity, unique_ids, scale=None):
+        """Returns the index of the only fiducial that moved since the last
+        :meth:`compute_assignment` at the same ``scale``, or None if it's not
+        the only change or if :attr:`incremental_update` is False.
+        """
+        last = self._last_computation
+        if not self.incremental_update or last is None:
+            return None
+
+        if scale is None:
+            scale = self.compute_scale
+        last_fiducials = last['fiducials']
+        if last['screen_size'] != self.screen_size or \
+                last['scale'] != scale or \
+                last['identity'] != list(fiducials_identity) or \
+                last['unique_ids'] != list(unique_ids) or \
+                last_fiducials.shape != fiducials.shape:
+            return None
+
+        moved = np.flatnonzero(np.any(last_fiducials != fiducials, axis=1))
+        if len(moved) != 1:
+            return None
+        return int(moved[0])
+
+    def update_district_pixels(
+            self, fiducial, fiducials, fiducials_identity, unique_ids,
+            cancel_token=None):
+        """Incrementally updates the results of the last
+        :meth:`compute_assignment` when only ``fiducial`` (its index) moved.
+
+        Only pixels within the old or new voronoi cell of the fiducial may
+        change district, so only the bounding boxes of these cells are
+        relabeled. The pixel counts of these boxes are subtracted before and
+        added back after relabeling them. The last computation is not
+        modified.
+
+        Returns the new ``pixel_district_map`` and the precinct by district
+        pixel counts.
+        """
+        last = self._last_computation
+        # the previous results may still be used elsewhere
+        pixel_district_map = np.array(last['pixel_district_map'])
+        old_counts = np.array(last['counts'], dtype=np.int64)
+        counts = np.zeros(old_counts.shape, dtype=np.uint32)
+
+        raster = self.get_precinct_raster(last['scale'])
+        cancel = _cancel_flag(cancel_token)
+        pixel_precinct_map = raster.pixel_precinct_map
+        w, h = raster.size
+        sites = fiducials * raster.scale
+        site_district = np.array(
+            [unique_ids.index(identity) for identity in fiducials_identity],
+            dtype=np.uint8)
+
+        for cell_sites in (last['fiducials'] * raster.scale, sites):
+            cell = voronoi_cell_polygon(
+                cell_sites, fiducial, (0, 0, w - 1, h - 1))
+            if not len(cell):
                 continue
 
-            disconnected = Precinct.find_disconnected_precincts(
-                precincts, district_map)
-            if disconnected:
-                break
+            # pad by a pixel in case of rounding errors at the cell boundary
+            x1, y1 = np.maximum(
+                np.floor(cell.min(axis=0)) - 1, 0).astype(np.int64)
+            x2, y2 = np.ceil(cell.max(axis=0)).astype(np.int64) + 2
+            x2, y2 = min(x2, w), min(y2, h)
 
-        return districts, disconnected
+            counts[:] = 0
+            count_precinct_districts(
+                pixel_precinct_map[x1:x2, y1:y2],
+                pixel_district_map[x1:x2, y1:y2], counts, cancel=cancel)
+            old_counts -= counts
 
-    def set_districts_boundary(self, districts):
-        pass
+            fill_voronoi_scanline(
+                pixel_district_map[x1:x2, y1:y2], sites, site_district,
+                x_offset=x1, y_offset=y1, num_threads=self.num_threads,
+                cancel=cancel)
+
+            counts[:] = 0
+            count_precinct_districts(
+                pixel_precinct_map[x1:x2, y1:y2],
+                pixel_district_map[x1:x2, y1:y2], counts, cancel=cancel)
+            old_counts += counts
+            _check_cancelled(cancel_token)
+
+        return pixel_district_map, old_counts.astype(np.uint32)
 
     def assign_precincts_to_districts(self, n_districts, pixel_district_map):
         """Uses the pre-computed precinct and district maps and assigns
@@ -371,27 +1532,184 @@ class VoronoiMapping(object):
         district identity index in `unique_ids` as filled into
         pixel_district_map.
         """
-        precincts = self.precincts
-        precinct_assignment = [[] for _ in range(n_districts)]
+        counts = self.compute_precinct_counts(n_districts, pixel_district_map)
+        return self.get_precinct_assignment(
+            n_districts,
+            self.compute_precinct_districts(counts, pixel_district_map))
+
+    def compute_precinct_counts(
+            self, n_districts, pixel_district_map, raster=None,
+            cancel_token=None):
+        """Counts the number of pixels of each precinct in each district, in
+        a single pass over the precinct and district maps.
+
+        The maps are split into blocks of columns that are counted in
+        parallel on the :meth:`get_thread_pool`, each into its own counts,
+        which are then summed, so the result doesn't depend on the number of
+        threads.
+
+        :param raster: The :class:`~distopia.mapping.raster.PrecinctRaster`
+            on whose grid ``pixel_district_map`` was computed. Defaults to
+            the one at :attr:`compute_scale`.
+        :return: A number of precincts by number of districts uint32 matrix.
+        """
+        if raster is None:
+            raster = self.get_precinct_raster()
+        pixel_precinct_map = raster.pixel_precinct_map
+        shape = len(self.precincts), n_districts
+        cancel = _cancel_flag(cancel_token)
+
+        w, h = pixel_precinct_map.shape
+        n = min(self.get_num_threads(), w * h // self.min_thread_pixels)
+        if n <= 1:
+            counts = np.zeros(shape, dtype=np.uint32)
+            count_precinct_districts(
+                pixel_precinct_map, pixel_district_map, counts, cancel=cancel)
+        else:
+            bounds = np.linspace(0, w, n + 1).astype(np.int64).tolist()
+            block_counts = np.zeros((n, ) + shape, dtype=np.uint32)
+
+            def count(i):
+                s, e = bounds[i], bounds[i + 1]
+                count_precinct_districts(
+                    pixel_precinct_map[s:e], pixel_district_map[s:e],
+                    block_counts[i], cancel=cancel)
+
+            list(self.get_thread_pool().map(count, range(n)))
+            counts = block_counts.sum(axis=0, dtype=np.uint32)
+        _check_cancelled(cancel_token)
+        return counts
+
+    def compute_precinct_districts(
+            self, counts, pixel_district_map, margins=None, raster=None,
+            cancel_token=None):
+        """Computes the district index of each precinct from the pixel
+        counts as returned by :meth:`compute_precinct_counts`.
+
+        Each precinct is assigned to the district with the most pixels, or
+        the first of them on ties. Pixels shared by overlapping precincts
+        are only counted for one of them in the counts, so a precinct
+        without any pixels in the counts is counted instead using its own
+        mask.
+
+        :param margins: If not None, an array into which the lead of the
+            winning district over the second, as a fraction of the precinct's
+            pixels, is written for each precinct.
+        :param raster: The :class:`~distopia.mapping.raster.PrecinctRaster`
+            on whose grid ``pixel_district_map`` was computed. Defaults to
+            the one at :attr:`compute_scale`.
+        :return: The array with the district index of each precinct, or -1
+            if it's under no district.
+        """
+        if raster is None:
+            raster = self.get_precinct_raster()
+        n_districts = counts.shape[1]
+        totals = counts.sum(axis=1)
+        precinct_districts = np.argmax(counts, axis=1).astype(np.int16)
+        precinct_districts[totals == 0] = -1
 
         bins = np.empty((n_districts, ), dtype=np.uint64)
-        for i, (precinct, (x0, y0, x1, y1, mask), collider) in enumerate(
-                zip(precincts, self.precinct_indices, self.precinct_colliders)):
+        for i in np.flatnonzero((totals == 0) & (raster.mask_sizes > 0)):
+            _check_cancelled(cancel_token)
+            x0, y0, x1, y1, mask = raster.precinct_indices[i]
             bins[:] = 0
-            district_i = collider.get_arg_max_count(
+            district_i = PolygonCollider.get_arg_max_count(
                 pixel_district_map[x0:x1, y0:y1],
                 mask, bins, n_districts,
                 x1 - x0, y1 - y0, 2 ** 8 - 1)
-
-            if district_i == 2 ** 8 - 1:
+            if district_i != 2 ** 8 - 1:
+                precinct_districts[i] = district_i
+
+        if margins is not None:
+            margins[:] = 1
+            if n_districts >= 2:
+                top = np.partition(counts, n_districts - 2, axis=1)[:, -2:]
+                has_pixels = totals > 0
+                margins[has_pixels] = \
+                    (top[has_pixels, 1].astype(np.float64) -
+                     top[has_pixels, 0]) / totals[has_pixels]
+        return precinct_districts
+
+    def get_precinct_assignment(self, n_districts, precinct_districts):
+        """Converts the precinct districts as returned by
+        :meth:`compute_precinct_districts` into a list of precincts, per
+        district.
+        """
+        precinct_assignment = [[] for _ in range(n_districts)]
+        for precinct, district_i in zip(
+                self.precincts, precinct_districts.tolist()):
+            if district_i == -1:
                 print('Got precinct under no district', precinct.identity)
                 continue
 
             precinct_assignment[district_i].append(precinct)
         return precinct_assignment
 
+    def compute_batch_assignment(
+            self, fiducials, fiducials_district, n_districts, scale=None,
+            sample_step=1, block_size=4096):
+        """Assigns the precincts to districts for many fiducial
+        configurations at once, with numpy.
+
+        The nearest fiducial is computed, for all the configurations, for the
+        precinct mask pixels as returned by
+        :meth:`~distopia.mapping.raster.PrecinctRaster.get_sample_pixels`,
+        rather than for all the pixels. Each precinct is assigned to the
+        district of most of its samples, like
+        :meth:`assign_precincts_to_districts` does with the full map.
+
+        :param fiducials: A configurations by fiducials by 2 array of the
+            fiducials' screen positions. Configurations with fewer
+            fiducials are padded with NaN (or inf) positions.
+        :param fiducials_district: A configurations by fiducials (or just
+            fiducials, if shared) int array of the district index, in
+            ``0..n_districts - 1``, of each fiducial.
+        :param n_districts: The number of districts.
+        :param scale: The scale of the grid whose pixels are sampled. Defaults
+            to :attr:`compute_scale`.
+        :param sample_step: Only every ``sample_step`` pixel in ``x`` and
+            ``y`` is sampled.
+        :param block_size: The number of samples processed at once, which
+            bounds the memory used.
+        :return: A configurations by precincts int16 array of the district
+            index of each precinct, or -1 if it's under no district.
+        """
+        raster = self.get_precinct_raster(scale)
+        sites = np.array(fiducials, dtype=np.float64) * raster.scale
+        sites[~np.isfinite(sites)] = np.inf
+        n_configs, n_sites = sites.shape[:2]
+        site_district = np.broadcast_to(
+            np.asarray(fiducials_district, dtype=np.int64),
+            (n_configs, n_sites))
+
+        positions, sample_precincts = raster.get_sample_pixels(sample_step)
+        n_samples = len(positions)
+        n_precincts = len(self.precincts)
+
+        labels = np.empty((n_configs, n_samples), dtype=np.int64)
+        for start in range(0, n_samples, block_size):
+            end = min(start + block_size, n_samples)
+            dist = (sites[:, :, 0:1] - positions[start:end, 0]) ** 2
+            dist += (sites[:, :, 1:2] - positions[start:end, 1]) ** 2
+            # on ties the fiducial listed first wins
+            labels[:, start:end] = np.take_along_axis(
+                site_district, np.argmin(dist, axis=1), axis=1)
+
+        counts = np.empty((n_configs, n_precincts, n_districts), dtype=np.int64)
+        sample_bins = sample_precincts * n_districts
+        for i in range(n_configs):
+            counts[i] = np.bincount(
+                sample_bins + labels[i],
+                minlength=n_precincts * n_districts).reshape(
+                    (n_precincts, n_districts))
+
+        assignment = np.argmax(counts, axis=2).astype(np.int16)
+        assignment[counts.sum(axis=2) == 0] = -1
+        return assignment
+
     def compute_district_pixels(
-            self, fiducials, fiducials_identity, unique_ids):
+            self, fiducials, fiducials_identity, unique_ids, scale=None,
+            cancel_token=None):
         """Computes the assignment of pixels to districts and creates the
         associated districts.
 
@@ -399,168 +1717,140 @@ class VoronoiMapping(object):
         correspond to each other. All ids must be in unique ids.
         pixel_district_map is filled in with the index of the district
         identity in unique_ids to make it 0-n-1.
+
+        The engine used is selected with :attr:`pixel_engine`. The map is
+        computed on the grid of ``scale`` (defaults to
+        :attr:`compute_scale`), with the fiducials given in screen
+        coordinates. :class:`ComputationCancelled` is raised if the optional
+        :class:`CancellationToken` ``cancel_token`` is cancelled.
         """
-        t0 = time.clock()
-        vor = Voronoi(fiducials)
-        t1 = time.clock()
-        regions, vertices = self.voronoi_finite_polygons_2d(vor)
-        t2 = time.clock()
-        assert len(regions) <= 2 ** 8 - 2
-        w, h = self.screen_size
+        if scale is None:
+            scale = self.compute_scale
+        size = get_grid_size(self.screen_size, scale)
+        fiducials = np.asarray(fiducials, dtype=np.float64) * scale
+
+        engine = self.pixel_engine
+        if engine == 'collider':
+            f = self.compute_district_pixels_collider
+        elif engine == 'nearest':
+            f = self.compute_district_pixels_nearest
+        elif engine == 'scanline':
+            f = self.compute_district_pixels_scanline
+        else:
+            raise ValueError('Unknown pixel engine "{}"'.format(engine))
+        pixel_district_map = f(
+            fiducials, fiducials_identity, unique_ids, size,
+            cancel_token=cancel_token)
+        _check_cancelled(cancel_token)
+        return pixel_district_map
+
+    def compute_district_pixels_collider(
+            self, fiducials, fiducials_identity, unique_ids, size=None,
+            cancel_token=None):
+        """The ``'collider'`` :attr:`pixel_engine`. Builds the voronoi
+        polygons and rasterizes each of them with a
+        :class:`~distopia.mapping._voronoi.PolygonCollider`.
+        """
+        w, h = size or self.screen_size
+        vertices, offsets = clipped_voronoi_polygons(
+            fiducials, (-.5, -.5, w - .5, h - .5))
+        assert len(offsets) - 1 <= 2 ** 8 - 2
         pixel_district_map = np.ones((w, h), dtype=np.uint8) * (2 ** 8 - 1)
 
         colliders = []
-        for i, region_indices in enumerate(regions):
-            poly = list(map(float, vertices[region_indices].reshape((-1, ))))
-            collider = PolygonCollider(points=poly, cache=True, rect=(0, 0, w, h))
-            colliders.append(collider)
-
-        t3 = time.clock()
-        for i, (region_indices, collider) in enumerate(zip(regions, colliders)):
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            poly = vertices[start:end]
+            colliders.append(PolygonCollider(
+                points=poly, cache=True, rect=(0, 0, w, h))
+                if len(poly) else None)
+
+        for i, collider in enumerate(colliders):
+            _check_cancelled(cancel_token)
+            if collider is None:
+                continue
             idx = unique_ids.index(fiducials_identity[i])
             collider.mark_pixels_u8(pixel_district_map, w, h, idx)
 
-        t4 = time.clock()
-        # print("{:0.5f}, {:0.5f}, {:0.5f}, {:0.5f}".format(t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         return pixel_district_map
 
-    def voronoi_finite_polygons_2d(self, vor):
+    def compute_district_pixels_nearest(
+            self, fiducials, fiducials_identity, unique_ids, size=None,
+            cancel_token=None):
+        """The ``'nearest'`` :attr:`pixel_engine`. Labels every pixel with
+        the district of its nearest fiducial.
+
+        The squared distances are computed with numpy in blocks of
+        :attr:`nearest_block_size` columns, so memory stays bounded. On ties
+        the fiducial listed first wins.
         """
-        Reconstruct infinite voronoi regions in a 2D diagram to finite
-        regions.
-
-        based on https://stackoverflow.com/a/20678647.
-
-        Parameters
-        ----------
-        vor : Voronoi
-            Input diagram
-
-        Returns
-        -------
-        regions : list of tuples
-            Indices of vertices in each revised Voronoi regions.
-        vertices : list of tuples
-            Coordinates for revised Voronoi vertices. Same as coordinates
-            of input vertices, with 'points at infinity' appended to the
-            end.
-
-        """
-        new_regions = []
-        orig_vertices = vor.vertices.tolist()
-        new_vertices = list(orig_vertices)
-        # list of tuple of indices in orig_vertices, each describing a ridge
-        # made by a pair of returned vertices
-        ridge_vertices = vor.ridge_vertices
-        # list of tuples, each two indices in points. They describe a ridge
-        # perpendicular to their line
-        ridge_points = vor.ridge_points
-        assert len(ridge_vertices) == len(ridge_points)
-        # list of tuple, each a point passed by the user
-        points = vor.points
-        # for each point in points, it's the index in regions that contains it
-        point_region = vor.point_region
-        assert len(points) == len(point_region)
-        # list of lists, each is indices in orig_vertices making the polygon
-        regions = vor.regions
-        assert len(points) == len([r for r in regions if r])
-
-        center = vor.points.mean(axis=0)
-        w, h = self.screen_size
-        radius = 100 * max(w, h)
-
-        # Construct a map containing all ridges for a given point
-        # for every point it lists all counter points and vertices between them
-        all_ridges = defaultdict(list)
-        for (p1, p2), (v1, v2) in zip(ridge_points, ridge_vertices):
-            # points p1, p2 will have the same vertices between them
-            all_ridges[p1].append((p1, p2, v1, v2))
-            all_ridges[p2].append((p1, p2, v1, v2))
-
-        # compute the polygons for each region
-        for p1, region in enumerate(point_region):
-            # The region polygon. First get all vertices for the region within
-            # the screen
-            region_vertices = []
-            for v in regions[region]:
-                # skip infinite vertices
-                if v < 0:
-                    continue
+        assert len(unique_ids) <= 2 ** 8 - 2
+        w, h = size or self.screen_size
+        fiducials = np.asarray(fiducials, dtype=np.float64)
+        site_district = np.array(
+            [unique_ids.index(identity) for identity in fiducials_identity],
+            dtype=np.uint8)
+        pixel_district_map = np.empty((w, h), dtype=np.uint8)
+
+        block = self.nearest_block_size
+        dy2 = (np.arange(h, dtype=np.float64)[np.newaxis, :] -
+               fiducials[:, 1:2]) ** 2
+        dist = np.empty((block, h), dtype=np.float64)
+        min_dist = np.empty((block, h), dtype=np.float64)
+        closer = np.empty((block, h), dtype=np.bool_)
+
+        for x0 in range(0, w, block):
+            _check_cancelled(cancel_token)
+            x1 = min(x0 + block, w)
+            n = x1 - x0
+            dx2 = (np.arange(x0, x1, dtype=np.float64)[np.newaxis, :] -
+                   fiducials[:, 0:1]) ** 2
+            labels = pixel_district_map[x0:x1]
+            best = min_dist[:n]
+            np.add.outer(dx2[0], dy2[0], out=best)
+            labels[:] = site_district[0]
+
+            for i in range(1, len(fiducials)):
+                np.add.outer(dx2[i], dy2[i], out=dist[:n])
+                np.less(dist[:n], best, out=closer[:n])
+                np.minimum(best, dist[:n], out=best)
+                np.copyto(labels, site_district[i], where=closer[:n])
 
-                # skip vertices outside the screen
-                # x, y = orig_vertices[v]
-                # if not (0 <= x <= w - 1 and 0 <= y <= h - 1):
-                #     continue
-                region_vertices.append(
-                    [(None, None), None, v, orig_vertices[v]])
-
-            # all the ridges that make the region
-            for p1_, p2_, v1, v2 in all_ridges[p1]:
-                # if the second point of the ridge is infinite,
-                # one and only one of the vertex indices will be -1
-                if v2 < 0:
-                    v1, v2 = v2, v1
-                if v1 >= 0:
-                    assert v2 >= 0
-                    # x1, y1 = orig_vertices[v1]
-                    # x2, y2 = orig_vertices[v2]
-                    #
-                    # # assume that if a vertex is outside the screen,
-                    # # the other vertex must be on the other side of the p1-p2
-                    # # perpendicular
-                    # if not (0 <= x1 <= w - 1 and 0 <= y1 <= h - 1):
-                    #     region_vertices.append(
-                    #         [[x2, y2], [x1 - x2, y1 - y2], None, [x1, y1]])
-                    # if not (0 <= x2 <= w - 1 and 0 <= y2 <= h - 1):
-                    #     region_vertices.append(
-                    #         [[x1, y1], [x2 - x1, y2 - y1], None, [x2, y2]])
+        return pixel_district_map
 
-                    continue
-                # assume that if there's an infinite point, the pair will be
-                # within the screen boundary
-                assert v2 >= 0
-
-                # Compute the missing endpoint of an infinite ridge
-
-                t = vor.points[p2_] - vor.points[p1_]  # tangent
-                t /= np.linalg.norm(t)
-                # normal, facing to the left of the line between p1 - p2
-                n = np.array([-t[1], t[0]])
-
-                # find midpoint between the two points
-                midpoint = vor.points[[p1_, p2_]].mean(axis=0)
-                # find whether the normal points in the same direction as the
-                # line made by the center of the voronoi points with midpoint.
-                # If it faces the opposite direction, reorient to face from
-                # the center to midpoint direction (i.e. away from the center)
-                # It will be the same for p1, and p2 when we encounter each
-                # this ensures that we get the same far point for each
-                direction = np.sign(np.dot(midpoint - center, n)) * n
-                # add a point very far from the last point
-                far_point = orig_vertices[v2] + direction * radius
-                region_vertices.append(
-                    [orig_vertices[v2], direction, None, far_point])
-
-            # for (x1, y1), direction, v, (x2, y2) in temp_vertices:
-            #     if v is not None:
-            #         assert x2 >= 0 and y2 >= 0
-            # finish
-
-            vs = np.asarray([v[3] for v in region_vertices])
-            c = vs.mean(axis=0)
-            angles = np.arctan2(vs[:, 1] - c[1], vs[:, 0] - c[0])
-            region_vertices = [region_vertices[i] for i in np.argsort(angles)]
-
-            region_verts_i = []
-            for i, item in enumerate(region_vertices):
-                if item[1] is None:
-                    region_verts_i.append(item[2])
-                else:
-                    region_verts_i.append(len(new_vertices))
-                    new_vertices.append(item[3])
-
-            new_regions.append(region_verts_i)
-
-        # region is sorted according to points order
-        new_vertices = np.asarray(new_vertices)
-        return new_regions, new_vertices
+    def compute_district_pixels_scanline(
+            self, fiducials, fiducials_identity, unique_ids, size=None,
+            cancel_token=None):
+        """The ``'scanline'`` :attr:`pixel_engine`. Labels every pixel with
+        the district of its nearest fiducial using
+        :func:`~distopia.mapping._voronoi.fill_voronoi_scanline`.
+        """
+        assert len(unique_ids) <= 2 ** 8 - 2
+        w, h = size or self.screen_size
+        site_district = np.array(
+            [unique_ids.index(identity) for identity in fiducials_identity],
+            dtype=np.uint8)
+        pixel_district_map = np.empty((w, h), dtype=np.uint8)
+        fill_voronoi_scanline(
+            pixel_district_map,
+            np.ascontiguousarray(fiducials, dtype=np.float64), site_district,
+            num_threads=self.num_threads, cancel=_cancel_flag(cancel_token))
+        return pixel_district_map
+
+    def voronoi_finite_polygons_2d(self, vor):
+        """Converts the voronoi diagram of the fiducials into finite regions,
+        each clipped to the screen.
+
+        See :func:`clipped_voronoi_polygons`, which this wraps.
+
+        :param vor: The scipy :class:`~scipy.spatial.Voronoi` diagram of the
+            fiducials (only its ``points`` are used).
+        :return: A tuple of a list with an array of the indices in
+            ``vertices`` of each region's polygon, in the order of the points,
+            and the nx2 array of ``vertices``.
+        """
+        w, h = self.screen_size
+        vertices, offsets = clipped_voronoi_polygons(
+            vor.points, (-.5, -.5, w - .5, h - .5))
+        regions = [np.arange(start, end) for start, end in
+                   zip(offsets[:-1], offsets[1:])]
+        return regions, vertices
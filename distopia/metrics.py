@@ -4,7 +4,9 @@ States Metrics
 
 Defines metrics that summarize the state based on the districts.
 """
-__all__ = ('StateMetric', )
+import numpy as np
+
+__all__ = ('StateMetric', 'StateScalarMetric', 'StateMetricSuite')
 
 
 class StateMetric(object):
@@ -24,3 +26,167 @@ class StateMetric(object):
 
     def compute(self):
         raise NotImplementedError
+
+
+class StateScalarMetric(StateMetric):
+    """A state metric with a single value, computed together with the other
+    state metrics by :meth:`StateMetricSuite.create_state_metrics`.
+    """
+
+    value = 0
+
+    def __init__(self, value=0, **kwargs):
+        super(StateScalarMetric, self).__init__(**kwargs)
+        self.value = value
+
+    def compute(self):
+        # the value is computed by the suite when the metric is created
+        pass
+
+
+class StateMetricSuite(object):
+    """Computes all the state metrics in one vectorized pass over the
+    districts' aggregated metrics.
+
+    The metrics are:
+
+    ``'population_deviation'``
+        The largest deviation of a district's population from the mean
+        district population, as a fraction of the mean.
+    ``'efficiency_gap'``
+        The difference between the first and second party's wasted votes,
+        as a fraction of all the votes. Votes for the loser and votes above
+        half for the winner are wasted, so a positive gap favors the second
+        party.
+    ``'mean_median'``
+        The median minus the mean of the first party's two-party vote share
+        in the districts. A negative difference disadvantages the first
+        party.
+    ``'seat_share'``
+        The fraction of the districts the first party wins.
+    ``'majority_minority'``
+        The number of districts where the majority group is less than half
+        of the population.
+
+    Metrics whose district metrics are not available are skipped.
+    """
+
+    population_metric = 'population'
+    """The district metric with the population.
+    """
+
+    population_label = 'population-total'
+    """The label of the total population in :attr:`population_metric`.
+    """
+
+    voters_label = 'population-voting'
+    """The label of the voting age population in :attr:`population_metric`,
+    which scales the vote shares to votes.
+    """
+
+    votes_metric = 'projected_votes'
+    """The district metric with the (population weighted mean) vote shares
+    of the parties.
+    """
+
+    party_labels = ('2016-democrat', '2016-republican')
+    """The labels of the first and second party's vote shares in
+    :attr:`votes_metric`.
+    """
+
+    race_metric = 'race'
+    """The district metric with the population of each racial group.
+    """
+
+    majority_label = 'population-white'
+    """The label of the majority group in :attr:`race_metric`.
+    """
+
+    @staticmethod
+    def get_district_data(districts, name, label):
+        """Returns the array with the value of ``label`` in the histogram
+        metric ``name`` of each district, or None if not all districts have
+        it.
+        """
+        data = []
+        for district in districts:
+            metric = district.metrics.get(name)
+            if metric is None or label not in metric.labels:
+                return None
+            data.append(metric.data[metric.labels.index(label)]
+                        if len(metric.data) else 0)
+        return np.array(data, dtype=np.float64)
+
+    def compute(self, districts):
+        """Computes the state metrics of the districts.
+
+        :return: A dict mapping metric name to its value.
+        """
+        values = {}
+        if not districts:
+            return values
+
+        population = self.get_district_data(
+            districts, self.population_metric, self.population_label)
+        if population is not None:
+            mean = population.mean()
+            values['population_deviation'] = \
+                float(np.max(np.abs(population - mean)) / mean) if mean else 0.
+
+        first, second = [
+            self.get_district_data(districts, self.votes_metric, label)
+            for label in self.party_labels]
+        if first is not None and second is not None:
+            voters = self.get_district_data(
+                districts, self.population_metric, self.voters_label)
+            if voters is None:
+                voters = population
+            if voters is not None:
+                first = first * voters
+                second = second * voters
+            values.update(self.compute_vote_metrics(first, second))
+
+        race = [district.metrics.get(self.race_metric)
+                for district in districts]
+        if all(metric is not None and self.majority_label in metric.labels
+               for metric in race):
+            i = race[0].labels.index(self.majority_label)
+            race = np.array(
+                [metric.data if len(metric.data) else
+                 np.zeros(len(metric.labels)) for metric in race],
+                dtype=np.float64)
+            totals = race.sum(axis=1)
+            values['majority_minority'] = int(np.count_nonzero(
+                (totals > 0) & (race[:, i] * 2 < totals)))
+        return values
+
+    @staticmethod
+    def compute_vote_metrics(first, second):
+        """Computes the vote based metrics from the arrays of the first and
+        second party's votes in each district. Districts without votes are
+        ignored.
+        """
+        has_votes = (first + second) > 0
+        first, second = first[has_votes], second[has_votes]
+        if not len(first):
+            return {}
+
+        totals = first + second
+        first_wins = first > second
+        wasted_first = np.where(first_wins, first - totals / 2., first)
+        wasted_second = np.where(first_wins, second, second - totals / 2.)
+        share = first / totals
+        return {
+            'efficiency_gap': float(
+                (wasted_first.sum() - wasted_second.sum()) / totals.sum()),
+            'mean_median': float(np.median(share) - np.mean(share)),
+            'seat_share': float(np.mean(first_wins)),
+        }
+
+    def create_state_metrics(self, districts):
+        """Computes the state metrics of the districts and returns them as a
+        list of :class:`StateScalarMetric`.
+        """
+        return [
+            StateScalarMetric(name=name, districts=districts, value=value)
+            for name, value in self.compute(districts).items()]
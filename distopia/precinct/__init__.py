@@ -3,61 +3,567 @@ Precinct
 =========
 
 :class:`Precinct` defines a precinct and it's immutable data.
+
+The data of all the precincts is stored column by column in a
+:class:`PrecinctTable`, and each :class:`Precinct` is a light view onto one
+row of its table.
 """
 
 from collections import deque, defaultdict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import numpy as np
 
-__all__ = ('Precinct', )
+from distopia.precinct.metrics import PrecinctHistogram, PrecinctScalar, \
+    PrecinctCategory
+from distopia.precinct.adjacency import PrecinctAdjacency
 
+__all__ = ('Precinct', 'PrecinctTable')
 
-class Precinct(object):
+
+class PrecinctTable(object):
+    """Stores the data of many precincts as a struct of arrays, one row per
+    precinct.
+
+    Rather than each precinct holding its own lists and dicts, the
+    boundaries are stored in one flat vertex buffer, the neighbours as a CSR
+    graph, the districts as an array of indices and each metric as a single
+    matrix with labels shared by all the precincts.
     """
-    Describes a precinct and its data.
+
+    identities = None
+    """The int64 array of the :attr:`Precinct.identity` of each precinct.
     """
 
-    name = ''
-    """Name describing the precinct.
+    names = None
+    """The numpy string array of the :attr:`Precinct.name` of each precinct.
     """
 
-    identity = 0
-    """The id of the precinct. """
+    locations = None
+    """The nx2 float64 array of the :attr:`Precinct.location` of each
+    precinct, which defaults to the mean of its boundary vertices.
+    """
 
-    boundary = []
-    """A nx2 list of the ``x``, ``y`` coordinates of the polygon that
-    describes the precinct's boundary.
+    vertices = None
+    """The mx2 float64 array of the boundary vertices of all the precincts.
+    The vertices of precinct ``i`` are
+    ``vertices[vertex_offsets[i]:vertex_offsets[i + 1]]``.
     """
 
-    location = (0, 0)
-    """The (practically unique) center location of the precinct.
+    vertex_offsets = None
+    """The n + 1 int64 array of the offsets into :attr:`vertices` of each
+    precinct's boundary.
     """
 
-    neighbours = []
-    """List of other :class:`Precinct`'s that are on the boundary of this
-    precinct.
+    neighbour_indptr = None
+    """The n + 1 int64 array of the offsets into :attr:`neighbour_indices` of
+    the neighbours of each precinct.
     """
 
-    district = None
-    """The :class:`~distopia.district.District` that currently contains this
-    precinct.
+    neighbour_indices = None
+    """The int64 array of the row indices of the neighbours of all the
+    precincts, in CSR form like
+    :class:`~distopia.precinct.adjacency.PrecinctAdjacency`. Unlike it, the
+    neighbours are stored as set and aren't made symmetric.
+    """
+
+    districts = None
+    """The int32 array of the index in :attr:`district_objects` of each
+    precinct's :attr:`Precinct.district`, or -1 if it's under no district.
+    """
+
+    district_objects = []
+    """The list of the :class:`~distopia.district.District` instances
+    indexed by :attr:`districts`. Districts no longer referenced are
+    dropped when the list grows.
+    """
+
+    metric_data = {}
+    """A mapping from the metric name to the array of its data. Histogram
+    metrics have a precincts by labels matrix, other metrics an array of one
+    value per precinct.
+    """
+
+    metric_labels = {}
+    """A mapping from the name of the histogram metrics to their labels,
+    shared by all the precincts.
+    """
+
+    metric_types = {}
+    """A mapping from the metric name to the
+    :class:`~distopia.precinct.metrics.PrecinctMetric` subclass returned by
+    :attr:`Precinct.metrics`.
+    """
+
+    _precincts = None
+
+    _pending_neighbours = {}
+
+    _foreign_neighbours = {}
+
+    _district_index = {}
+
+    _max_districts = 64
+
+    def __init__(self, boundaries, identities=None, names=None,
+                 locations=None, **kwargs):
+        """
+        :param boundaries: A list with the boundary of each precinct, either
+            a flat list of the ``x``, ``y`` coordinates or a kx2 array.
+        :param identities: The identity of each precinct. Defaults to its
+            row index.
+        :param names: The name of each precinct. Defaults to empty names.
+        :param locations: The ``(x, y)`` location of each precinct. Defaults
+            to the mean of its boundary vertices.
+        """
+        super(PrecinctTable, self).__init__(**kwargs)
+        n = len(boundaries)
+        boundaries = [
+            np.asarray(b, dtype=np.float64).reshape((-1, 2))
+            for b in boundaries]
+        counts = np.array([len(b) for b in boundaries], dtype=np.int64)
+        self.vertex_offsets = offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        self.vertices = vertices = np.concatenate(
+            boundaries or [np.empty((0, 2))]).reshape((-1, 2))
+
+        if identities is None:
+            identities = np.arange(n)
+        self.identities = np.array(identities, dtype=np.int64).reshape(n)
+        if names is None:
+            names = [''] * n
+        self.names = np.array(names, dtype=np.str_).reshape(n)
+
+        if locations is None:
+            rows = np.repeat(np.arange(n), counts)
+            locations = np.stack([
+                np.bincount(rows, vertices[:, 0], minlength=n),
+                np.bincount(rows, vertices[:, 1], minlength=n)],
+                axis=1).astype(np.float64)
+            locations /= np.maximum(counts, 1)[:, np.newaxis]
+        self.locations = np.array(
+            locations, dtype=np.float64).reshape((n, 2))
+
+        self.neighbour_indptr = np.zeros(n + 1, dtype=np.int64)
+        self.neighbour_indices = np.zeros(0, dtype=np.int64)
+        self._pending_neighbours = {}
+        self._foreign_neighbours = {}
+
+        self.districts = np.full(n, -1, dtype=np.int32)
+        self.district_objects = []
+        self._district_index = {}
+
+        self.metric_data = {}
+        self.metric_labels = {}
+        self.metric_types = {}
+
+    def __len__(self):
+        return len(self.identities)
+
+    @classmethod
+    def from_polygons(cls, polygons, names=None):
+        """Creates the table from the polygons of each precinct, as in
+        :attr:`~distopia.app.geo_data.GeoData.polygons`. Only the first
+        polygon of each precinct is used as its boundary.
+        """
+        return cls([p[0] for p in polygons], names=names)
+
+    @property
+    def precincts(self):
+        """The list of the :class:`Precinct` views of all the rows, created
+        once, so the same instance is always returned for a row.
+        """
+        if self._precincts is None:
+            self._precincts = [
+                Precinct(table=self, index=i) for i in range(len(self))]
+        return self._precincts
+
+    def get_vertices(self, i):
+        """Returns the kx2 array view of the boundary vertices of precinct
+        ``i``.
+        """
+        offsets = self.vertex_offsets
+        return self.vertices[offsets[i]:offsets[i + 1]]
+
+    def set_boundary(self, i, boundary):
+        """Replaces the boundary of precinct ``i``, which requires copying
+        the :attr:`vertices` of all the precincts.
+        """
+        boundary = np.asarray(boundary, dtype=np.float64).reshape((-1, 2))
+        offsets = self.vertex_offsets
+        self.vertices = np.concatenate([
+            self.vertices[:offsets[i]], boundary,
+            self.vertices[offsets[i + 1]:]])
+        offsets[i + 1:] += len(boundary) - (offsets[i + 1] - offsets[i])
+
+    def set_name(self, i, name):
+        """Sets the name of precinct ``i``, widening :attr:`names` if needed.
+        """
+        name = str(name)
+        if len(name) > self.names.dtype.itemsize // 4:
+            self.names = self.names.astype('<U{}'.format(len(name)))
+        self.names[i] = name
+
+    def _flush_neighbours(self):
+        pending = self._pending_neighbours
+        if not pending:
+            return
+        self._pending_neighbours = {}
+
+        n = len(self)
+        pending_rows = np.array(sorted(pending), dtype=np.int64)
+        new_cols = [np.asarray(pending[i], dtype=np.int64).reshape(-1)
+                    for i in pending_rows.tolist()]
+        new_rows = np.repeat(pending_rows, [len(c) for c in new_cols])
+
+        indptr = self.neighbour_indptr
+        rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+        keep = ~np.isin(rows, pending_rows)
+        rows = np.concatenate([rows[keep], new_rows])
+        cols = np.concatenate([self.neighbour_indices[keep]] + new_cols)
+
+        # stable, so each row keeps the order its neighbours were set in
+        order = np.argsort(rows, kind='stable')
+        self.neighbour_indptr = indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        self.neighbour_indices = cols[order]
+
+    def get_neighbours(self, i):
+        """Returns the list of the :class:`Precinct` neighbours of precinct
+        ``i``.
+        """
+        if i in self._foreign_neighbours:
+            return list(self._foreign_neighbours[i])
+
+        self._flush_neighbours()
+        indptr = self.neighbour_indptr
+        precincts = self.precincts
+        return [precincts[j] for j in
+                self.neighbour_indices[indptr[i]:indptr[i + 1]].tolist()]
+
+    def set_precinct_neighbours(self, i, neighbours):
+        """Sets the neighbours of precinct ``i`` to the list of
+        :class:`Precinct` ``neighbours``.
+
+        Neighbours from other tables can't be stored in the CSR graph, so
+        they are kept as a list instead.
+        """
+        neighbours = list(neighbours)
+        if all(getattr(p, 'table', None) is self for p in neighbours):
+            self._foreign_neighbours.pop(i, None)
+            self._pending_neighbours[i] = [p.index for p in neighbours]
+        else:
+            self._foreign_neighbours[i] = neighbours
+            self._pending_neighbours[i] = []
+
+    def set_neighbours(self, neighbours):
+        """Sets the neighbours of all the precincts.
+
+        :param neighbours: A list with the list of the row indices of the
+            neighbours of each precinct.
+        """
+        n = len(self)
+        assert len(neighbours) == n
+        counts = [len(items) for items in neighbours]
+        self.neighbour_indptr = indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        self.neighbour_indices = np.array(
+            [j for items in neighbours for j in items],
+            dtype=np.int64).reshape(-1)
+        self._pending_neighbours = {}
+        self._foreign_neighbours = {}
+
+    def set_adjacency(self, adjacency):
+        """Sets the neighbours of all the precincts from a
+        :class:`~distopia.precinct.adjacency.PrecinctAdjacency`.
+        """
+        assert len(adjacency) == len(self)
+        self.neighbour_indptr = np.array(adjacency.indptr, dtype=np.int64)
+        self.neighbour_indices = np.array(adjacency.indices, dtype=np.int64)
+        self._pending_neighbours = {}
+        self._foreign_neighbours = {}
+
+    def get_adjacency(self):
+        """Returns the (symmetric)
+        :class:`~distopia.precinct.adjacency.PrecinctAdjacency` of the
+        neighbours. Neighbours from other tables are ignored.
+        """
+        self._flush_neighbours()
+        rows = np.repeat(
+            np.arange(len(self), dtype=np.int64),
+            np.diff(self.neighbour_indptr))
+        return PrecinctAdjacency.from_edges(
+            len(self), np.stack([rows, self.neighbour_indices], axis=1))
+
+    def get_district(self, i):
+        """Returns the :class:`~distopia.district.District` of precinct
+        ``i``, or None.
+        """
+        index = self.districts[i]
+        if index < 0:
+            return None
+        return self.district_objects[index]
+
+    def set_district(self, i, district):
+        """Sets the :class:`~distopia.district.District` of precinct ``i``,
+        which can be None.
+        """
+        self.districts[i] = self.get_district_index(district)
+
+    def get_district_index(self, district):
+        """Returns the index of ``district`` in :attr:`district_objects`,
+        adding it if it's not there yet. None is -1.
+        """
+        if district is None:
+            return -1
+
+        index = self._district_index.get(district)
+        if index is None:
+            if len(self.district_objects) >= self._max_districts:
+                self._compact_districts()
+            index = len(self.district_objects)
+            self.district_objects.append(district)
+            self._district_index[district] = index
+        return index
+
+    def get_district_assignment(self, districts):
+        """Returns the array of the index in ``districts`` of each precinct's
+        district, or -1 if its district is not in ``districts``.
+        """
+        # the extra last item maps the -1 of unassigned precincts to -1
+        lookup = np.full(len(self.district_objects) + 1, -1, dtype=np.int64)
+        for i, district in enumerate(districts):
+            index = self._district_index.get(district)
+            if index is not None:
+                lookup[index] = i
+        return lookup[self.districts]
+
+    def _compact_districts(self):
+        districts = self.districts
+        assigned = districts >= 0
+        live = np.unique(districts[assigned])
+        mapping = np.full(len(self.district_objects), -1, dtype=np.int32)
+        mapping[live] = np.arange(len(live), dtype=np.int32)
+        districts[assigned] = mapping[districts[assigned]]
+
+        objects = self.district_objects = [
+            self.district_objects[i] for i in live.tolist()]
+        self._district_index = {d: i for i, d in enumerate(objects)}
+        self._max_districts = max(64, 2 * len(objects))
+
+    def set_metric(self, name, data, labels=None, metric_cls=None):
+        """Sets the metric ``name`` of all the precincts.
+
+        :param data: A precincts by labels matrix for histogram metrics, or
+            an array of one value per precinct otherwise.
+        :param labels: The labels of the histogram columns.
+        :param metric_cls: The
+            :class:`~distopia.precinct.metrics.PrecinctMetric` subclass
+            returned by :attr:`Precinct.metrics`. Defaults to
+            :class:`~distopia.precinct.metrics.PrecinctHistogram` for
+            matrices and :class:`~distopia.precinct.metrics.PrecinctScalar`
+            otherwise.
+        """
+        if metric_cls is PrecinctCategory:
+            data = np.array(data, dtype=object)
+        else:
+            data = np.array(data, dtype=np.float64)
+        if metric_cls is None:
+            metric_cls = PrecinctHistogram if data.ndim == 2 else \
+                PrecinctScalar
+        if len(data) != len(self):
+            raise ValueError(
+                'Got data for {} precincts, expected {}'.format(
+                    len(data), len(self)))
+
+        self.metric_data[name] = data
+        self.metric_types[name] = metric_cls
+        if metric_cls is PrecinctHistogram:
+            self.metric_labels[name] = list(labels or [])
+        else:
+            self.metric_labels.pop(name, None)
+
+    def get_precinct_metric(self, i, name):
+        """Returns the metric ``name`` of precinct ``i`` as a
+        :class:`~distopia.precinct.metrics.PrecinctMetric`, whose histogram
+        data is a view into :attr:`metric_data`.
+        """
+        metric_cls = self.metric_types[name]
+        value = self.metric_data[name][i]
+        if metric_cls is PrecinctHistogram:
+            return PrecinctHistogram(
+                name=name, data=value, labels=self.metric_labels[name])
+        if isinstance(value, np.generic):
+            value = value.item()
+        return metric_cls(name=name, value=value)
+
+    def set_precinct_metric(self, i, metric):
+        """Sets the metric of precinct ``i`` from a
+        :class:`~distopia.precinct.metrics.PrecinctMetric`, creating the
+        metric's array, zero filled for the other precincts, if needed.
+        """
+        name = metric.name
+        metric_cls = type(metric)
+        if isinstance(metric, PrecinctHistogram):
+            value = np.asarray(metric.data, dtype=np.float64)
+            shape = (len(self), len(value))
+        else:
+            value = metric.value
+            shape = (len(self), )
+
+        data = self.metric_data.get(name)
+        if data is None or self.metric_types[name] is not metric_cls:
+            if metric_cls is PrecinctCategory:
+                data = np.full(shape, None, dtype=object)
+            else:
+                data = np.zeros(shape, dtype=np.float64)
+            self.set_metric(
+                name, data, labels=getattr(metric, 'labels', None),
+                metric_cls=metric_cls)
+            data = self.metric_data[name]
+        elif data.shape != shape:
+            raise ValueError(
+                'Metric "{}" has shape {}, expected {}'.format(
+                    name, shape, data.shape))
+        data[i] = value
+
+
+class _PrecinctMetrics(Mapping):
+    """The read-only mapping returned by :attr:`Precinct.metrics`, except that
+    metrics can be set to store them in the table.
     """
 
-    metrics = {}
-    """A mapping from :attr:`~distopia.precinct.metrics.PrecinctMetric.name` 
-    to the :class:`~distopia.precinct.metrics.PrecinctMetric` instance that
-    contains the metric data for this precinct.
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, name):
+        if name not in self.table.metric_data:
+            raise KeyError(name)
+        return self.table.get_precinct_metric(self.index, name)
+
+    def __setitem__(self, name, metric):
+        if metric.name != name:
+            raise ValueError(
+                'Metric named "{}" set as "{}"'.format(metric.name, name))
+        self.table.set_precinct_metric(self.index, metric)
+
+    def __iter__(self):
+        return iter(self.table.metric_data)
+
+    def __len__(self):
+        return len(self.table.metric_data)
+
+
+class Precinct(object):
+    """
+    Describes a precinct and its data.
+
+    A precinct is a view onto row ``index`` of its :class:`PrecinctTable`
+    ``table``. When created without a table, it gets its own single row
+    table.
     """
 
+    __slots__ = ('table', 'index')
+
     def __init__(self, boundary=None, identity=0, name='', location=(0, 0),
-                 **kwargs):
+                 table=None, index=0, **kwargs):
         super(Precinct, self).__init__(**kwargs)
-        if boundary is None:
-            boundary = []
-        self.identity = identity
-        self.location = location
-        self.boundary = boundary
-        self.name = name
-        self.neighbours = []
-        self.metrics = {}
+        if table is None:
+            if boundary is None:
+                boundary = []
+            table = PrecinctTable(
+                [boundary], identities=[identity], names=[name],
+                locations=[location])
+            table._precincts = [self]
+            index = 0
+
+        self.table = table
+        self.index = index
+
+    @property
+    def name(self):
+        """Name describing the precinct.
+        """
+        return str(self.table.names[self.index])
+
+    @name.setter
+    def name(self, value):
+        self.table.set_name(self.index, value)
+
+    @property
+    def identity(self):
+        """The id of the precinct. """
+        return int(self.table.identities[self.index])
+
+    @identity.setter
+    def identity(self, value):
+        self.table.identities[self.index] = value
+
+    @property
+    def boundary(self):
+        """A flat list of the ``x``, ``y`` coordinates of the polygon that
+        describes the precinct's boundary.
+        """
+        return self.table.get_vertices(self.index).reshape(-1).tolist()
+
+    @boundary.setter
+    def boundary(self, value):
+        self.table.set_boundary(self.index, value)
+
+    @property
+    def vertices(self):
+        """The kx2 array view of the vertices of the precinct's
+        :attr:`boundary`, without copying them into a list.
+        """
+        return self.table.get_vertices(self.index)
+
+    @property
+    def location(self):
+        """The (practically unique) center location of the precinct.
+        """
+        return tuple(self.table.locations[self.index].tolist())
+
+    @location.setter
+    def location(self, value):
+        self.table.locations[self.index] = value
+
+    @property
+    def neighbours(self):
+        """List of other :class:`Precinct`'s that are on the boundary of this
+        precinct.
+        """
+        return self.table.get_neighbours(self.index)
+
+    @neighbours.setter
+    def neighbours(self, value):
+        self.table.set_precinct_neighbours(self.index, value)
+
+    @property
+    def district(self):
+        """The :class:`~distopia.district.District` that currently contains
+        this precinct.
+        """
+        return self.table.get_district(self.index)
+
+    @district.setter
+    def district(self, value):
+        self.table.set_district(self.index, value)
+
+    @property
+    def metrics(self):
+        """A mapping from :attr:`~distopia.precinct.metrics.PrecinctMetric.name`
+        to the :class:`~distopia.precinct.metrics.PrecinctMetric` instance that
+        contains the metric data for this precinct.
+
+        The metrics are created from the :attr:`table` data when accessed,
+        and setting one stores its data in the table.
+        """
+        return _PrecinctMetrics(self.table, self.index)
 
     @classmethod
     def find_disconnected_precincts(cls, precincts, district_map):
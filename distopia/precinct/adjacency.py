@@ -0,0 +1,631 @@
+"""
+Precinct Adjacency
+==================
+
+Stores which precincts neighbour each other as a CSR (compressed sparse row)
+graph, so that the contiguity of all the districts can be checked at once.
+"""
+from collections import deque
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+__all__ = ('PrecinctAdjacency', 'DistrictContiguity',
+           'adjacency_from_polygons', 'adjacency_from_raster',
+           'find_point_edge_pairs')
+
+
+class PrecinctAdjacency(object):
+    """The precinct adjacency graph in CSR form.
+
+    The neighbours of precinct ``i`` are
+    ``indices[indptr[i]:indptr[i + 1]]``, where precincts are identified by
+    their index in the list of precincts. The graph is undirected, so each
+    edge is listed for both its precincts.
+    """
+
+    indptr = None
+    """The n + 1 array of the offsets into :attr:`indices` of the neighbours of
+    each precinct.
+    """
+
+    indices = None
+    """The array of the neighbours' indices of all the precincts.
+    """
+
+    _edges = None
+
+    def __init__(self, indptr, indices, **kwargs):
+        super(PrecinctAdjacency, self).__init__(**kwargs)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_edges(cls, n, edges):
+        """Creates the adjacency of ``n`` precincts from a mx2 array of
+        ``edges``, each the indices of two neighbouring precincts. Edges
+        may be listed once or in both directions and may be repeated.
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape((-1, 2))
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        edges = np.concatenate([edges, edges[:, ::-1]])
+        edges = np.unique(edges, axis=0)
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 0], minlength=n), out=indptr[1:])
+        return cls(indptr, edges[:, 1])
+
+    @classmethod
+    def from_precincts(cls, precincts):
+        """Creates the adjacency from the
+        :attr:`~distopia.precinct.Precinct.neighbours` of the ``precincts``.
+        """
+        index = {precinct: i for i, precinct in enumerate(precincts)}
+        edges = [(i, index[neighbour])
+                 for i, precinct in enumerate(precincts)
+                 for neighbour in precinct.neighbours if neighbour in index]
+        return cls.from_edges(len(precincts), edges)
+
+    def save(self, filename):
+        """Saves the adjacency to ``filename`` as an uncompressed ``.npz``
+        file, so that :meth:`load` doesn't have to rebuild it.
+        """
+        dtype = np.int32 if len(self.indices) < 2 ** 31 else np.int64
+        np.savez(
+            filename, indptr=self.indptr.astype(dtype),
+            indices=self.indices.astype(dtype))
+
+    @classmethod
+    def load(cls, filename):
+        """Loads the adjacency saved with :meth:`save`.
+        """
+        with np.load(filename) as data:
+            return cls(data['indptr'], data['indices'])
+
+    def get_neighbours(self, i):
+        """Returns the array of the indices of the neighbours of precinct
+        ``i``.
+        """
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def get_edges(self):
+        """Returns the two arrays of the first and second precinct of each
+        (directed) edge.
+        """
+        if self._edges is None:
+            rows = np.repeat(
+                np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+            self._edges = rows, self.indices
+        return self._edges
+
+    def label_district_pieces(self, precinct_districts):
+        """Labels the contiguous pieces of all the districts with a single
+        connected components pass over the graph, after removing the edges
+        between precincts of different districts.
+
+        :param precinct_districts: The array of the district index of each
+            precinct, or -1 if it's under no district.
+        :return: A tuple of the number of pieces and the array of the piece
+            label of each precinct.
+        """
+        precinct_districts = np.asarray(precinct_districts)
+        rows, cols = self.get_edges()
+        district = precinct_districts[rows]
+        keep = (district == precinct_districts[cols]) & (district >= 0)
+        n = len(self)
+
+        # rows are sorted, so the kept edges are still in CSR order
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=n), out=indptr[1:])
+        indices = cols[keep]
+        graph = csr_matrix(
+            (np.ones(len(indices), dtype=np.int8), indices, indptr),
+            shape=(n, n))
+        return connected_components(graph, directed=False)
+
+    def find_disconnected_pieces(self, precinct_districts):
+        """Finds the pieces of all the districts that are disconnected from
+        the rest of their district.
+
+        The largest piece of each district is its main piece (on ties, the
+        one with the lowest precinct index), all its other pieces are
+        disconnected. Precincts under no district are ignored.
+
+        :param precinct_districts: The array of the district index of each
+            precinct, or -1 if it's under no district.
+        :return: A list of the arrays of the precinct indices of each
+            disconnected piece.
+        """
+        precinct_districts = np.asarray(precinct_districts, dtype=np.int64)
+        n_pieces, labels = self.label_district_pieces(precinct_districts)
+        sizes = np.bincount(labels, minlength=n_pieces)
+
+        # the district of each piece, and its first precinct for ties
+        first = np.full(n_pieces, len(labels), dtype=np.int64)
+        np.minimum.at(first, labels, np.arange(len(labels)))
+        piece_district = precinct_districts[first]
+
+        # sort by district, then largest and first piece. The first piece
+        # of each district is the main piece
+        order = np.lexsort((first, -sizes, piece_district))
+        sorted_district = piece_district[order]
+        is_main = np.ones(n_pieces, dtype=np.bool_)
+        is_main[1:] = sorted_district[1:] != sorted_district[:-1]
+        disconnected = order[~is_main & (sorted_district >= 0)]
+        if not len(disconnected):
+            return []
+
+        disconnected.sort()
+        members = np.argsort(labels, kind='stable')
+        starts = np.zeros(n_pieces + 1, dtype=np.int64)
+        np.cumsum(sizes, out=starts[1:])
+        return [members[starts[piece]:starts[piece + 1]]
+                for piece in disconnected]
+
+
+def find_point_edge_pairs(
+        points, starts, ends, tolerance, point_groups=None, edge_groups=None):
+    """Finds the pairs of a point and an edge that may be within
+    ``tolerance`` of each other. To stay well below comparing all the pairs,
+    the points and edges are hashed into grid cells and only points and
+    edges sharing a cell are compared.
+
+    :param points: A nx2 array of the points.
+    :param starts: A mx2 array of the start of each edge.
+    :param ends: A mx2 array of the end of each edge.
+    :param point_groups: An optional array of the group, e.g. the precinct,
+        of each point. If given with ``edge_groups``, pairs of the same group
+        are skipped.
+    :param edge_groups: An optional array of the group of each edge.
+    :return: A tuple of the arrays of the point and edge of each pair, the
+        distance of the point to the edge and the position, from zero to
+        one, of the closest point along the edge. Pairs farther than
+        ``tolerance`` may be included.
+    """
+    if not len(points) or not len(starts):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), np.zeros(0)
+
+    # the cells are about as large as the edges, so each edge covers a few
+    lengths = np.linalg.norm(ends - starts, axis=1)
+    cell = max(float(np.mean(lengths)), tolerance, 1e-9)
+    origin = np.minimum(
+        np.minimum(starts.min(axis=0), ends.min(axis=0)),
+        points.min(axis=0)) - 2 * tolerance
+    n_y = int(np.ceil(
+        (max(starts[:, 1].max(), ends[:, 1].max(), points[:, 1].max()) -
+         origin[1]) / cell)) + 2
+
+    point_cells = np.floor((points - origin) / cell).astype(np.int64)
+    point_keys = point_cells[:, 0] * n_y + point_cells[:, 1]
+
+    # edges longer than a cell, e.g. a straight state boundary, are split
+    # into pieces of at most a cell, so the number of cells an edge covers
+    # grows with its length rather than with the area of its bounding box
+    n_pieces = np.maximum(np.ceil(lengths / cell), 1).astype(np.int64)
+    piece_edges = np.repeat(np.arange(len(starts)), n_pieces)
+    piece_index = np.arange(len(piece_edges)) - np.repeat(
+        np.cumsum(n_pieces) - n_pieces, n_pieces)
+    piece_fraction = n_pieces[piece_edges].astype(np.float64)
+    delta = (ends - starts)[piece_edges]
+    piece_starts = starts[piece_edges] + delta * (
+        piece_index / piece_fraction)[:, np.newaxis]
+    piece_ends = starts[piece_edges] + delta * (
+        (piece_index + 1) / piece_fraction)[:, np.newaxis]
+
+    # each piece is added to all the cells of its bounding box, grown by the
+    # tolerance
+    low = np.floor(
+        (np.minimum(piece_starts, piece_ends) - tolerance - origin) /
+        cell).astype(np.int64)
+    high = np.floor(
+        (np.maximum(piece_starts, piece_ends) + tolerance - origin) /
+        cell).astype(np.int64)
+    size = high - low + 1
+    counts = size[:, 0] * size[:, 1]
+    piece_ids = np.repeat(np.arange(len(piece_edges)), counts)
+    local = np.arange(len(piece_ids)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    piece_size_y = size[piece_ids, 1]
+    edge_keys = (low[piece_ids, 0] + local // piece_size_y) * n_y + \
+        low[piece_ids, 1] + local % piece_size_y
+    edge_ids = piece_edges[piece_ids]
+
+    order = np.argsort(edge_keys, kind='stable')
+    edge_keys = edge_keys[order]
+    edge_ids = edge_ids[order]
+
+    # all the (point, edge) pairs that share a cell
+    lo = np.searchsorted(edge_keys, point_keys, side='left')
+    hi = np.searchsorted(edge_keys, point_keys, side='right')
+    n_pairs = hi - lo
+    point_ids = np.repeat(np.arange(len(points)), n_pairs)
+    pair_edges = edge_ids[
+        np.repeat(lo, n_pairs) + np.arange(len(point_ids)) -
+        np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)]
+
+    # the pieces of an edge may share a cell
+    pair_keys = np.unique(point_ids * len(starts) + pair_edges)
+    point_ids = pair_keys // len(starts)
+    pair_edges = pair_keys % len(starts)
+
+    if point_groups is not None and edge_groups is not None:
+        other = point_groups[point_ids] != edge_groups[pair_edges]
+        point_ids = point_ids[other]
+        pair_edges = pair_edges[other]
+
+    # the distance of each point to the edge
+    pair_points = points[point_ids]
+    a = starts[pair_edges]
+    ab = ends[pair_edges] - a
+    denom = np.einsum('ij,ij->i', ab, ab)
+    t = np.einsum('ij,ij->i', pair_points - a, ab) / np.where(
+        denom > 0, denom, 1)
+    t = np.clip(t, 0, 1)
+    dist = np.linalg.norm(a + ab * t[:, np.newaxis] - pair_points, axis=1)
+    return point_ids, pair_edges, dist, t
+
+
+def adjacency_from_polygons(polygons, mode='rook', tolerance=1.):
+    """Creates the adjacency of the precincts from their polygons, e.g.
+    :attr:`distopia.app.geo_data.GeoData.polygons`.
+
+    Two precincts are in contact where a vertex of one is within
+    ``tolerance`` of an edge of the other, so boundaries that were simplified
+    differently on each side still match. The vertices and edges near each
+    other are found with :func:`find_point_edge_pairs`.
+
+    :param polygons: A list, for each precinct, of the list of its polygons,
+        each a nx2 array of its vertices.
+    :param mode: ``'rook'``, where precincts are neighbours only if they share
+        a boundary segment longer than ``tolerance``, or ``'queen'``, where
+        touching at a single point is enough.
+    :param tolerance: The largest distance, in the polygons' units, between
+        boundaries that are considered shared.
+    :return: The :class:`PrecinctAdjacency`.
+    """
+    if mode not in ('rook', 'queen'):
+        raise ValueError('Unknown adjacency mode "{}"'.format(mode))
+    n = len(polygons)
+
+    starts = []
+    ends = []
+    edge_precincts = []
+    for i, precinct_polygons in enumerate(polygons):
+        for polygon in precinct_polygons:
+            polygon = np.asarray(polygon, dtype=np.float64).reshape((-1, 2))
+            if not len(polygon):
+                continue
+            starts.append(polygon)
+            ends.append(np.roll(polygon, -1, axis=0))
+            edge_precincts.append(np.full(len(polygon), i, dtype=np.int64))
+    if not starts:
+        return PrecinctAdjacency.from_edges(n, [])
+
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    edge_precincts = np.concatenate(edge_precincts)
+    vertex_precincts = edge_precincts
+
+    vertex_ids, pair_edges, dist, _ = find_point_edge_pairs(
+        starts, starts, ends, tolerance, point_groups=vertex_precincts,
+        edge_groups=edge_precincts)
+    close = dist <= tolerance
+    points = starts[vertex_ids[close]]
+
+    p1 = vertex_precincts[vertex_ids[close]]
+    p2 = edge_precincts[pair_edges[close]]
+    if mode == 'queen' or not len(p1):
+        return PrecinctAdjacency.from_edges(n, np.stack([p1, p2], axis=1))
+
+    # for rook, the contact points of each pair must span a segment
+    pair_keys = np.minimum(p1, p2) * n + np.maximum(p1, p2)
+    unique_keys, inverse = np.unique(pair_keys, return_inverse=True)
+    low = np.full((len(unique_keys), 2), np.inf)
+    high = np.full((len(unique_keys), 2), -np.inf)
+    np.minimum.at(low, inverse, points)
+    np.maximum.at(high, inverse, points)
+    span = np.max(high - low, axis=1)
+    keys = unique_keys[span > tolerance]
+    return PrecinctAdjacency.from_edges(
+        n, np.stack([keys // n, keys % n], axis=1))
+
+
+def adjacency_from_raster(pixel_precinct_map, n_precincts, mode='rook'):
+    """Creates the adjacency of the precincts from their rasterization, e.g.
+    :attr:`distopia.mapping.raster.PrecinctRaster.pixel_precinct_map`.
+
+    :param pixel_precinct_map: A width by height map of the precinct index
+        of each pixel. Values of ``n_precincts`` or larger are no precinct.
+    :param n_precincts: The number of precincts.
+    :param mode: ``'rook'``, where precincts are neighbours if they have
+        pixels that share a side, or ``'queen'``, where sharing a corner is
+        enough.
+    :return: The :class:`PrecinctAdjacency`.
+    """
+    if mode == 'rook':
+        offsets = [(1, 0), (0, 1)]
+    elif mode == 'queen':
+        offsets = [(1, 0), (0, 1), (1, 1), (1, -1)]
+    else:
+        raise ValueError('Unknown adjacency mode "{}"'.format(mode))
+
+    pixels = np.asarray(pixel_precinct_map).astype(np.int64)
+    w, h = pixels.shape
+    edges = []
+    for dx, dy in offsets:
+        first = pixels[:w - dx, max(-dy, 0):h - max(dy, 0)]
+        second = pixels[dx:, max(dy, 0):h - max(-dy, 0)]
+        keep = (first != second) & (first < n_precincts) & \
+            (second < n_precincts)
+        pairs = np.stack([first[keep], second[keep]], axis=1)
+        edges.append(np.unique(pairs, axis=0))
+    return PrecinctAdjacency.from_edges(n_precincts, np.concatenate(edges))
+
+
+class DistrictContiguity(object):
+    """Keeps track of the contiguous pieces of all the districts as
+    precincts flip between districts, so that the contiguity can be checked
+    in time proportional to the change rather than to the number of
+    precincts.
+
+    When a precinct joins a district, the pieces it touches are merged by
+    relabeling the smaller pieces. When a precinct leaves a district, a
+    breadth first search is started from each of its neighbours in the
+    district and the searches advance in lockstep. They stop once they
+    have all met, i.e. the district is still connected, or once all but one
+    have run out of precincts. The searches that ran out are the pieces that
+    broke off, and each is no larger than the piece that was not fully
+    explored, so the work is bounded by the size of the fragments.
+    """
+
+    adjacency = None
+    """The :class:`PrecinctAdjacency` of the precincts.
+    """
+
+    precinct_districts = None
+    """The array of the current district index of each precinct, or -1 if
+    it's under no district.
+    """
+
+    labels = None
+    """The array of the piece label of each precinct, or -1 if it's under no
+    district.
+    """
+
+    max_flips = 64
+    """When more precincts than this flip in :meth:`update`, the pieces are
+    recomputed from scratch with :meth:`reset` instead.
+    """
+
+    _neighbours = []
+
+    _members = {}
+
+    _district_pieces = {}
+
+    _next_label = 0
+
+    def __init__(
+            self, adjacency, precinct_districts=None, max_flips=64, **kwargs):
+        super(DistrictContiguity, self).__init__(**kwargs)
+        self.adjacency = adjacency
+        self.max_flips = max_flips
+        indptr = adjacency.indptr.tolist()
+        indices = adjacency.indices.tolist()
+        self._neighbours = [
+            indices[indptr[i]:indptr[i + 1]] for i in range(len(adjacency))]
+
+        if precinct_districts is None:
+            precinct_districts = np.full(len(adjacency), -1, dtype=np.int64)
+        self.reset(precinct_districts)
+
+    def reset(self, precinct_districts):
+        """Recomputes all the pieces for ``precinct_districts``, with
+        :meth:`PrecinctAdjacency.label_district_pieces`.
+        """
+        districts = self.precinct_districts = np.array(
+            precinct_districts, dtype=np.int64)
+        n_pieces, labels = self.adjacency.label_district_pieces(districts)
+        labels = labels.astype(np.int64)
+        labels[districts < 0] = -1
+        self.labels = labels
+        self._next_label = n_pieces
+
+        members = self._members = {}
+        district_pieces = self._district_pieces = {}
+        for i in np.flatnonzero(districts >= 0).tolist():
+            label = int(labels[i])
+            if label not in members:
+                members[label] = set()
+                district_pieces.setdefault(
+                    int(districts[i]), set()).add(label)
+            members[label].add(i)
+
+    def update(self, precinct_districts):
+        """Updates the pieces to the new ``precinct_districts``, flipping
+        only the precincts whose district changed.
+        """
+        precinct_districts = np.asarray(precinct_districts, dtype=np.int64)
+        if precinct_districts.shape != self.precinct_districts.shape:
+            self.reset(precinct_districts)
+            return
+
+        flips = np.flatnonzero(precinct_districts != self.precinct_districts)
+        if len(flips) > self.max_flips:
+            self.reset(precinct_districts)
+            return
+
+        for i in flips.tolist():
+            self.flip(i, int(precinct_districts[i]))
+
+    def flip(self, precinct, district):
+        """Moves the precinct at index ``precinct`` to ``district`` (-1 for
+        none).
+        """
+        districts = self.precinct_districts
+        old = int(districts[precinct])
+        if old == district:
+            return
+
+        if old >= 0:
+            self._remove(precinct, old)
+        districts[precinct] = district
+        if district >= 0:
+            self._add(precinct, district)
+
+    def _add(self, precinct, district):
+        districts = self.precinct_districts
+        labels = self.labels
+        members = self._members
+        pieces = self._district_pieces.setdefault(district, set())
+        touching = {int(labels[q]) for q in self._neighbours[precinct]
+                    if districts[q] == district and q != precinct}
+
+        if not touching:
+            label = self._next_label
+            self._next_label += 1
+            members[label] = {precinct}
+            labels[precinct] = label
+            pieces.add(label)
+            return
+
+        # merge the smaller pieces into the largest
+        label = max(touching, key=lambda item: len(members[item]))
+        target = members[label]
+        for other in touching:
+            if other == label:
+                continue
+            nodes = members.pop(other)
+            labels[list(nodes)] = label
+            target |= nodes
+            pieces.discard(other)
+
+        target.add(precinct)
+        labels[precinct] = label
+
+    def _remove(self, precinct, district):
+        districts = self.precinct_districts
+        labels = self.labels
+        label = int(labels[precinct])
+        members = self._members[label]
+        members.discard(precinct)
+        labels[precinct] = -1
+        districts[precinct] = -1
+
+        if not members:
+            del self._members[label]
+            self._district_pieces[district].discard(label)
+            return
+
+        seeds = [q for q in self._neighbours[precinct]
+                 if districts[q] == district]
+        if len(seeds) > 1:
+            self._split(label, seeds, district)
+
+    def _split(self, label, seeds, district):
+        districts = self.precinct_districts
+        neighbours = self._neighbours
+        n = len(seeds)
+        parent = list(range(n))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owner = {seed: i for i, seed in enumerate(seeds)}
+        frontiers = [deque([seed]) for seed in seeds]
+        visited = [[seed] for seed in seeds]
+        n_groups = n
+
+        while n_groups > 1:
+            active = {find(i) for i in range(n) if frontiers[i]}
+            if len(active) <= 1:
+                break
+
+            for i in range(n):
+                frontier = frontiers[i]
+                if not frontier:
+                    continue
+
+                for q in neighbours[frontier.popleft()]:
+                    if districts[q] != district:
+                        continue
+                    j = owner.get(q)
+                    if j is None:
+                        owner[q] = i
+                        frontier.append(q)
+                        visited[i].append(q)
+                        continue
+
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        parent[root_j] = root_i
+                        n_groups -= 1
+
+        if n_groups == 1:
+            return
+
+        groups = {}
+        for i in range(n):
+            groups.setdefault(find(i), []).append(i)
+
+        # the group still being explored is the remaining main piece,
+        # otherwise all were exhausted and the largest is kept
+        def group_key(root):
+            explored = any(frontiers[i] for i in groups[root])
+            return explored, sum(len(visited[i]) for i in groups[root])
+        main = max(groups, key=group_key)
+
+        members = self._members
+        pieces = self._district_pieces[district]
+        for root, searches in groups.items():
+            if root == main:
+                continue
+            nodes = set()
+            for i in searches:
+                nodes.update(visited[i])
+
+            new_label = self._next_label
+            self._next_label += 1
+            self.labels[list(nodes)] = new_label
+            members[label] -= nodes
+            members[new_label] = nodes
+            pieces.add(new_label)
+
+    def is_connected(self, district):
+        """Whether ``district`` is in a single piece (or empty).
+        """
+        return len(self._district_pieces.get(district, ())) <= 1
+
+    def get_fragments(self, district):
+        """Returns the pieces of ``district`` that broke off its main piece,
+        like :meth:`PrecinctAdjacency.find_disconnected_pieces`.
+
+        :return: A list of the sorted arrays of the precinct indices of each
+            disconnected piece, sorted by their first precinct.
+        """
+        pieces = self._district_pieces.get(district, ())
+        if len(pieces) <= 1:
+            return []
+
+        members = self._members
+        pieces = [sorted(members[label]) for label in pieces]
+        main = max(pieces, key=lambda nodes: (len(nodes), -nodes[0]))
+        return [np.array(nodes, dtype=np.int64) for nodes in
+                sorted(pieces, key=lambda nodes: nodes[0])
+                if nodes is not main]
+
+    def find_disconnected_pieces(self):
+        """Returns the disconnected pieces of all the districts, like
+        :meth:`PrecinctAdjacency.find_disconnected_pieces`.
+        """
+        fragments = []
+        for district in self._district_pieces:
+            fragments.extend(self.get_fragments(district))
+        return sorted(fragments, key=lambda nodes: nodes[0])
@@ -0,0 +1,631 @@
+"""
+Precinct Topology
+=================
+
+Splits the precinct boundaries into arcs that are shared by the two
+precincts on either side, like TopoJSON does, so that the outline of a
+group of precincts, e.g. a district, is the set of arcs whose two sides are
+in different groups, without computing a union of polygons.
+"""
+from collections import OrderedDict
+import os
+import shutil
+import numpy as np
+from scipy.spatial import cKDTree
+
+from distopia.precinct.adjacency import find_point_edge_pairs
+
+__all__ = ('PrecinctTopology', )
+
+
+class PrecinctTopology(object):
+    """The boundaries of the precincts as a set of shared arcs.
+
+    Each arc is a polyline of :attr:`vertices` between two junctions, i.e.
+    vertices where more than two precincts (or the outside) meet. It's stored
+    once, even though it bounds the precincts on both its sides. The ring of
+    each precinct is the sequence of its arcs, where, like in TopoJSON, arc
+    ``~i`` is arc ``i`` reversed.
+
+    All the rings are counter clockwise, so :attr:`arc_precincts` of each arc
+    is the precinct on its left, followed by the precinct on its right (or
+    -1 if it's outside all the precincts).
+    """
+
+    vertices = None
+    """The nx2 array of all the vertices of the arcs. Arcs that meet share
+    the vertex where they meet.
+    """
+
+    arc_vertices = None
+    """The array of the indices into :attr:`vertices` of the vertices of all
+    the arcs.
+    """
+
+    arc_offsets = None
+    """The number of arcs + 1 array of the offsets into :attr:`arc_vertices`
+    of the vertices of each arc.
+    """
+
+    arc_precincts = None
+    """The number of arcs by 2 array of the precinct on the left and right
+    side of each arc, or -1 if there's none on that side.
+    """
+
+    ring_arcs = None
+    """The array of the (signed) arcs of all the precinct rings.
+    """
+
+    ring_offsets = None
+    """The number of rings + 1 array of the offsets into :attr:`ring_arcs` of
+    the arcs of each ring.
+    """
+
+    ring_precincts = None
+    """The array of the precinct of each ring.
+    """
+
+    ring_polygons = None
+    """The array of the index of the polygon of each ring in the list of the
+    polygons of its precinct that the topology was built from.
+    """
+
+    n_precincts = 0
+    """The number of precincts.
+    """
+
+    max_cached_assignments = 64
+    """The number of assignments whose district outlines are cached by
+    :meth:`get_district_rings`.
+    """
+
+    format_version = 2
+    """The version of the topology construction, which is part of the cache
+    key of saved topologies (see
+    :meth:`~distopia.mapping.voronoi.VoronoiMapping.get_topology_cache_key`),
+    so it must be increased whenever the construction changes.
+    """
+
+    _district_rings = None
+
+    def __init__(
+            self, vertices, arc_vertices, arc_offsets, arc_precincts,
+            ring_arcs, ring_offsets, ring_precincts, n_precincts,
+            ring_polygons, **kwargs):
+        super(PrecinctTopology, self).__init__(**kwargs)
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape((-1, 2))
+        self.arc_vertices = np.asarray(arc_vertices, dtype=np.int64)
+        self.arc_offsets = np.asarray(arc_offsets, dtype=np.int64)
+        self.arc_precincts = np.asarray(
+            arc_precincts, dtype=np.int64).reshape((-1, 2))
+        self.ring_arcs = np.asarray(ring_arcs, dtype=np.int64)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.ring_precincts = np.asarray(ring_precincts, dtype=np.int64)
+        self.ring_polygons = np.asarray(ring_polygons, dtype=np.int64)
+        self.n_precincts = n_precincts
+        self._district_rings = OrderedDict()
+
+    @property
+    def n_arcs(self):
+        """The number of arcs.
+        """
+        return len(self.arc_offsets) - 1
+
+    @staticmethod
+    def get_ring_area(points):
+        """Returns the signed area of the ring with the kx2 vertices
+        ``points``, positive if it's counter clockwise.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        x, y = points[:, 0], points[:, 1]
+        return float(
+            np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2.
+
+    @classmethod
+    def from_polygons(cls, polygons, tolerance=1.):
+        """Builds the topology from the polygons of each precinct, e.g.
+        :attr:`distopia.app.geo_data.GeoData.polygons`.
+
+        Boundaries that were simplified differently on each side don't share
+        their vertices exactly, so they are first matched up: vertices
+        within half ``tolerance`` of a vertex are snapped to it, and vertices
+        within ``tolerance`` of another precinct's edge are inserted into that
+        edge. Boundaries that still don't match become arcs with only one
+        precinct.
+
+        :param polygons: A list, for each precinct, of the list of its
+            polygons, each a nx2 array of its vertices.
+        :param tolerance: The largest distance, in the polygons' units,
+            between boundaries that are considered shared.
+        :return: The :class:`PrecinctTopology`.
+        """
+        rings = []
+        ring_precincts = []
+        ring_polygons = []
+        for i, precinct_polygons in enumerate(polygons):
+            for j, polygon in enumerate(precinct_polygons):
+                polygon = np.asarray(
+                    polygon, dtype=np.float64).reshape((-1, 2))
+                if len(polygon) >= 3:
+                    rings.append(polygon)
+                    ring_precincts.append(i)
+                    ring_polygons.append(j)
+        n_precincts = len(polygons)
+        if not rings:
+            return cls(
+                np.zeros((0, 2)), [], [0], np.zeros((0, 2)), [], [0], [],
+                n_precincts, [])
+
+        points = np.concatenate(rings)
+        point_rings = np.repeat(
+            np.arange(len(rings)), [len(ring) for ring in rings])
+        ring_precincts = np.array(ring_precincts, dtype=np.int64)
+
+        # snap the vertices that are close to the first of them, so every
+        # node is within half tolerance of its vertices. Merging all the
+        # pairs closer than that instead would chain the closely spaced
+        # vertices along a boundary into one node
+        n = len(points)
+        point_nodes = np.full(n, -1, dtype=np.int64)
+        representatives = []
+        neighbours = cKDTree(points).query_ball_point(points, tolerance / 2.)
+        for i in range(n):
+            if point_nodes[i] != -1:
+                continue
+            members = np.asarray(neighbours[i], dtype=np.int64)
+            members = members[point_nodes[members] == -1]
+            point_nodes[members] = len(representatives)
+            representatives.append(i)
+        nodes = points[representatives]
+
+        # the edges of the rings, dropping those that collapsed
+        edge_rings = point_rings
+        edge_starts = point_nodes
+        ring_starts = np.searchsorted(point_rings, np.arange(len(rings)))
+        next_point = np.arange(1, n + 1)
+        ring_ends = np.append(ring_starts[1:], n)
+        next_point[ring_ends - 1] = ring_starts
+        edge_ends = point_nodes[next_point]
+        keep = edge_starts != edge_ends
+        edge_rings = edge_rings[keep]
+        edge_starts = edge_starts[keep]
+        edge_ends = edge_ends[keep]
+        edge_precincts = ring_precincts[edge_rings]
+
+        # the precincts of each node, so nodes aren't inserted into the
+        # edges of their own precinct
+        node_keys = np.unique(
+            point_nodes * n_precincts + ring_precincts[point_rings])
+        node_ids, edge_ids, dist, t = find_point_edge_pairs(
+            nodes, nodes[edge_starts], nodes[edge_ends], tolerance)
+        insert = (dist <= tolerance) & (t > 0) & (t < 1) & \
+            (node_ids != edge_starts[edge_ids]) & \
+            (node_ids != edge_ends[edge_ids])
+        node_ids, edge_ids, t = node_ids[insert], edge_ids[insert], t[insert]
+        own = np.isin(node_ids * n_precincts + edge_precincts[edge_ids],
+                      node_keys)
+        node_ids, edge_ids, t = node_ids[~own], edge_ids[~own], t[~own]
+        dist = dist[insert][~own]
+        # a node near the vertex between two edges of a ring is only inserted
+        # into the closest one
+        order = np.argsort(dist, kind='stable')
+        _, first = np.unique(
+            node_ids[order] * len(rings) + edge_rings[edge_ids[order]],
+            return_index=True)
+        keep = order[first]
+        node_ids, edge_ids, t = node_ids[keep], edge_ids[keep], t[keep]
+
+        # the node sequence of each ring is the start of each of its edges
+        # followed by the nodes inserted into the edge
+        n_edges = len(edge_starts)
+        seq_edges = np.concatenate([np.arange(n_edges), edge_ids])
+        seq_t = np.concatenate([np.full(n_edges, -1.), t])
+        seq_nodes = np.concatenate([edge_starts, node_ids])
+        order = np.lexsort((seq_t, seq_edges))
+        seq_nodes = seq_nodes[order]
+        seq_rings = edge_rings[seq_edges[order]]
+
+        ring_nodes = []
+        for ring in range(len(rings)):
+            s, e = np.searchsorted(seq_rings, [ring, ring + 1])
+            nodes_ = seq_nodes[s:e]
+            if len(nodes_):
+                nodes_ = nodes_[np.append(
+                    nodes_[1:] != nodes_[:-1], nodes_[-1] != nodes_[0])]
+            if len(nodes_) < 3:
+                ring_nodes.append(None)
+                continue
+            # make all the rings counter clockwise
+            if cls.get_ring_area(nodes[nodes_]) < 0:
+                nodes_ = nodes_[::-1]
+            ring_nodes.append(nodes_)
+
+        return cls._from_ring_nodes(
+            nodes, ring_nodes, ring_precincts, ring_polygons, n_precincts)
+
+    @classmethod
+    def _from_ring_nodes(
+            cls, nodes, ring_nodes, ring_precincts, ring_polygons,
+            n_precincts):
+        # the precincts on the left and right of each undirected edge
+        starts = []
+        ends = []
+        precincts = []
+        for nodes_, precinct in zip(ring_nodes, ring_precincts):
+            if nodes_ is not None:
+                starts.append(nodes_)
+                ends.append(np.roll(nodes_, -1))
+                precincts.append(np.full(len(nodes_), precinct))
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        precincts = np.concatenate(precincts)
+
+        n_nodes = len(nodes)
+        forward = starts < ends
+        keys = np.where(
+            forward, starts * n_nodes + ends, ends * n_nodes + starts)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        # the precinct traversing the edge from its lower to its higher node
+        # is on its left, as the rings are counter clockwise
+        edge_precincts = np.full((len(unique_keys), 2), -1, dtype=np.int64)
+        edge_precincts[inverse[forward], 0] = precincts[forward]
+        edge_precincts[inverse[~forward], 1] = precincts[~forward]
+
+        # junctions are nodes that don't join exactly two edges with the
+        # same precincts on their sides
+        edge_nodes = np.stack(
+            [unique_keys // n_nodes, unique_keys % n_nodes], axis=1)
+        degree = np.bincount(edge_nodes.ravel(), minlength=n_nodes)
+        pair_keys = edge_precincts[:, 0] * (n_precincts + 1) + \
+            edge_precincts[:, 1]
+        first_pair = np.full(n_nodes, -2, dtype=np.int64)
+        first_pair[edge_nodes[:, 0]] = pair_keys
+        first_pair[edge_nodes[:, 1]] = pair_keys
+        mixed = np.zeros(n_nodes, dtype=np.bool_)
+        mixed[edge_nodes[:, 0]] |= first_pair[edge_nodes[:, 0]] != pair_keys
+        mixed[edge_nodes[:, 1]] |= first_pair[edge_nodes[:, 1]] != pair_keys
+        is_junction = (degree != 2) | mixed
+
+        # split the rings at the junctions into arcs, storing each arc once
+        arcs = {}
+        arc_vertices = []
+        arc_precincts = []
+        ring_arcs = []
+        ring_offsets = [0]
+        kept_precincts = []
+        kept_polygons = []
+        for nodes_, precinct, polygon in zip(
+                ring_nodes, ring_precincts, ring_polygons):
+            if nodes_ is None:
+                continue
+            junctions = np.flatnonzero(is_junction[nodes_])
+            if len(junctions):
+                nodes_ = np.roll(nodes_, -junctions[0])
+                bounds = np.append(junctions - junctions[0], len(nodes_))
+                pieces = [np.append(nodes_[s:e], nodes_[e % len(nodes_)])
+                          for s, e in zip(bounds[:-1], bounds[1:])]
+            else:
+                # a closed arc, starting at its lowest node
+                nodes_ = np.roll(nodes_, -int(np.argmin(nodes_)))
+                pieces = [np.append(nodes_, nodes_[0])]
+
+            for piece in pieces:
+                piece = tuple(piece.tolist())
+                key = min(piece, piece[::-1])
+                arc = arcs.get(key)
+                if arc is None:
+                    arc = arcs[key] = len(arc_vertices)
+                    arc_vertices.append(key)
+                    arc_precincts.append([-1, -1])
+                # the ring's precinct is on the left of its arcs
+                if key == piece:
+                    arc_precincts[arc][0] = precinct
+                    ring_arcs.append(arc)
+                else:
+                    arc_precincts[arc][1] = precinct
+                    ring_arcs.append(~arc)
+            ring_offsets.append(len(ring_arcs))
+            kept_precincts.append(precinct)
+            kept_polygons.append(polygon)
+
+        arc_offsets = np.zeros(len(arc_vertices) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in arc_vertices], out=arc_offsets[1:])
+        return cls(
+            nodes,
+            np.concatenate(arc_vertices) if arc_vertices else [],
+            arc_offsets, arc_precincts, ring_arcs, ring_offsets,
+            kept_precincts, n_precincts, kept_polygons)
+
+    @classmethod
+    def from_precincts(cls, precincts, tolerance=1.):
+        """Builds the topology from the
+        :attr:`~distopia.precinct.Precinct.boundary` of the ``precincts``,
+        like :meth:`from_polygons`.
+        """
+        return cls.from_polygons(
+            [[precinct.boundary] for precinct in precincts],
+            tolerance=tolerance)
+
+    _saved_arrays = (
+        'vertices', 'arc_vertices', 'arc_offsets', 'arc_precincts',
+        'ring_arcs', 'ring_offsets', 'ring_precincts', 'ring_polygons',
+        'n_precincts')
+
+    def save(self, path):
+        """Saves the topology to the directory ``path``, with a ``.npy`` file
+        for each array, so that :meth:`load` can load it instead of building
+        it again.
+
+        Like :meth:`~distopia.mapping.raster.PrecinctRaster.save`, the files
+        are first written to a temporary directory that is then renamed to
+        ``path``. If ``path`` already exists, it's left unchanged.
+        """
+        if os.path.exists(path):
+            return
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(temp_path)
+        try:
+            for name in self._saved_arrays:
+                np.save(os.path.join(temp_path, '{}.npy'.format(name)),
+                        np.asarray(getattr(self, name)), allow_pickle=False)
+            os.rename(temp_path, path)
+        except OSError:
+            # another process saved it first
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the topology saved with :meth:`save`.
+        """
+        arrays = {
+            name: np.load(os.path.join(path, '{}.npy'.format(name)),
+                          allow_pickle=False)
+            for name in cls._saved_arrays}
+        arrays['n_precincts'] = int(arrays['n_precincts'])
+        return cls(**arrays)
+
+    def get_arc_points(self, arc):
+        """Returns the kx2 array of the vertices of the (signed) ``arc``.
+        """
+        i = ~arc if arc < 0 else arc
+        points = self.vertices[
+            self.arc_vertices[self.arc_offsets[i]:self.arc_offsets[i + 1]]]
+        return points[::-1] if arc < 0 else points
+
+    def simplify(self, tolerance):
+        """Returns a new topology with its arcs simplified with the
+        Douglas-Peucker algorithm, so that no removed vertex is farther than
+        ``tolerance`` from the simplified arc. All the arcs are simplified
+        together, one level of splits at a time.
+
+        The end points of the arcs, where the precincts meet, are kept and
+        each arc is simplified once for the precincts on both its sides, so
+        the simplified precincts still have no gaps or overlaps between
+        them. Closed arcs keep at least two interior vertices and the arcs
+        of rings with two arcs at least one, so no ring collapses.
+        """
+        offsets = self.arc_offsets
+        arc_vertices = self.arc_vertices
+        n_arcs = self.n_arcs
+        points = self.vertices[arc_vertices]
+        starts = offsets[:-1]
+        ends = offsets[1:] - 1
+        keep = np.zeros(len(arc_vertices), dtype=np.bool_)
+        keep[starts] = keep[ends] = True
+
+        # the number of splits done regardless of the tolerance
+        forced = np.zeros(n_arcs, dtype=np.int64)
+        lengths = np.diff(self.ring_offsets)
+        arcs = self.ring_arcs[np.repeat(lengths == 2, lengths)]
+        forced[np.where(arcs < 0, ~arcs, arcs)] = 1
+        forced[arc_vertices[starts] == arc_vertices[ends]] = 2
+
+        while True:
+            counts = ends - starts - 1
+            active = counts > 0
+            starts, ends = starts[active], ends[active]
+            forced, counts = forced[active], counts[active]
+            if not len(starts):
+                break
+
+            # the distance of the interior vertices of all the segments to
+            # their segment
+            first = np.cumsum(counts) - counts
+            segments = np.repeat(np.arange(len(starts)), counts)
+            interior = np.arange(counts.sum()) - np.repeat(first, counts) + \
+                np.repeat(starts, counts) + 1
+            a = points[starts][segments]
+            ab = points[ends][segments] - a
+            ap = points[interior] - a
+            length2 = np.einsum('ij,ij->i', ab, ab)
+            t = np.clip(np.einsum('ij,ij->i', ap, ab) / np.where(
+                length2 > 0, length2, 1.), 0., 1.)
+            dist = np.hypot(*(ap - t[:, np.newaxis] * ab).T)
+
+            # split each segment at its farthest vertex, if it's too far
+            max_dist = np.maximum.reduceat(dist, first)
+            farthest = np.flatnonzero(dist == max_dist[segments])
+            _, i = np.unique(segments[farthest], return_index=True)
+            split = (max_dist > tolerance) | (forced > 0)
+            middle = interior[farthest[i]][split]
+            keep[middle] = True
+            forced = forced[split] - 1
+            starts, ends = (
+                np.concatenate([starts[split], middle]),
+                np.concatenate([middle, ends[split]]))
+            forced = np.concatenate([forced, forced])
+
+        # only keep the vertices still used by the arcs
+        vertex_arcs = np.repeat(np.arange(n_arcs), np.diff(offsets))
+        arc_offsets = np.zeros(n_arcs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(vertex_arcs[keep], minlength=n_arcs),
+                  out=arc_offsets[1:])
+        used, arc_vertices = np.unique(
+            arc_vertices[keep], return_inverse=True)
+        return type(self)(
+            self.vertices[used], arc_vertices, arc_offsets,
+            self.arc_precincts, self.ring_arcs, self.ring_offsets,
+            self.ring_precincts, self.n_precincts, self.ring_polygons)
+
+    def get_precinct_polygons(self, polygons=None):
+        """Returns the polygons of the precincts, rebuilt from their arcs.
+
+        :param polygons: The polygons the topology was built from. If given,
+            the polygons that collapsed when it was built are copied from
+            them, so each precinct has the same number of polygons.
+        :return: A list, for each precinct, of the list of the kx2 arrays of
+            the vertices of its polygons, in the order of the polygons the
+            topology was built from.
+        """
+        offsets = self.ring_offsets.tolist()
+        chains = [(list(range(s, e)), True)
+                  for s, e in zip(offsets[:-1], offsets[1:])]
+        rings = self._get_chains_points(self.ring_arcs, chains)
+
+        if polygons is None:
+            precinct_polygons = [[] for _ in range(self.n_precincts)]
+            for ring, precinct in zip(rings, self.ring_precincts.tolist()):
+                precinct_polygons[precinct].append(ring)
+            return precinct_polygons
+
+        precinct_polygons = [list(p) for p in polygons]
+        for ring, precinct, i in zip(
+                rings, self.ring_precincts.tolist(),
+                self.ring_polygons.tolist()):
+            precinct_polygons[precinct][i] = ring
+        return precinct_polygons
+
+    def get_boundary_arcs(self, precinct_districts):
+        """Returns the arcs on the boundary of the districts.
+
+        :param precinct_districts: The array of the district index of each
+            precinct, or -1 if it's under no district.
+        :return: A tuple of the array of the arcs whose two sides are in
+            different districts and the number of arcs by 2 array of the
+            district on their left and right side, or -1.
+        """
+        precinct_districts = np.append(
+            np.asarray(precinct_districts, dtype=np.int64), -1)
+        sides = precinct_districts[self.arc_precincts]
+        arcs = np.flatnonzero(sides[:, 0] != sides[:, 1])
+        return arcs, sides[arcs]
+
+    @staticmethod
+    def _stitch_arcs(starts, ends):
+        # each arc ending at a node is followed by an arc starting there. At
+        # nodes where many arcs meet, the k-th arriving arc is followed by
+        # the k-th leaving arc
+        n = len(starts)
+        if not n:
+            return []
+
+        def rank(nodes):
+            order = np.argsort(nodes, kind='stable')
+            sorted_nodes = nodes[order]
+            ranks = np.empty(n, dtype=np.int64)
+            ranks[order] = np.arange(n) - np.searchsorted(
+                sorted_nodes, sorted_nodes, side='left')
+            return ranks
+
+        leaving = starts * n + rank(starts)
+        arriving = ends * n + rank(ends)
+        order = np.argsort(leaving)
+        i = np.minimum(np.searchsorted(leaving[order], arriving), n - 1)
+        following = np.where(leaving[order[i]] == arriving, order[i], -1)
+
+        has_previous = np.zeros(n, dtype=np.bool_)
+        has_previous[following[following >= 0]] = True
+        following = following.tolist()
+        visited = [False] * n
+
+        # the open chains, from where the boundaries didn't match, start at
+        # arcs without a previous arc. All the other arcs are in closed rings
+        chains = []
+        heads = np.flatnonzero(~has_previous).tolist() + list(range(n))
+        for head in heads:
+            if visited[head]:
+                continue
+            chain = []
+            arc = head
+            while arc >= 0 and not visited[arc]:
+                visited[arc] = True
+                chain.append(arc)
+                arc = following[arc]
+            chains.append((chain, arc == head))
+        return chains
+
+    def _get_chains_points(self, signed, chains):
+        # the vertices of the consecutive arcs of all the chains at once,
+        # without the last vertex of each arc, which is the first of the next
+        # one, except for the last arc of open chains
+        if not chains:
+            return []
+        signed = signed[np.concatenate([chain for chain, _ in chains])]
+        lengths = np.array([len(chain) for chain, _ in chains])
+        is_open = np.array([not closed for _, closed in chains])
+
+        arcs = np.where(signed < 0, ~signed, signed)
+        first = self.arc_offsets[arcs]
+        n_vertices = self.arc_offsets[arcs + 1] - first
+        counts = n_vertices - 1
+        counts[np.cumsum(lengths)[is_open] - 1] += 1
+
+        k = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        first = np.repeat(first, counts)
+        indices = np.where(
+            np.repeat(signed < 0, counts),
+            first + np.repeat(n_vertices - 1, counts) - k, first + k)
+        points = self.vertices[self.arc_vertices[indices]]
+
+        chain_counts = np.add.reduceat(counts, np.cumsum(lengths) - lengths)
+        return np.split(points, np.cumsum(chain_counts)[:-1])
+
+    def get_district_rings(self, precinct_districts, n_districts):
+        """Returns the outline of each district, stitched from the arcs on
+        its boundary. The cost is proportional to the number of boundary
+        arcs, and the outlines of the last
+        :attr:`max_cached_assignments` assignments are cached.
+
+        :param precinct_districts: The array of the district index of each
+            precinct, or -1 if it's under no district.
+        :param n_districts: The number of districts.
+        :return: A list with, for each district, the list of the kx2 arrays
+            of the vertices of its rings, counter clockwise for the outer
+            rings and clockwise for the holes. If the arcs don't close a
+            ring, e.g. where the boundaries didn't match, the ring is left
+            open.
+        """
+        precinct_districts = np.asarray(precinct_districts, dtype=np.int64)
+        key = n_districts, precinct_districts.tobytes()
+        cache = self._district_rings
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        arcs, sides = self.get_boundary_arcs(precinct_districts)
+        offsets = self.arc_offsets
+        arc_vertices = self.arc_vertices
+        starts = arc_vertices[offsets[arcs]]
+        ends = arc_vertices[offsets[arcs + 1] - 1]
+
+        district_rings = []
+        for district in range(n_districts):
+            # walk each arc so the district is on its left
+            left = sides[:, 0] == district
+            right = sides[:, 1] == district
+            signed = np.concatenate([arcs[left], ~arcs[right]])
+            chains = self._stitch_arcs(
+                np.concatenate([starts[left], ends[right]]),
+                np.concatenate([ends[left], starts[right]]))
+            district_rings.append(self._get_chains_points(signed, chains))
+
+        cache[key] = district_rings
+        while len(cache) > self.max_cached_assignments:
+            cache.popitem(last=False)
+        return district_rings
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+
+def test_metric_aggregator():
+    from distopia.precinct import PrecinctTable
+    from distopia.district import District
+    from distopia.district.aggregate import MetricAggregator, \
+        get_histogram_bin_edges
+    table = PrecinctTable([[]] * 4)
+    table.set_metric('population', [10, 30, 20, 40])
+    table.set_metric('votes', [[1, 2], [3, 4], [5, 6], [7, 8]], ['a', 'b'])
+    table.set_metric('rate', [1., 2., 3., 4.])
+    table.set_metric(
+        'income', [[50, 50, 0], [0, 100, 0], [0, 0, 100], [25, 25, 50]],
+        ['<10,000', '10,000-19,999', '>20,000'])
+    assert [e.tolist() for e in get_histogram_bin_edges(
+        table.metric_labels['income'])] == [[0, 1e4, 2e4], [1e4, 2e4, 2e4]]
+
+    aggregator = MetricAggregator(
+        table, ['votes', 'rate', 'income'],
+        aggregations={'rate': 'mean', 'income': 'median'},
+        weights='population')
+    assert aggregator.labels == {'votes': ['a', 'b'], 'rate': None,
+                                 'income': None}
+
+    values = aggregator.aggregate([0, 0, 1, -1], 3)
+    np.testing.assert_allclose(values['votes'], [[4, 6], [5, 6], [0, 0]])
+    np.testing.assert_allclose(
+        values['rate'], [(10 * 1 + 30 * 2) / 40., 3, 0])
+    # district 0 has 5 and 5 + 30 people in the first two income brackets,
+    # the median is 40 / 2 - 5 = 15 of the 35 into the second bracket
+    np.testing.assert_allclose(
+        values['income'], [10000 + 15 / 35. * 10000, 20000, 0])
+
+    batch = aggregator.aggregate_batch([[0, 0, 1, -1], [1, 1, 1, 1]], 3)
+    np.testing.assert_allclose(batch['votes'][0], values['votes'])
+    np.testing.assert_allclose(batch['votes'][1], [[0, 0], [16, 20], [0, 0]])
+
+    districts = [District(), District()]
+    districts[0].assign_precincts(table.precincts[:2])
+    districts[1].assign_precincts(table.precincts[2:3])
+    aggregator.create_district_metrics(districts)
+    assert districts[0].metrics['votes'].data == [4, 6]
+    assert districts[1].metrics['rate'].value == pytest.approx(3)
+
+
+def test_metric_aggregator_incremental():
+    from distopia.precinct import PrecinctTable
+    from distopia.district.aggregate import MetricAggregator
+    rand = np.random.RandomState(0)
+    n = 200
+    table = PrecinctTable([[]] * n)
+    table.set_metric('population', rand.randint(1, 1000, n))
+    table.set_metric('votes', rand.randint(0, 100, (n, 3)), ['a', 'b', 'c'])
+    table.set_metric('rate', rand.uniform(0, 1, n))
+    aggregator = MetricAggregator(
+        table, ['votes', 'rate'], aggregations={'rate': 'mean'},
+        weights='population')
+    full = MetricAggregator(
+        table, ['votes', 'rate'], aggregations={'rate': 'mean'},
+        weights='population')
+
+    districts = rand.randint(-1, 5, n)
+    n_updates = []
+    for i in range(50):
+        districts = districts.copy()
+        flips = rand.randint(0, n, 80 if i % 10 == 9 else 3)
+        districts[flips] = rand.randint(-1, 5, len(flips))
+        ids = [0, 1, 2, 3, 4] if i < 30 else [0, 1, 2, 3, 5]
+
+        values = aggregator.aggregate(districts, 5, district_ids=ids)
+        n_updates.append(aggregator._n_updates)
+        expected = full.aggregate(districts, 5)
+        np.testing.assert_array_equal(values['votes'], expected['votes'])
+        np.testing.assert_allclose(values['rate'], expected['rate'])
+    # large changes and changed districts are fully recomputed
+    assert n_updates[:11] == [0, 1, 2, 3, 4, 5, 6, 7, 8, 0, 1]
+    assert n_updates[30] == 0 and n_updates[31] == 1
+
+
+def test_district_compactness():
+    from distopia.district import District
+    from distopia.district.compactness import DistrictCompactness
+    pixel_district_map = np.full((300, 200), 255, dtype=np.uint8)
+    pixel_precinct_map = np.zeros((300, 200), dtype=np.uint8)
+    x, y = np.mgrid[0:300, 0:200]
+    pixel_district_map[10:90, 10:90] = 0
+    pixel_district_map[(x - 200) ** 2 + (y - 100) ** 2 < 60 ** 2] = 1
+    pixel_district_map[10:290, 180:190] = 2
+    # pixels outside the state don't count
+    pixel_district_map[0:150, 150:200] = 3
+    pixel_precinct_map[0:150, 150:200] = 255
+
+    compactness = DistrictCompactness(
+        metrics=['polsby_popper', 'reock', 'convex_hull',
+                 'moment_of_inertia'])
+    values = compactness.compute(
+        pixel_district_map, pixel_precinct_map, 4, 1)
+
+    square, disk, strip, empty = zip(*[
+        values[name] for name in compactness.metrics])
+    assert square == pytest.approx([np.pi / 4, 2 / np.pi, 1, 3 / np.pi],
+                                   rel=.05)
+    assert disk == pytest.approx([1, 1, 1, 1], abs=.03)
+    assert strip[1] < .1 and strip[2] == pytest.approx(1)
+    assert strip[0] < square[0] and strip[3] < square[3]
+    assert empty == (0, 0, 0, 0)
+
+    # the perimeter estimate doesn't depend on the orientation
+    for angle in (10, 22.5, 30, 45):
+        angle = np.radians(angle)
+        u = (x - 150) * np.cos(angle) + (y - 100) * np.sin(angle)
+        v = (y - 100) * np.cos(angle) - (x - 150) * np.sin(angle)
+        rotated = np.where(
+            (np.abs(u) < 40) & (np.abs(v) < 40), 0, 255).astype(np.uint8)
+        values = compactness.compute(
+            rotated, np.zeros_like(pixel_precinct_map), 1, 1)
+        assert values['polsby_popper'][0] == pytest.approx(
+            np.pi / 4, rel=.05)
+
+    districts = [District() for _ in range(4)]
+    compactness.create_district_metrics(
+        districts, pixel_district_map, pixel_precinct_map, 1)
+    assert districts[0].metrics['reock'].value == pytest.approx(2 / np.pi)
+
+
+def test_create_district_metrics():
+    from distopia.district import District
+    from distopia.district.compactness import DistrictCompactness
+    from distopia.district.metrics import create_district_metrics
+    from distopia.mapping.voronoi import VoronoiMapping
+    from distopia.precinct import Precinct
+    from distopia.precinct.metrics import PrecinctHistogram
+    vor = VoronoiMapping()
+    vor.screen_size = (100, 100)
+    precincts = []
+    for i in range(2):
+        precinct = Precinct(
+            boundary=[i * 50, 0, i * 50 + 50, 0, i * 50 + 50, 100, i * 50, 100],
+            identity=i)
+        precinct.metrics['age'] = PrecinctHistogram(
+            name='age', labels=['young', 'old'], data=[i + 1, 2])
+        precincts.append(precinct)
+    vor.set_precincts(precincts)
+
+    districts = [District(), District()]
+    districts[0].precincts = precincts
+    pixel_district_map = np.zeros((100, 100), dtype=np.uint8)
+    pixel_district_map[:, 50:] = 1
+    create_district_metrics(
+        districts, ['age'], district_compactness=DistrictCompactness(
+            metrics=['convex_hull']), voronoi_mapping=vor,
+        pixel_district_map=pixel_district_map, pixel_district_scale=1.)
+
+    assert districts[0].metrics['age'].data == [3, 4]
+    assert districts[1].metrics['age'].data == []
+    assert [d.metrics['convex_hull'].value for d in districts] == [1, 1]
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+
+class Shape(object):
+
+    def __init__(self, points, parts):
+        self.points = points
+        self.parts = parts
+
+
+def test_generate_polygons():
+    from pyproj import Transformer
+    from distopia.app.geo_data import GeoData
+    rand = np.random.RandomState(0)
+    shapes = []
+    for i in range(20):
+        points = (rand.uniform(-1e3, 1e3, size=(10, 2)) +
+                  [5e5 + i * 1e3, 3e5]).tolist()
+        shapes.append(Shape(points, [0, 4] if i % 3 else [0]))
+
+    geo_data = GeoData()
+    geo_data.shapes = shapes
+    geo_data.generate_polygons()
+
+    transformer = Transformer.from_crs(
+        'epsg:3071', 'epsg:3857', always_xy=True)
+    expected = []
+    for shape in shapes:
+        bounds = list(shape.parts) + [len(shape.points)]
+        expected.append([
+            np.array([transformer.transform(x, y)
+                      for x, y in shape.points[s:e]])
+            for s, e in zip(bounds[:-1], bounds[1:])])
+
+    assert len(geo_data.polygons) == len(expected)
+    for polygons, expected_polygons in zip(geo_data.polygons, expected):
+        assert len(polygons) == len(expected_polygons)
+        for polygon, expected_polygon in zip(polygons, expected_polygons):
+            assert polygon == pytest.approx(expected_polygon)
+
+    points = np.concatenate([p for polygons in expected for p in polygons])
+    assert geo_data.containing_rect == pytest.approx(
+        tuple(points.min(axis=0)) + tuple(points.max(axis=0)))
+
+    # in chunks on threads
+    points = np.concatenate([shape.points for shape in shapes])
+    assert geo_data.reproject_points(points, threads=4, chunk_size=16) == \
+        pytest.approx(geo_data.reproject_points(points))
+
+
+def test_simplify_polygons():
+    from distopia.app.geo_data import GeoData
+    from distopia.precinct.topology import PrecinctTopology
+    # two squares sharing a boundary with a small zigzag, and a collapsed
+    # polygon
+    zigzag = [(10 + (.1 if k % 2 else 0), k) for k in range(11)]
+    left = np.array([(0, 0)] + zigzag + [(0, 10)], dtype=np.float64)
+    right = np.array(
+        zigzag[::-1] + [(20, 0), (20, 10)], dtype=np.float64)
+    point = np.array([(30, 30)] * 3, dtype=np.float64)
+
+    geo_data = GeoData()
+    geo_data.polygons = [[left, point], [right]]
+    geo_data.simplify_polygons(tolerances=[.5, 4.])
+    assert [tolerance for tolerance, _ in geo_data.polygon_lods] == [.5, 4.]
+
+    polygons = geo_data.get_lod_polygons(1.)
+    assert polygons is geo_data.polygon_lods[0][1]
+    assert geo_data.get_lod_polygons(.1) is geo_data.polygons
+    assert polygons[0][1] is point
+    assert len(polygons[0][0]) < len(left)
+    assert len(polygons[1][0]) < len(right)
+    # the shared boundary is simplified the same on both sides
+    shared = [set(map(tuple, p[np.abs(p[:, 0] - 10) < 1].tolist()))
+              for p in (polygons[0][0], polygons[1][0])]
+    assert shared[0] == shared[1]
+    for polygon in (polygons[0][0], polygons[1][0]):
+        assert abs(PrecinctTopology.get_ring_area(polygon)) == \
+            pytest.approx(100, abs=1)
+
+    flat = geo_data.flatten_polygons(polygons)
+    unflattened = geo_data.unflatten_polygons(*flat)
+    assert len(unflattened) == len(polygons)
+    for p1, p2 in zip(unflattened, polygons):
+        assert len(p1) == len(p2)
+        for polygon1, polygon2 in zip(p1, p2):
+            assert np.array_equal(polygon1, polygon2)
+
+
+def test_flat_data(tmp_path, monkeypatch):
+    from distopia.app.geo_data import GeoData
+    monkeypatch.setattr(GeoData, 'data_path', str(tmp_path))
+    square = np.array([(0, 0), (10, 0), (10, 10), (0, 10)], dtype=np.float64)
+
+    geo_data = GeoData()
+    geo_data.fields = ['id', 'name', 'area']
+    geo_data.records = [(1, 'first', 1.5), (300, 'second', 2.)]
+    geo_data.polygons = [[square, square + 20], [square + 10]]
+    geo_data.simplify_polygons(tolerances=[1.])
+    assert geo_data.dump_flat_data()
+
+    loaded = GeoData()
+    assert loaded.load_flat_data()
+    assert loaded.fields == geo_data.fields
+    assert [tuple(r) for r in loaded.records] == geo_data.records
+    assert loaded.records['id'].tolist() == [1, 300]
+    assert len(loaded.polygon_lods) == 1
+    for polygons, expected in [
+            (loaded.polygons, geo_data.polygons),
+            (loaded.polygon_lods[0][1], geo_data.polygon_lods[0][1])]:
+        assert len(polygons) == len(expected)
+        for p1, p2 in zip(polygons, expected):
+            assert len(p1) == len(p2)
+            for polygon1, polygon2 in zip(p1, p2):
+                assert polygon1.dtype == np.float32
+                assert polygon1 == pytest.approx(polygon2)
+
+    # a truncated buffer is a cache miss, and dumping again replaces it
+    vertices = tmp_path / 'flat_data' / 'vertices.npy'
+    vertices.write_bytes(vertices.read_bytes()[:-8])
+    assert not GeoData().load_flat_data()
+    assert geo_data.dump_flat_data()
+    assert GeoData().load_flat_data()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['flat_data']
+
+    monkeypatch.setattr(GeoData, 'data_path', str(tmp_path / 'missing'))
+    assert not GeoData().load_flat_data()
@@ -0,0 +1,531 @@
+import math
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def voronoi_mapping():
+    from distopia.mapping.voronoi import VoronoiMapping
+    vor = VoronoiMapping()
+    vor.screen_size = (320, 180)
+    return vor
+
+
+def grid_precincts(screen_size, cols=16, rows=9, neighbours=False):
+    from distopia.precinct import Precinct
+    w, h = screen_size
+    dx, dy = w / float(cols), h / float(rows)
+    precincts = []
+    for col in range(cols):
+        for row in range(rows):
+            x0, y0, x1, y1 = col * dx, row * dy, (col + 1) * dx, (row + 1) * dy
+            precincts.append(Precinct(
+                boundary=[x0, y0, x1, y0, x1, y1, x0, y1],
+                identity=len(precincts), location=((x0 + x1) / 2, (y0 + y1) / 2)))
+
+    if neighbours:
+        for i, precinct in enumerate(precincts):
+            col, row = divmod(i, rows)
+            precinct.neighbours = [
+                precincts[c * rows + r] for c, r in
+                ((col - 1, row), (col + 1, row), (col, row - 1), (col, row + 1))
+                if 0 <= c < cols and 0 <= r < rows]
+    return precincts
+
+
+def random_fiducials(n, screen_size, seed=0):
+    w, h = screen_size
+    rand = np.random.RandomState(seed)
+    return rand.uniform(0, 1, size=(n, 2)) * [w - 1, h - 1]
+
+
+@pytest.mark.parametrize('engine', ['nearest', 'scanline'])
+def test_pixel_engines_match_collider(voronoi_mapping, engine):
+    for seed in range(4):
+        fiducials = random_fiducials(8, voronoi_mapping.screen_size, seed)
+        identity = [0, 1, 2, 3, 0, 1, 4, 5]
+        unique_ids = sorted(set(identity))
+
+        voronoi_mapping.pixel_engine = 'collider'
+        expected = voronoi_mapping.compute_district_pixels(
+            fiducials, identity, unique_ids)
+        voronoi_mapping.pixel_engine = engine
+        pixels = voronoi_mapping.compute_district_pixels(
+            fiducials, identity, unique_ids)
+
+        np.testing.assert_array_equal(pixels, expected)
+
+
+def test_fill_voronoi_scanline_window():
+    from distopia.mapping._voronoi import fill_voronoi_scanline
+    sites = random_fiducials(6, (320, 180), seed=3)
+    site_ids = np.arange(6, dtype=np.uint8)
+
+    pixels = np.empty((320, 180), dtype=np.uint8)
+    fill_voronoi_scanline(pixels, sites, site_ids)
+    window = np.zeros((320, 180), dtype=np.uint8)
+    fill_voronoi_scanline(
+        window[40:200, 25:150], sites, site_ids, x_offset=40, y_offset=25)
+
+    np.testing.assert_array_equal(window[40:200, 25:150], pixels[40:200, 25:150])
+    assert not np.any(window[:40])
+
+
+def test_incremental_update_matches_full(voronoi_mapping):
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    fiducials = random_fiducials(8, voronoi_mapping.screen_size, seed=5)
+    identity = [0, 1, 2, 3, 0, 1, 4, 5]
+    unique_ids = sorted(set(identity))
+    voronoi_mapping.compute_assignment(fiducials, identity, unique_ids)
+    voronoi_mapping.incremental_update = True
+
+    rand = np.random.RandomState(7)
+    for step in range(10):
+        i = step % len(fiducials)
+        fiducials[i] = np.clip(
+            fiducials[i] + rand.uniform(-30, 30, size=2), 0, [319, 179])
+        assert voronoi_mapping.get_moved_fiducial(
+            fiducials, identity, unique_ids) == i
+
+        pixels, assignment, counts = voronoi_mapping.compute_assignment(
+            fiducials, identity, unique_ids)
+        expected_pixels = voronoi_mapping.compute_district_pixels(
+            fiducials, identity, unique_ids)
+        expected = voronoi_mapping.assign_precincts_to_districts(
+            len(unique_ids), expected_pixels)
+
+        np.testing.assert_array_equal(pixels, expected_pixels)
+        np.testing.assert_array_equal(
+            counts, voronoi_mapping.compute_precinct_counts(
+                len(unique_ids), expected_pixels))
+        assert assignment == expected
+
+
+def test_progressive_refinement(voronoi_mapping):
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    fiducials = random_fiducials(8, voronoi_mapping.screen_size, seed=2)
+    identity = list(range(8))
+
+    _, expected, _ = voronoi_mapping.compute_assignment(
+        fiducials, identity, identity)
+    pixels, _, counts = voronoi_mapping.compute_assignment(
+        fiducials, identity, identity, scale=.25)
+    assert pixels.shape == (80, 45)
+    assert counts.shape == (16 * 9, 8)
+
+    # refine every precinct
+    voronoi_mapping.refine_margin = 2
+    assert voronoi_mapping.refine_assignment()[0] == expected
+
+    # an incremental update after refining matches a full recompute
+    voronoi_mapping.incremental_update = True
+    fiducials[3] = np.clip(fiducials[3] + [25, -15], 0, [319, 179])
+    assert voronoi_mapping.get_moved_fiducial(
+        fiducials, identity, identity, scale=.25) == 3
+    pixels, assignment, counts = voronoi_mapping.compute_assignment(
+        fiducials, identity, identity, scale=.25)
+
+    voronoi_mapping.incremental_update = False
+    expected_pixels, expected, expected_counts = \
+        voronoi_mapping.compute_assignment(
+            fiducials, identity, identity, scale=.25)
+    np.testing.assert_array_equal(pixels, expected_pixels)
+    np.testing.assert_array_equal(counts, expected_counts)
+    assert assignment == expected
+
+
+def test_grid_scale_controller():
+    from distopia.mapping.voronoi import GridScaleController
+    controller = GridScaleController(
+        target_latency=.01, scales=(1., .5, .25))
+    assert controller.select_scale() == 1.
+
+    controller.record(1., .05)
+    # .5 is extrapolated to .0125 and .25 to .003125
+    assert controller.select_scale() == .25
+
+    controller.record(.5, .008)
+    assert controller.select_scale() == .5
+
+
+def test_grid_scale_controller_records_full_computes(voronoi_mapping):
+    from distopia.mapping.voronoi import GridScaleController
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    voronoi_mapping.grid_controller = controller = GridScaleController()
+    voronoi_mapping.incremental_update = True
+    fiducials = random_fiducials(8, voronoi_mapping.screen_size, seed=5)
+    identity = list(range(8))
+
+    voronoi_mapping.compute_assignment(fiducials, identity, identity)
+    duration = controller.durations[1.]
+    # moving a single fiducial is an incremental update, which isn't timed
+    fiducials[2] += 10
+    voronoi_mapping.compute_assignment(fiducials, identity, identity)
+    assert controller.durations == {1.: duration}
+
+
+def test_precinct_counts(voronoi_mapping):
+    from distopia.mapping._voronoi import PolygonCollider
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    fiducials = random_fiducials(5, voronoi_mapping.screen_size, seed=1)
+    pixels = voronoi_mapping.compute_district_pixels(
+        fiducials, list(range(5)), list(range(5)))
+    counts = voronoi_mapping.compute_precinct_counts(5, pixels)
+
+    bins = np.empty(5, dtype=np.uint64)
+    for i, (x0, y0, x1, y1, mask) in enumerate(
+            voronoi_mapping.precinct_indices):
+        bins[:] = 0
+        PolygonCollider.get_arg_max_count(
+            pixels[x0:x1, y0:y1], mask, bins, 5, x1 - x0, y1 - y0, 255)
+        np.testing.assert_array_equal(counts[i], bins)
+
+
+def even_odd_pixels(points, w, h):
+    # tests each pixel against all the edges, like the collider used to
+    xs, ys = points[0::2], points[1::2]
+    min_x, min_y = math.floor(min(xs)), math.floor(min(ys))
+    xs = [x - min_x for x in xs]
+    ys = [y - min_y for y in ys]
+    edges = []
+    j = len(xs) - 1
+    for i in range(len(xs)):
+        if ys[j] == ys[i]:
+            edges.append((ys[i], ys[j], 0., xs[i]))
+        else:
+            edges.append((ys[i], ys[j], (xs[j] - xs[i]) / (ys[j] - ys[i]),
+                          xs[i] - ys[i] * xs[j] / (ys[j] - ys[i]) +
+                          ys[i] * xs[i] / (ys[j] - ys[i])))
+        j = i
+
+    pixels = set()
+    for y in range(max(-min_y, 0), h - min_y):
+        for x in range(max(-min_x, 0), w - min_x):
+            odd = 0
+            for y_i, y_j, multiple, constant in edges:
+                if y_i < y <= y_j or y_j < y <= y_i:
+                    odd ^= y * multiple + constant < x
+            if odd:
+                pixels.add((x + min_x, y + min_y))
+    return pixels
+
+
+def test_polygon_collider_scanline():
+    from distopia.mapping._voronoi import PolygonCollider
+    rand = np.random.RandomState(0)
+    for trial in range(60):
+        k = rand.randint(3, 12)
+        if trial % 2:
+            # integer vertices have many crossings exactly on pixels
+            points = rand.randint(-5, 40, size=2 * k).astype(np.float64)
+        else:
+            points = rand.uniform(-10, 50, size=2 * k)
+
+        expected = even_odd_pixels(points.tolist(), 40, 30)
+        for value in (points.tolist(), points, points.reshape((-1, 2))):
+            collider = PolygonCollider(
+                points=value, cache=True, rect=(0, 0, 40, 30))
+            assert set(collider.get_inside_points()) == expected
+
+
+def test_threaded_rasterization(voronoi_mapping):
+    from distopia.mapping.raster import PrecinctRaster
+    # overlapping precincts, which are marked in order
+    precincts = grid_precincts(voronoi_mapping.screen_size) + \
+        grid_precincts(voronoi_mapping.screen_size, cols=5, rows=3)
+    rasters = [
+        PrecinctRaster(precincts, voronoi_mapping.screen_size,
+                       num_threads=num_threads)
+        for num_threads in (1, 4)]
+    np.testing.assert_array_equal(
+        rasters[0].pixel_precinct_map, rasters[1].pixel_precinct_map)
+    np.testing.assert_array_equal(rasters[0].bboxes, rasters[1].bboxes)
+    for item1, item2 in zip(
+            rasters[0].precinct_indices, rasters[1].precinct_indices):
+        np.testing.assert_array_equal(item1[4], item2[4])
+    # the masks are the inside points
+    for collider, (x1, y1, _, _, mask) in zip(
+            rasters[0].colliders, rasters[0].precinct_indices):
+        expected = np.zeros_like(mask)
+        for x, y in collider.get_inside_points():
+            expected[x - x1, y - y1] = 1
+        np.testing.assert_array_equal(mask, expected)
+
+    voronoi_mapping.set_precincts(precincts[:144])
+    fiducials = random_fiducials(5, voronoi_mapping.screen_size, seed=2)
+    pixels = voronoi_mapping.compute_district_pixels(
+        fiducials, list(range(5)), list(range(5)))
+    voronoi_mapping.num_threads = 1
+    expected = voronoi_mapping.compute_precinct_counts(5, pixels)
+    voronoi_mapping.num_threads = 3
+    voronoi_mapping.min_thread_pixels = 100
+    try:
+        counts = voronoi_mapping.compute_precinct_counts(5, pixels)
+    finally:
+        voronoi_mapping.stop_thread()
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_precinct_raster_cache(voronoi_mapping, tmp_path):
+    from distopia.mapping.raster import PrecinctRaster
+    precincts = grid_precincts(voronoi_mapping.screen_size)
+    voronoi_mapping.raster_cache_path = str(tmp_path / 'rasters')
+    voronoi_mapping.set_precincts(precincts)
+    raster = voronoi_mapping.get_precinct_raster()
+    assert len(raster.colliders) == len(precincts)
+    assert len(list((tmp_path / 'rasters').iterdir())) == 1
+
+    # a new instance loads it from the cache
+    voronoi_mapping.set_precincts(precincts)
+    loaded = voronoi_mapping.get_precinct_raster()
+    assert not loaded.colliders
+    assert loaded.size == raster.size
+    np.testing.assert_array_equal(
+        loaded.pixel_precinct_map, raster.pixel_precinct_map)
+    np.testing.assert_array_equal(loaded.bboxes, raster.bboxes)
+    np.testing.assert_array_equal(loaded.mask_sizes, raster.mask_sizes)
+    for item, loaded_item in zip(
+            raster.precinct_indices, loaded.precinct_indices):
+        assert item[:4] == loaded_item[:4]
+        np.testing.assert_array_equal(item[4], loaded_item[4])
+    assert isinstance(loaded, PrecinctRaster)
+
+    # other scales and screen sizes are cached separately
+    voronoi_mapping.get_precinct_raster(.5)
+    voronoi_mapping.screen_size = (160, 90)
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    assert len(list((tmp_path / 'rasters').iterdir())) == 3
+
+    # the topology is only built when first needed, and then cached too
+    assert voronoi_mapping.precinct_topology is None
+    topology = voronoi_mapping.get_precinct_topology()
+    assert len(list((tmp_path / 'rasters').iterdir())) == 4
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    loaded = voronoi_mapping.get_precinct_topology()
+    assert loaded is not topology and loaded.n_precincts == 16 * 9
+    for name in loaded._saved_arrays:
+        np.testing.assert_array_equal(
+            getattr(loaded, name), getattr(topology, name))
+
+
+def test_reassignment_cache(voronoi_mapping):
+    from distopia.mapping.voronoi import ReassignmentCache
+    precincts = grid_precincts(voronoi_mapping.screen_size, neighbours=True)
+
+    voronoi_mapping.reassignment_cache = cache = ReassignmentCache(
+        max_entries=2, grid=4.)
+    voronoi_mapping.set_precincts(precincts)
+
+    layouts = [
+        [(40, 40), (280, 40), (40, 140), (280, 140)],
+        [(40, 40), (280, 40), (40, 140), (160, 90)],
+        [(160, 40), (280, 40), (40, 140), (160, 90)]]
+    keys = []
+    for pos in layouts[0]:
+        keys.append(voronoi_mapping.add_fiducial(pos, len(keys)))
+
+    districts = voronoi_mapping.apply_voronoi()
+    assert len(districts) == 4
+    assert cache.get_stats()['misses'] == 1
+
+    # moving a fiducial within the grid hits the cache
+    voronoi_mapping.move_fiducial(keys[0], (41, 40.5))
+    assert voronoi_mapping.apply_voronoi() is districts
+    assert cache.hits == 1
+
+    for pos in layouts[1:]:
+        voronoi_mapping.move_fiducial(keys[0], pos[0])
+        voronoi_mapping.move_fiducial(keys[3], pos[3])
+        voronoi_mapping.apply_voronoi()
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.misses == 3
+
+    # the first layout was evicted, and adding it evicts the second
+    voronoi_mapping.move_fiducial(keys[0], layouts[0][0])
+    voronoi_mapping.move_fiducial(keys[3], layouts[0][3])
+    assert voronoi_mapping.apply_voronoi() is not districts
+    voronoi_mapping.move_fiducial(keys[0], layouts[2][0])
+    voronoi_mapping.move_fiducial(keys[3], layouts[2][3])
+    voronoi_mapping.apply_voronoi()
+    assert cache.hits == 2
+    assert cache.get_stats()['hit_rate'] == 2 / 6.
+
+
+def test_reassignment_mailbox():
+    from distopia.mapping.voronoi import ReassignmentMailbox
+    mailbox = ReassignmentMailbox(max_cancellations=1)
+    for i in range(3):
+        assert mailbox.post(i) == i + 1
+    # the newest request replaced the others
+    assert mailbox.get()[:2] == (3, 2)
+    assert not mailbox.has_pending()
+
+    mailbox.post(3)
+    epoch, request, token = mailbox.get()
+    assert not token.cancelled
+    mailbox.post(4)
+    assert token.cancelled
+    assert mailbox.is_stale(epoch)
+    mailbox.done(cancelled=True)
+
+    # after max_cancellations in a row, the computation is allowed to finish
+    epoch, request, token = mailbox.get()
+    mailbox.post(5)
+    assert not token.cancelled
+    mailbox.done()
+
+    epoch, request, token = mailbox.get()
+    mailbox.post(6, cancellable=False)
+    assert token.cancelled
+    mailbox.done(cancelled=True)
+    epoch, request, token = mailbox.get()
+    mailbox.post(7)
+    assert not token.cancelled
+
+    mailbox.close()
+    assert mailbox.get() is None
+
+
+def test_cancel_computation(voronoi_mapping):
+    from distopia.mapping.voronoi import CancellationToken, \
+        ComputationCancelled
+    from distopia.mapping._voronoi import fill_voronoi_scanline
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    fiducials = random_fiducials(5, voronoi_mapping.screen_size, seed=2)
+    ids = list(range(5))
+
+    token = CancellationToken()
+    token.cancel()
+    pixels = np.zeros((320, 180), dtype=np.uint8)
+    fill_voronoi_scanline(
+        pixels, fiducials, np.arange(1, 6, dtype=np.uint8),
+        cancel=token.flag)
+    assert not pixels.any()
+
+    with pytest.raises(ComputationCancelled):
+        voronoi_mapping.compute_assignment(
+            fiducials, ids, ids, cancel_token=token)
+    assert voronoi_mapping._last_computation is None
+
+
+def test_agent_evaluate_many():
+    from distopia.app.agent import VoronoiAgent
+    from distopia.mapping.voronoi import VoronoiMapping
+    from distopia.precinct.metrics import PrecinctHistogram
+    agent = VoronoiAgent()
+    agent.metrics = ['population']
+    agent.screen_size = (320, 180)
+    agent.voronoi_mapping = vor = VoronoiMapping()
+    vor.screen_size = agent.screen_size
+    agent.precincts = precincts = grid_precincts(
+        agent.screen_size, neighbours=True)
+    for i, precinct in enumerate(precincts):
+        precinct.metrics['population'] = PrecinctHistogram(
+            name='population', labels=['a', 'b'], data=[i, 1])
+    vor.set_precincts(precincts)
+
+    configs = [
+        {i: [tuple(pos)] for i, pos in enumerate(
+            random_fiducials(5, agent.screen_size, seed))}
+        for seed in range(10)]
+    configs[3] = {0: [(10, 10)]}
+    expected = [agent.evaluate_design(config) for config in configs]
+    assert expected[3] == {'districts': [], 'metrics': [], 'error': []}
+    assert any(result['districts'] for result in expected)
+    assert vor.fiducial_locations == {}
+
+    try:
+        results = agent.evaluate_many(configs, chunk_size=3, max_pending=1)
+    finally:
+        agent.stop_pool()
+    assert results == expected
+
+
+def test_batch_assignment(voronoi_mapping):
+    from distopia.mapping._voronoi import PolygonCollider
+    voronoi_mapping.set_precincts(grid_precincts(voronoi_mapping.screen_size))
+    fiducials = np.stack([
+        random_fiducials(6, voronoi_mapping.screen_size, seed)
+        for seed in range(5)])
+    fiducials[2, 5] = np.nan
+    districts = np.array([0, 1, 2, 3, 0, 1])
+    assignment = voronoi_mapping.compute_batch_assignment(
+        fiducials, districts, 4, block_size=1000)
+    assert assignment.shape == (5, 16 * 9)
+
+    bins = np.empty(4, dtype=np.uint64)
+    for i in range(5):
+        n = 5 if i == 2 else 6
+        pixels = voronoi_mapping.compute_district_pixels(
+            fiducials[i, :n], districts[:n], list(range(4)))
+        for j, (x0, y0, x1, y1, mask) in enumerate(
+                voronoi_mapping.precinct_indices):
+            bins[:] = 0
+            assert assignment[i, j] == PolygonCollider.get_arg_max_count(
+                pixels[x0:x1, y0:y1], mask, bins, 4, x1 - x0, y1 - y0, 255)
+
+
+def test_clipped_voronoi_polygons():
+    from distopia.mapping.voronoi import clipped_voronoi_polygons, \
+        voronoi_cell_polygon
+
+    def area(polygon):
+        x, y = polygon[:, 0], polygon[:, 1]
+        return abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1))) / 2
+
+    rect = (-.5, -.5, 319.5, 179.5)
+    sites = random_fiducials(7, (320, 180), seed=4)
+    vertices, offsets = clipped_voronoi_polygons(sites, rect)
+    assert offsets.shape == (8, )
+    assert np.all(vertices >= rect[:2]) and np.all(vertices <= rect[2:])
+
+    for i in range(7):
+        polygon = vertices[offsets[i]:offsets[i + 1]]
+        assert area(polygon) == pytest.approx(
+            area(voronoi_cell_polygon(sites, i, rect)))
+    assert sum(
+        area(vertices[offsets[i]:offsets[i + 1]]) for i in range(7)) == \
+        pytest.approx(320 * 180)
+
+
+def test_reassignment_cache_coarse_results(voronoi_mapping):
+    import threading
+    from distopia.mapping.voronoi import GridScaleController, \
+        ReassignmentCache
+    voronoi_mapping.reassignment_cache = cache = ReassignmentCache()
+    voronoi_mapping.set_precincts(
+        grid_precincts(voronoi_mapping.screen_size, neighbours=True))
+    # the controller always picks the coarse grid
+    voronoi_mapping.grid_controller = GridScaleController(scales=(.25, ))
+    for i, pos in enumerate(random_fiducials(
+            6, voronoi_mapping.screen_size, seed=3)):
+        voronoi_mapping.add_fiducial(pos, i)
+
+    done = threading.Event()
+    errors = []
+
+    def callback(districts, fiducial_identity, fiducial_pos, error, *largs,
+                 **kwargs):
+        errors.extend(error)
+        done.set()
+
+    voronoi_mapping.start_processing_thread()
+    try:
+        # a coarse result that is not refined is not cached
+        voronoi_mapping.progressive = False
+        voronoi_mapping.request_reassignment(callback)
+        assert done.wait(10)
+        assert not errors
+        assert len(cache) == 0
+
+        # but it is once refined to the compute scale
+        voronoi_mapping.progressive = True
+        done.clear()
+        voronoi_mapping.request_reassignment(callback)
+        while done.wait(10) and not len(cache):
+            done.clear()
+        assert not errors
+        assert len(cache) == 1
+    finally:
+        voronoi_mapping.stop_thread()
@@ -0,0 +1,36 @@
+import pytest
+
+
+def test_state_metric_suite():
+    from distopia.district import District
+    from distopia.district.metrics import DistrictHistogramAggregateMetric
+    from distopia.metrics import StateMetricSuite
+
+    def make_district(population, dem, rep, white, black):
+        district = District()
+        for name, labels, data in [
+                ('population', ['population-total', 'population-voting'],
+                 [population, population]),
+                ('projected_votes', ['2016-democrat', '2016-republican'],
+                 [dem, rep]),
+                ('race', ['population-white', 'population-black'],
+                 [white, black])]:
+            metric = district.metrics[name] = \
+                DistrictHistogramAggregateMetric(district=district, name=name)
+            metric.labels = labels
+            metric.data = data
+        return district
+
+    districts = [
+        make_district(100, .7, .3, 40, 60),
+        make_district(100, .4, .6, 90, 10),
+        make_district(200, .45, .55, 150, 50)]
+    metrics = StateMetricSuite().create_state_metrics(districts)
+    values = {metric.name: metric.value for metric in metrics}
+
+    assert values['population_deviation'] == pytest.approx(.5)
+    assert values['seat_share'] == pytest.approx(1 / 3.)
+    assert values['majority_minority'] == 1
+    # wasted dem votes: 70 - 50, 40, 90 and rep votes: 30, 60 - 50, 110 - 100
+    assert values['efficiency_gap'] == pytest.approx((150 - 50) / 400.)
+    assert values['mean_median'] == pytest.approx(.45 - (.7 + .4 + .45) / 3)
@@ -1,4 +1,257 @@
+import pytest
+
 
 def test_create_precinct():
     from distopia.precinct import Precinct
     Precinct()
+
+
+def test_adjacency_disconnected_pieces():
+    import numpy as np
+    from distopia.precinct.adjacency import PrecinctAdjacency
+    # a 4x3 grid of precincts, indexed row by row
+    edges = [(r * 4 + c, r * 4 + c + 1) for r in range(3) for c in range(3)]
+    edges += [(r * 4 + c, (r + 1) * 4 + c) for r in range(2) for c in range(4)]
+    adjacency = PrecinctAdjacency.from_edges(12, edges)
+    assert sorted(adjacency.get_neighbours(5).tolist()) == [1, 4, 6, 9]
+
+    districts = np.array([
+        0, 0, 1, 1,
+        0, 0, 1, 2,
+        0, 1, 1, 2])
+    assert adjacency.find_disconnected_pieces(districts) == []
+
+    districts[3] = 0
+    districts[5] = 2
+    districts[9] = -1
+    pieces = adjacency.find_disconnected_pieces(districts)
+    assert [piece.tolist() for piece in pieces] == [[3], [5]]
+
+
+def test_adjacency_from_precincts():
+    from distopia.precinct import Precinct
+    from distopia.precinct.adjacency import PrecinctAdjacency
+    precincts = [Precinct(identity=i) for i in range(4)]
+    precincts[0].neighbours = [precincts[1]]
+    precincts[2].neighbours = [precincts[1], precincts[3]]
+    adjacency = PrecinctAdjacency.from_precincts(precincts)
+    assert adjacency.indptr.tolist() == [0, 1, 3, 5, 6]
+    assert adjacency.indices.tolist() == [1, 0, 2, 1, 3, 2]
+
+
+def test_district_contiguity_matches_full():
+    import numpy as np
+    from distopia.precinct.adjacency import PrecinctAdjacency, \
+        DistrictContiguity
+    rows, cols = 12, 15
+    edges = [(r * cols + c, r * cols + c + 1)
+             for r in range(rows) for c in range(cols - 1)]
+    edges += [(r * cols + c, (r + 1) * cols + c)
+              for r in range(rows - 1) for c in range(cols)]
+    adjacency = PrecinctAdjacency.from_edges(rows * cols, edges)
+
+    rand = np.random.RandomState(0)
+    districts = (np.arange(rows * cols) % cols) // 4
+    contiguity = DistrictContiguity(adjacency, districts, max_flips=10)
+    for _ in range(300):
+        districts = districts.copy()
+        flips = rand.randint(0, rows * cols, rand.randint(1, 15))
+        districts[flips] = rand.randint(-1, 4, len(flips))
+        contiguity.update(districts)
+
+        expected = adjacency.find_disconnected_pieces(districts)
+        pieces = contiguity.find_disconnected_pieces()
+        assert [p.tolist() for p in pieces] == [p.tolist() for p in expected]
+        for district in range(4):
+            assert contiguity.is_connected(district) == (not any(
+                districts[p[0]] == district for p in expected))
+
+
+@pytest.mark.parametrize('mode', ['rook', 'queen'])
+def test_adjacency_from_geometry(tmp_path, mode):
+    import numpy as np
+    from distopia.precinct.adjacency import PrecinctAdjacency, \
+        adjacency_from_polygons, adjacency_from_raster
+    # a 3x3 grid of 10x10 squares, the middle one split with an extra vertex
+    # that its neighbours don't have
+    polygons = []
+    for row in range(3):
+        for col in range(3):
+            x, y = col * 10, row * 10
+            square = [(x, y), (x + 10, y), (x + 10, y + 10), (x, y + 10)]
+            if (row, col) == (1, 1):
+                square.insert(1, (x + 5, y))
+            polygons.append([np.array(square, dtype=np.float64)])
+
+    expected = {(0, 1), (1, 2), (3, 4), (4, 5), (6, 7), (7, 8),
+                (0, 3), (3, 6), (1, 4), (4, 7), (2, 5), (5, 8)}
+    if mode == 'queen':
+        expected |= {(0, 4), (1, 3), (1, 5), (2, 4), (3, 7), (4, 6),
+                     (4, 8), (5, 7)}
+
+    def get_edges(adjacency):
+        rows, cols = adjacency.get_edges()
+        return {(r, c) for r, c in zip(rows.tolist(), cols.tolist()) if r < c}
+
+    adjacency = adjacency_from_polygons(polygons, mode=mode, tolerance=.5)
+    assert get_edges(adjacency) == expected
+
+    pixels = np.repeat(np.repeat(
+        np.arange(9).reshape((3, 3)).T, 10, axis=0), 10, axis=1)
+    assert get_edges(adjacency_from_raster(pixels, 9, mode=mode)) == expected
+
+    fname = str(tmp_path / 'adjacency.npz')
+    adjacency.save(fname)
+    assert get_edges(PrecinctAdjacency.load(fname)) == expected
+
+
+def test_point_edge_pairs_long_edges():
+    import numpy as np
+    from distopia.precinct.adjacency import find_point_edge_pairs
+    rand = np.random.RandomState(4)
+    # many short edges and a few very long ones, like a straight boundary
+    starts = rand.uniform(0, 1000, size=(400, 2))
+    ends = starts + rand.uniform(-2, 2, size=(400, 2))
+    starts[:3] = [(0, 0), (0, 1000), (500, 0)]
+    ends[:3] = [(1000, 1000), (1000, 0), (500, 1000)]
+    points = rand.uniform(0, 1000, size=(3000, 2))
+
+    point_ids, edge_ids, dist, _ = find_point_edge_pairs(
+        points, starts, ends, 3.)
+    found = {(p, e) for p, e, d in zip(
+        point_ids.tolist(), edge_ids.tolist(), dist.tolist()) if d <= 3.}
+    assert len(found) == len(point_ids[dist <= 3.])
+
+    a = starts[np.newaxis, :, :]
+    ab = (ends - starts)[np.newaxis, :, :]
+    t = np.clip(np.sum((points[:, np.newaxis, :] - a) * ab, axis=2) /
+                np.sum(ab * ab, axis=2), 0, 1)
+    all_dist = np.linalg.norm(
+        a + ab * t[:, :, np.newaxis] - points[:, np.newaxis, :], axis=2)
+    expected = {tuple(pair) for pair in np.argwhere(all_dist <= 3.).tolist()}
+    assert found == expected
+    assert any(e < 3 for _, e in expected)
+
+
+def test_precinct_table():
+    import numpy as np
+    from distopia.precinct import PrecinctTable
+    from distopia.precinct.metrics import PrecinctHistogram, PrecinctScalar
+    from distopia.district import District
+    table = PrecinctTable(
+        [[0, 0, 2, 0, 2, 2], np.array([[0, 0], [4, 4]]), []],
+        names=['a', 'b', 'c'])
+    precincts = table.precincts
+    assert precincts is table.precincts
+    assert precincts[0].boundary == [0, 0, 2, 0, 2, 2]
+    assert precincts[1].location == (2, 2)
+    assert precincts[2].boundary == []
+
+    precincts[2].boundary = [1, 1, 3, 3]
+    precincts[2].name = 'a longer name'
+    assert precincts[1].boundary == [0, 0, 4, 4]
+    assert precincts[2].boundary == [1, 1, 3, 3]
+    assert [p.name for p in precincts] == ['a', 'b', 'a longer name']
+
+    precincts[0].neighbours = [precincts[1], precincts[2]]
+    precincts[2].neighbours = [precincts[0]]
+    assert precincts[0].neighbours == [precincts[1], precincts[2]]
+    assert precincts[1].neighbours == []
+    assert table.get_adjacency().indices.tolist() == [1, 2, 0, 0]
+
+    table.set_metric('age', [[1, 2], [3, 4], [5, 6]], labels=['x', 'y'])
+    precincts[1].metrics['income'] = PrecinctScalar(name='income', value=7)
+    age = precincts[2].metrics['age']
+    assert isinstance(age, PrecinctHistogram)
+    assert age.labels == ['x', 'y'] and list(age.data) == [5, 6]
+    assert [precincts[i].metrics['income'].value for i in range(3)] == \
+        [0, 7, 0]
+    assert sorted(precincts[0].metrics) == ['age', 'income']
+
+    districts = []
+    for _ in range(100):
+        districts = [District(), District()]
+        districts[0].assign_precincts(precincts[:2])
+        districts[1].assign_precincts(precincts[2:])
+    assert [p.district for p in precincts] == [
+        districts[0], districts[0], districts[1]]
+    assert len(table.district_objects) <= 64
+
+
+def test_precinct_topology():
+    import numpy as np
+    from distopia.precinct.topology import PrecinctTopology
+    # a 3x3 grid of 10x10 squares, some clockwise, the middle one with an
+    # extra vertex that its neighbour doesn't have and slightly offset
+    polygons = []
+    for row in range(3):
+        for col in range(3):
+            x, y = col * 10, row * 10
+            square = [(x, y), (x + 10, y), (x + 10, y + 10), (x, y + 10)]
+            if (row, col) == (1, 1):
+                square = [(x, y + .2), (x + 5, y + .2), (x + 10, y),
+                          (x + 10, y + 10), (x, y + 10)]
+            if col == 2:
+                square = square[::-1]
+            polygons.append([np.array(square, dtype=np.float64)])
+
+    topology = PrecinctTopology.from_polygons(polygons, tolerance=.5)
+    # 12 shared arcs and 8 on the outside
+    assert topology.n_arcs == 20
+    assert np.count_nonzero((topology.arc_precincts >= 0).all(axis=1)) == 12
+    for ring in range(9):
+        arcs = topology.ring_arcs[
+            topology.ring_offsets[ring]:topology.ring_offsets[ring + 1]]
+        points = np.concatenate(
+            [topology.get_arc_points(arc)[:-1] for arc in arcs])
+        assert topology.get_ring_area(points) == pytest.approx(100, abs=3)
+
+    def get_areas(precinct_districts, n):
+        return [sorted(int(round(topology.get_ring_area(ring), -1))
+                       for ring in rings)
+                for rings in topology.get_district_rings(
+                    precinct_districts, n)]
+
+    assert get_areas([0, 0, 0, 0, 0, 0, 0, 0, 0], 1) == [[900]]
+    assert get_areas([0, 1, 1, 0, 1, 1, 0, 1, 1], 2) == [[300], [600]]
+    # the middle precinct is a hole in the other district, and precincts
+    # under no district are skipped
+    assert get_areas([0, 0, 0, 0, 1, 0, 0, 0, 0], 2) == [[-100, 900], [100]]
+    assert get_areas([-1, 0, 0, 0, 0, 0, 0, 0, 0], 1) == [[800]]
+
+    rings = topology.get_district_rings([0, 1, 1, 0, 1, 1, 0, 1, 1], 2)
+    assert topology.get_district_rings(
+        [0, 1, 1, 0, 1, 1, 0, 1, 1], 2) is rings
+
+
+def test_precinct_topology_close_vertices():
+    import numpy as np
+    from distopia.precinct.topology import PrecinctTopology
+    # two squares whose shared boundary has vertices every .2, offset
+    # slightly on the right side, which are closer than half the tolerance
+    ys = np.arange(.2, 9.9, .2)
+    left = np.concatenate([
+        [(0, 0), (10, 0)], np.stack([np.full(len(ys), 10.), ys], axis=1),
+        [(10, 10), (0, 10)]])
+    right = np.concatenate([
+        [(10, 0), (20, 0), (20, 10), (10, 10)],
+        np.stack([np.full(len(ys), 10.05), ys[::-1] + .05], axis=1)])
+    polygons = [[left], [right]]
+
+    topology = PrecinctTopology.from_polygons(polygons, tolerance=.5)
+    # every vertex stays within half the tolerance of its node, instead of
+    # the whole boundary collapsing into one node
+    vertices = topology.vertices
+    for polygon in (left, right):
+        dist = np.min(np.linalg.norm(
+            polygon[:, np.newaxis, :] - vertices[np.newaxis, :, :],
+            axis=2), axis=1)
+        assert np.all(dist <= .25)
+
+    assert np.count_nonzero((topology.arc_precincts >= 0).all(axis=1)) == 1
+    for ring in range(2):
+        arcs = topology.ring_arcs[
+            topology.ring_offsets[ring]:topology.ring_offsets[ring + 1]]
+        points = np.concatenate(
+            [topology.get_arc_points(arc)[:-1] for arc in arcs])
+        assert topology.get_ring_area(points) == pytest.approx(100, abs=1)
@@ -1,3 +1,4 @@
+import sys
 from setuptools import setup, find_packages
 from distutils.extension import Extension
 from Cython.Build import cythonize
@@ -20,6 +21,15 @@ class CustomBuildExtCommand(build_ext):
         build_ext.run(self)
 
 
+if sys.platform == 'win32':
+    openmp_compile_args = ['/openmp']
+    openmp_link_args = []
+elif sys.platform == 'darwin':
+    # apple's clang does not ship with OpenMP, kernels run single threaded
+    openmp_compile_args = openmp_link_args = []
+else:
+    openmp_compile_args = openmp_link_args = ['-fopenmp']
+
 setup(
     name='Distopia',
     version=distopia.__version__,
@@ -30,7 +40,6 @@ setup(
     long_description=long_description,
     classifiers=['License :: OSI Approved :: MIT License',
                  'Topic :: Scientific/Engineering',
-                 'Programming Language :: Python :: 2.7',
                  'Programming Language :: Python :: 3.5',
                  'Programming Language :: Python :: 3.6',
                  'Programming Language :: Python :: 3.7',
@@ -38,7 +47,9 @@ setup(
     packages=find_packages(),
     cmdclass={'build_ext': CustomBuildExtCommand},
     ext_modules=cythonize([Extension(
-        "distopia.mapping._voronoi", ["distopia/mapping/_voronoi.pyx"])]),
+        "distopia.mapping._voronoi", ["distopia/mapping/_voronoi.pyx"],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args)]),
     install_requires=['pytest', 'scipy', 'pyshp', 'numpy', 'pyproj', 'oscpy',
                       'matplotlib', 'Cython', 'roslibpy'],
     package_data={'distopia': ['data/*', ]},